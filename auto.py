@@ -38,6 +38,7 @@ import urllib.error
 import urllib.parse
 import urllib.request
 from argparse import Namespace
+from functools import partial
 from shutil import copy, copytree
 from shutil import get_terminal_size as tsize
 from shutil import rmtree
@@ -48,13 +49,25 @@ from zipfile import ZipFile
 import psutil
 from PIL import Image, ImageChops
 
+import tracing
+from catalog import TileCatalog
+from checkpoint import openCheckpoint, unitKey
 from crop import crop
+from encoders import ENCODERS, parseProfile, readFormats
+from rawimage import jpegQuality, screenshotExt
+from metrics import Metrics
+from filewatch import SAFETYINTERVAL, FileWatcher, waitForData, waitForFile
 from ref import ref
+from scheduler import Scheduler, stageCpu
+from tilestore import closeConnections, dedupSavings, uniformTiles
 from updateLib import update as updateLib
+from workerpool import WorkerPool
 from zoom import zoom, zoomRenderboxes
 
 userFolder = Path(__file__, "..", "..", "..").resolve()
 
+STAGEMEMORY = 64	# MB per thread the scheduler reserves for a step, zoom reserves --zoommemory instead if that is more.
+
 def naturalSort(l): 
 	convert = lambda text: int(text) if text.isdigit() else text.lower() 
 	alphanum_key = lambda key: [ convert(c) for c in re.split('(\d+)', key) ] 
@@ -69,10 +82,14 @@ def printErase(arg):
 		pass
 
 
-def startGameAndReadGameLogs(results, condition, exeWithArgs, isSteam, tmpDir, pidBlacklist, rawTags, args):
+def startGameAndReadGameLogs(results, condition, exeWithArgs, isSteam, tmpDir, pidBlacklist, rawTags, args, traceEvents=None):
+
+	if traceEvents is not None:
+		tracing.start("factorio logs", traceEvents)
 
 	pipeOut, pipeIn = os.pipe()
-	p = subprocess.Popen(exeWithArgs, stdout=pipeIn)
+	with tracing.span("launch factorio", "factorio"):
+		p = subprocess.Popen(exeWithArgs, stdout=pipeIn)
 
 	printingStackTraceback = False
 	# TODO: keep printing multiline stuff until new print detected
@@ -102,6 +119,7 @@ def startGameAndReadGameLogs(results, condition, exeWithArgs, isSteam, tmpDir, p
 				return True
 			m = re.match(r'^\ *\d+(?:\.\d+)? *Script *@__L0laapk3_FactorioMaps__\/(.*?)(?:(\[info\]) ?(.*))?$', line, re.IGNORECASE)
 			if m is not None and m.group(2) is not None:
+				tracing.instant(m.group(3), "factorio")
 				printErase(m.group(3))
 				prevPrinted = True
 			elif m is not None and args.verbose:
@@ -121,11 +139,11 @@ def startGameAndReadGameLogs(results, condition, exeWithArgs, isSteam, tmpDir, p
 			attrs = ('pid', 'name', 'create_time')
 
 			# on some devices, the previous check wasn't enough apparently, so explicitely wait until the log file is created.
-			while not os.path.exists(os.path.join(tmpDir, "factorio-current.log")):
-				time.sleep(0.4)
+			waitForFile(os.path.join(tmpDir, "factorio-current.log"))
 
 			oldest = None
 			pid = None
+			findStart = tracing.now()
 			while pid is None:
 				for proc in psutil.process_iter(attrs=attrs):
 					pinfo = proc.as_dict(attrs=attrs)
@@ -134,6 +152,7 @@ def startGameAndReadGameLogs(results, condition, exeWithArgs, isSteam, tmpDir, p
 						pid = pinfo["pid"]
 				if pid is None:
 					time.sleep(1)
+			tracing.complete("find factorio process", findStart, "factorio")
 			# print(f"PID: {pid}")
 		else:
 			pid = p.pid
@@ -147,12 +166,12 @@ def startGameAndReadGameLogs(results, condition, exeWithArgs, isSteam, tmpDir, p
 		isFirstLine = True
 		if isSteam:
 			pipef.close()
-			with Path(tmpDir, "factorio-current.log").open("r", encoding="utf-8") as f:
+			with Path(tmpDir, "factorio-current.log").open("r", encoding="utf-8") as f, FileWatcher(Path(tmpDir, "factorio-current.log")) as watcher:
 				while psutil.pid_exists(pid):
 					where = f.tell()
 					line = f.readline()
 					if not line:
-						time.sleep(0.4)
+						watcher.wait(0.4)
 						f.seek(where)
 					else:
 						printingStackTraceback = handleGameLine(line, isFirstLine)
@@ -265,7 +284,7 @@ def changeModlist(modpath: Path,newState: bool):
 		json.dump(modlist, f, indent=2)
 
 
-def buildAutorun(args: Namespace, workFolder: Path, outFolder: Path, isFirstSnapshot: bool, daytime: str):
+def buildAutorun(args: Namespace, workFolder: Path, outFolder: Path, isFirstSnapshot: bool, daytimes: list, mapInfoFile: str):
 	printErase("Building autorun.lua")
 	mapInfoPath = Path(workFolder, "mapInfo.json")
 	if mapInfoPath.is_file():
@@ -296,11 +315,14 @@ def buildAutorun(args: Namespace, workFolder: Path, outFolder: Path, isFirstSnap
 
 	with Path(__file__, "..", "autorun.lua").resolve().open("w", encoding="utf-8") as f:
 		surfaceString = '{"' + '", "'.join(args.surface) + '"}' if args.surface else "nil"
+		daytimeString = '{"' + '", "'.join(daytimes) + '"}'
 		autorunString = \
 			f'''fm.autorun = {{
 			HD = {lowerBool(args.hd)},
-			daytime = "{daytime}",
+			daytimes = {daytimeString},
 			alt_mode = {lowerBool(args.altmode)},
+			screenshot_extension = "{screenshotExt(args)}",
+			jpeg_quality = {jpegQuality(parseProfile(args.tileformat))},
 			tags = {lowerBool(args.tags)},
 			around_tag_range = {args.tag_range},
 			around_build_range = {args.build_range},
@@ -309,6 +331,7 @@ def buildAutorun(args: Namespace, workFolder: Path, outFolder: Path, isFirstSnap
 			date = "{datetime.datetime.strptime(args.date, "%d/%m/%y").strftime("%d/%m/%y")}",
 			surfaces = {surfaceString},
 			name = "{str(outFolder) + "/"}",
+			mapinfo_file = "{mapInfoFile}",
 			mapInfo = {mapInfoLua.encode("utf-8").decode("unicode-escape")},
 			chunkCache = {chunkCache}
 			}}'''
@@ -354,17 +377,24 @@ def buildConfig(args: Namespace, tmpDir, basepath):
 def auto(*args):
 
 	lock = threading.Lock()
+	def running(pid):
+		# a factorio we started stays a zombie until it is waited for, it has exited all the same.
+		try:
+			return psutil.Process(pid).status() != psutil.STATUS_ZOMBIE
+		except psutil.NoSuchProcess:
+			return False
+
 	def kill(pid, onlyStall=False):
 		if pid:
-			with lock:
+			with lock, tracing.span("kill factorio", "factorio"):
 				if not onlyStall and psutil.pid_exists(pid):
 
 					if os.name == 'nt':
 						subprocess.check_call(("taskkill", "/pid", str(pid)), stdout=subprocess.DEVNULL, shell=True)
 					else:
-						subprocess.check_call(("killall", "factorio"), stdout=subprocess.DEVNULL)	# TODO: kill correct process instead of just killing all
+						psutil.Process(pid).terminate()
 
-					while psutil.pid_exists(pid):
+					while running(pid):
 						time.sleep(0.1)
 
 					printErase("killed factorio")
@@ -398,7 +428,19 @@ def auto(*args):
 	parser.add_argument("--cropthreads", type=int, default=None, help="Sets the number of threads used for the crop step.")
 	parser.add_argument("--refthreads", type=int, default=None, help="Sets the number of threads used for the crossreferencing step.")
 	parser.add_argument("--zoomthreads", type=int, default=None, help="Sets the number of threads used for the zoom step.")
+	parser.add_argument("--refmode", choices=("signature", "exact", "scaled"), default="signature", help="How the crossreferencing step compares new screenshots with old tiles. signature compares with the 1/8 size signature zoom stored for the old tile and decodes the old tile at full size if there is none. exact always decodes both at full size, slower, only useful if you suspect the faster comparison misses changes. scaled is signature, but decodes old jpg tiles without a signature at 1/4 size, about a third faster than full size with --screenshotformat=bmp and no faster with png screenshots.")
+	parser.add_argument("--zoommemory", type=int, default=256, help="Sets the amount of memory (in MB) each zoom thread may use to keep zoom levels in memory instead of writing them to disk in between. Set to 0 to always write every zoom level to disk.")
+	parser.add_argument("--downsampler", choices=("antialias", "box"), default="antialias", help="How the zoom step shrinks 4 tiles into their parent. antialias resizes every child with PIL. box averages 2x2 pixel blocks of all 4 children at once, which is faster but a little less smooth, and keeps jpeg screenshots from being used as tiles as they are.")
+	parser.add_argument("--memorybudget", type=int, default=None, help="Sets the amount of memory (in MB) all steps that run at the same time may use together. By default this is half of the memory available when the script starts.")
+	parser.add_argument("--metrics-file", type=lambda p: Path(p).resolve(), default=None, help="Writes tile counts, bytes read and written, decode and encode time, per tile latencies, worker utilisation and time spent waiting on factorio per step, snapshot, surface and daytime to this json file while the script runs.")
+	parser.add_argument("--screenshotformat", choices=("png", "bmp", "jpeg"), default="png", help="Format factorio saves its screenshots in. bmp screenshots are read without decoding them, which uses a lot more disk space while the snapshot is being made but much less cpu time. jpeg screenshots are cropped without decoding them and kept as the max zoom tiles when those are jpg, at the cost of a little quality. A jpeg screenshot that needs cropping in only one of two snapshots is encoded again, so crossreferencing sees it as changed and keeps it and the neighbours it was cropped towards, even when nothing changed.")
+	parser.add_argument("--tileformat", default="jpg", help="Formats of the finished tiles from the max zoom level outwards, separated by commas. The last one is used for all remaining zoom levels. jpg, webp, webp-lossless or avif (needs pip install pillow-avif-plugin), each optionally followed by :quality, like webp-lossless,webp:75.")
+	parser.add_argument("--tilestore", choices=("files", "sqlite"), default="files", help="Where the finished tiles go. sqlite packs the tiles of every snapshot, surface and daytime into one tiles.sqlite file, view the result with python tilestore.py OUTPUTFOLDER.")
+	parser.add_argument("--dedup", action="store_true", help="Stores every finished tile that is byte for byte the same as one written before, in any snapshot, surface or daytime, as a hard link to it (or a reference to it with --tilestore sqlite) instead of another copy.")
+	parser.add_argument("--trace", type=lambda p: Path(p).resolve(), default=None, help="Writes a timeline of factorio, every step and every worker process to this file when the script ends. Open it in https://ui.perfetto.dev or chrome://tracing.")
+	parser.add_argument("--metrics-port", type=int, default=None, help="Serves the same json as --metrics-file on http://127.0.0.1:PORT/ while the script runs.")
 	parser.add_argument("--screenshotthreads", type=int, default=None, help="Set the number of screenshotting threads factorio uses.")
+	parser.add_argument("--captures", type=int, default=1, help="Sets the number of factorio instances that take the screenshots of different saves at the same time. Only the screenshots overlap: all instances share autorun.lua, latest.txt and the chunk cache, so each save is only loaded once the one before it scanned its surfaces. Needs the standalone version of factorio, steam only runs one at a time.")
 	parser.add_argument("--delete", action="store_true", help="Deletes the output folder specified before running the script.")
 	parser.add_argument("--dry", action="store_true", help="Skips starting factorio, making screenshots and doing the main steps, only execute setting up and finishing of script.")
 	parser.add_argument("targetname", nargs="?", help="output folder name for the generated snapshots.")
@@ -408,6 +450,10 @@ def auto(*args):
 	args = parser.parse_args()
 	if args.verbose > 0:
 		print(args)
+	try:
+		parseProfile(args.tileformat)
+	except ValueError as e:
+		parser.error(str(e))
 
 	if args.update:
 		checkUpdate(args.reverseupdatetest)
@@ -484,7 +530,7 @@ def auto(*args):
 
 	psutil.Process(os.getpid()).nice(psutil.ABOVE_NORMAL_PRIORITY_CLASS if os.name == 'nt' else 5)
 
-	workthread = None
+	pids = set()
 
 	workfolder = Path(args.basepath, foldername).resolve()
 	try:
@@ -506,7 +552,12 @@ def auto(*args):
 
 	changeModlist(args.mod_path, True)
 
-	manager = mp.Manager()
+	pool = WorkerPool(max(args.maxthreads, args.cropthreads or 0, args.refthreads or 0, args.zoomthreads or 0))
+	if args.metrics_file or args.metrics_port:
+		pool.metrics = Metrics(args.metrics_file, args.metrics_port)
+	if args.trace:
+		tracing.start("auto.py")
+	manager = pool.manager
 	rawTags = manager.dict()
 	rawTags["__used"] = False
 
@@ -525,6 +576,7 @@ def auto(*args):
 	###########################################
 
 	datapath = Path(workfolder, "latest.txt")
+	checkpoint = openCheckpoint(workfolder)
 
 	isFirstSnapshot = True
 
@@ -536,187 +588,340 @@ def auto(*args):
 		if args.night:
 			daytimes.append("night")
 
-		for index, savename in () if args.dry else enumerate(saveGames):
-			for daytimeIndex, setDaytime in enumerate(daytimes):
-
-				printErase("cleaning up")
-				if datapath.is_file():
-					datapath.unlink()
-
-				buildAutorun(args, workfolder, foldername, isFirstSnapshot, setDaytime)
-				isFirstSnapshot = False
-
-				with TemporaryDirectory(prefix="FactorioMaps-") as tmpDir:
-					configPath = buildConfig(args, tmpDir, args.basepath)
-
-					pid = None
-					isSteam = None
-					pidBlacklist = [p.info["pid"] for p in psutil.process_iter(attrs=['pid', 'name']) if p.info['name'] == "factorio.exe"]
-
-
-					launchArgs = [
-						'--load-game',
-						str(Path(userFolder, 'saves', savename).absolute()),
-						'--disable-audio',
-						'--config',
-						str(configPath),
-						"--mod-directory",str(args.mod_path.absolute()),
-						"--disable-migration-window"
-					]
-
-					usedSteamLaunchHack = False
+		cropthreads = min(args.cropthreads or args.maxthreads, pool.processes)
+		refthreads = min(args.refthreads or args.maxthreads, pool.processes)
+		zoomthreads = min(args.zoomthreads or args.maxthreads, pool.processes)
+		memoryBudget = args.memorybudget or psutil.virtual_memory().available // 2 // 2**20
+		scheduler = Scheduler(pool.processes, memoryBudget)
+
+		lastZoom = {}			# (outFolder, surface, daytime): zoom job of the newest snapshot, the next ref needs its tiles
+		lastRenderboxes = {}	# outFolder: renderbox job of the newest snapshot
+		dayRefs = {}			# (outFolder, timestamp, surface): ref job of the day screenshots, night reuses its results
+		mapInfoLock = threading.Lock()
+		scanned = [threading.Event() for _ in saveGames]	# set once a capture is done with latest.txt, autorun.lua and chunkCache.json
+
+
+		def resumable(key, stage, func, *args):
+			# skips steps an interrupted run already finished.
+			if checkpoint.isDone(key, stage):
+				return
+			func(*args)
+			checkpoint.markDone(key, stage)
+
+		def forgetScreenshot(screenshot):
+			# factorio takes the screenshots of an interrupted capture again, so everything done with the old ones is redone.
+			outFolder, timestamp, surface, daytime = list(map(lambda s: s.replace("|", " "), screenshot.split(" ")))
+			outFolder = outFolder.replace("/", " ")
+			rmtree(Path(args.basepath, outFolder, "Images", timestamp, surface, daytime), ignore_errors=True)
+			checkpoint.remove("units", unitKey(timestamp, surface, daytime))
+			checkpoint.remove("units", f"{timestamp}/{daytime}")
+			checkpoint.remove("renderboxes", timestamp)
+			with TileCatalog(Path(args.basepath, outFolder)) as catalog:
+				catalog.forget(surface, daytime)
+
+		def readCaptureInfo(captureInfoPath):
+			# factorio rewrites the file at the end of every surface and daytime, a half written one is read again.
+			while True:
+				try:
+					with captureInfoPath.open("r", encoding="utf-8") as f:
+						return json.load(f)
+				except ValueError:
+					time.sleep(0.1)
+
+		def mergeMapInfo(captureInfoPath, timestamp, remove=False):
+			# copies the map factorio wrote to its own mapInfo file into mapInfo.json. maps are added in the order the captures
+			# got to this point in, which is the order of the saves, the other maps of the file are older copies and left alone.
+			with mapInfoLock:
+				if not captureInfoPath.is_file():
+					return
+				captureInfo = readCaptureInfo(captureInfoPath)
+				mapInfoPath = Path(workfolder, "mapInfo.json")
+				if mapInfoPath.is_file():
+					with mapInfoPath.open("r", encoding="utf-8") as f:
+						mapInfo = json.load(f)
+				else:
+					mapInfo = {}
+				for key, value in captureInfo.items():
+					if key != "maps":
+						mapInfo.setdefault(key, value)
+				maps = mapInfo.setdefault("maps", [])
+				newMap = next(m for m in captureInfo["maps"] if m["path"] == timestamp)
+				paths = [m["path"] for m in maps]
+				if timestamp in paths:
+					maps[paths.index(timestamp)] = newMap
+				else:
+					maps.append(newMap)
+
+				# ref and zoom read mapInfo.json while this runs, so it is replaced at once instead of rewritten in place.
+				tmpPath = Path(workfolder, "mapInfo.json.tmp")
+				with tmpPath.open("w", encoding="utf-8") as f:
+					json.dump(mapInfo, f)
+				while True:
+					try:
+						os.replace(tmpPath, mapInfoPath)
+						break
+					except PermissionError:	# windows does not replace files that are open
+						time.sleep(0.1)
+				if remove:
+					captureInfoPath.unlink()
+
+		def waitForScan(captureInfoPath, timestamp, surfaces):
+			# factorio scans a surface and writes chunkCache.json before its first screenshot, the map lists the surface as
+			# captured right after.
+			with tracing.span("wait for scan", "wait"), FileWatcher(captureInfoPath) as watcher:
+				while True:
+					if captureInfoPath.is_file():
+						newMap = next((m for m in readCaptureInfo(captureInfoPath).get("maps", ()) if m["path"] == timestamp), None)
+						if newMap and all(newMap["surfaces"].get(surface, {}).get("captured") for surface in surfaces):
+							return
+					watcher.wait(SAFETYINTERVAL)
+
+		def processScreenshot(outFolder, timestamp, surface, daytime, number, total, captureInfoPath):
+			print(f"Processing {outFolder}/{'/'.join([timestamp, surface, daytime])} ({number} of {total})")
+			crop(outFolder, timestamp, surface, daytime, args.basepath, args, pool)
+			waitStart = time.perf_counter()
+			waitForFile(Path(args.basepath, outFolder, "Images", timestamp, surface, daytime, "done.txt"))
+			if pool.metrics:
+				pool.metrics.add(("crop", timestamp, surface, daytime), "factorioWaitSeconds", time.perf_counter() - waitStart)
+			# ref and the renderboxes need the daytimes and links factorio added to the map while taking these screenshots.
+			if captureInfoPath:
+				mergeMapInfo(captureInfoPath, timestamp)
+
+		def addScreenshotJobs(index, latest, firstOutFolder, captureInfoPath):
+			# crop can start right away, ref and zoom of a surface have to wait for the previous snapshot of that surface.
+			needsThumbnail = index + 1 == len(saveGames)
+			daytimeSurfaces = {}
+			zoomJobs = []
+			refJob = None
+			timestamp = None
+			for jindex, screenshot in enumerate(latest):
+				outFolder, timestamp, surface, daytime = list(map(lambda s: s.replace("|", " "), screenshot.split(" ")))
+				outFolder = outFolder.replace("/", " ")
+				name = f"{outFolder}/{'/'.join([timestamp, surface, daytime])}"
+
+				if daytime in daytimeSurfaces:
+					daytimeSurfaces[daytime].append(surface)
+				else:
+					daytimeSurfaces[daytime] = [surface]
+
+				if pool.metrics:
+					pool.metrics.nameSave(timestamp, saveGames[index])
+
+				unit = unitKey(timestamp, surface, daytime)
+				cropJob = scheduler.add(
+					"crop " + name,
+					partial(resumable, unit, "crop", processScreenshot, outFolder, timestamp, surface, daytime, len(latest) * index + jindex + 1, len(latest) * len(saveGames), captureInfoPath),
+					cpu=stageCpu(cropthreads),
+					memory=cropthreads * STAGEMEMORY,
+				)
+				refJob = scheduler.add(
+					"ref " + name,
+					partial(resumable, unit, "ref", ref, outFolder, timestamp, surface, daytime, args.basepath, args, pool),
+					after=(
+						cropJob,
+						refJob,
+						lastZoom.get((outFolder, surface, daytime)),
+						lastRenderboxes.get(outFolder),
+						dayRefs.get((outFolder, timestamp, surface)) if daytime != "day" else None,
+					),
+					cpu=stageCpu(refthreads),
+					memory=refthreads * STAGEMEMORY,
+					resources=("mapInfo.out " + outFolder,),
+				)
+				if daytime == "day":
+					dayRefs[(outFolder, timestamp, surface)] = refJob
+				zoomJob = scheduler.add(
+					"zoom " + name,
+					partial(zoom, outFolder, timestamp, surface, daytime, args.basepath, needsThumbnail, args, pool),
+					after=(refJob,),
+					cpu=stageCpu(zoomthreads),
+					memory=zoomthreads * max(args.zoommemory, STAGEMEMORY),
+				)
+				lastZoom[(outFolder, surface, daytime)] = zoomJob
+				zoomJobs.append(zoomJob)
+
+			def renderboxes():
+				print("zooming renderboxes", timestamp)
+				zoomRenderboxes(daytimeSurfaces, workfolder, timestamp, Path(args.basepath, firstOutFolder, "Images"), args, pool)
+
+			lastRenderboxes[outFolder] = scheduler.add(
+				"renderboxes " + timestamp,
+				partial(resumable, f"{timestamp}/{daytime}", "renderboxes", renderboxes),
+				after=zoomJobs,
+				cpu=stageCpu(zoomthreads),
+				memory=zoomthreads * STAGEMEMORY,
+				resources=("mapInfo.out " + outFolder,),
+			)
+
+
+		def capture(index, savename, isFirstSnapshot):
+			# one factorio session captures every surface at every daytime, their screenshots are processed as they come in.
+			# sessions of different saves run at the same time, but each one only starts once the one before it scanned all its
+			# surfaces: it needs the maps and chunk cache of that save, and its jobs have to come after those of that save.
+			if index:
+				scanned[index - 1].wait()
+
+			captureKey = f"{savename}/{'+'.join(daytimes)}"
+			captured = checkpoint.get("captures", captureKey)
+			if captured.get("done"):
+				printErase(f"resuming {savename}")
+				addScreenshotJobs(index, captured["latest"], captured["firstOutFolder"], None)
+				scanned[index].set()
+				return
+			for screenshot in captured.get("latest", ()):
+				forgetScreenshot(screenshot)
+
+			printErase("cleaning up")
+			if datapath.is_file():
+				datapath.unlink()
+			captureInfoPath = Path(workfolder, f"mapInfo.capture{index}.json")
+			if captureInfoPath.is_file():
+				captureInfoPath.unlink()
+
+			buildAutorun(args, workfolder, foldername, isFirstSnapshot, daytimes, captureInfoPath.name)
+
+			with TemporaryDirectory(prefix="FactorioMaps-") as tmpDir:
+				configPath = buildConfig(args, tmpDir, args.basepath)
+
+				pid = None
+				isSteam = None
+				pidBlacklist = [p.info["pid"] for p in psutil.process_iter(attrs=['pid', 'name']) if p.info['name'] == "factorio.exe"]
+
+				launchArgs = [
+					'--load-game',
+					str(Path(userFolder, 'saves', savename).absolute()),
+					'--disable-audio',
+					'--config',
+					str(configPath),
+					"--mod-directory",str(args.mod_path.absolute()),
+					"--disable-migration-window"
+				]
+
+				usedSteamLaunchHack = False
+
+				if os.name == "nt":
+					steamApiPath = Path(factorioPath, "..", "steam_api64.dll")
+				else:
+					steamApiPath = Path(factorioPath, "..", "steam_api64.so")
 
-					if os.name == "nt":
-						steamApiPath = Path(factorioPath, "..", "steam_api64.dll")
-					else:
-						steamApiPath = Path(factorioPath, "..", "steam_api64.so")
-
-					if steamApiPath.exists():	# chances are this is a steam install..
-						# try to find steam
-						try:
-							from winreg import OpenKey, HKEY_CURRENT_USER, ConnectRegistry, QueryValueEx, REG_SZ
-							
-							key = OpenKey(ConnectRegistry(None, HKEY_CURRENT_USER), r'Software\Valve\Steam')
-							val, valType = QueryValueEx(key, 'SteamExe')
-							if valType != REG_SZ:
-								raise FileNotFoundError( errno.ENOENT, os.strerror(errno.ENOENT), "SteamExe")
-							steamPath = Path(val)
-						except (ImportError, FileNotFoundError) as e:
-							# fallback to old method
-							if os.name == "nt":
-								steamPath = Path(factorioPath, "..", "..", "..", "..", "..", "..", "steam.exe")
-							else:
-								steamPath = Path(factorioPath, "..", "..", "..", "..", "..", "..", "steam")
+				if steamApiPath.exists():	# chances are this is a steam install..
+					# try to find steam
+					try:
+						from winreg import OpenKey, HKEY_CURRENT_USER, ConnectRegistry, QueryValueEx, REG_SZ
 						
-						if steamPath and steamPath.exists(): # found a steam executable
-							usedSteamLaunchHack = True
-							exeWithArgs = [
-								str(steamPath),
-								"-applaunch",
-								"427520"
-							] + launchArgs
-
-					if not usedSteamLaunchHack:	# if non steam factorio, or if steam factorio but steam executable isnt found.
+						key = OpenKey(ConnectRegistry(None, HKEY_CURRENT_USER), r'Software\Valve\Steam')
+						val, valType = QueryValueEx(key, 'SteamExe')
+						if valType != REG_SZ:
+							raise FileNotFoundError( errno.ENOENT, os.strerror(errno.ENOENT), "SteamExe")
+						steamPath = Path(val)
+					except (ImportError, FileNotFoundError) as e:
+						# fallback to old method
+						if os.name == "nt":
+							steamPath = Path(factorioPath, "..", "..", "..", "..", "..", "..", "steam.exe")
+						else:
+							steamPath = Path(factorioPath, "..", "..", "..", "..", "..", "..", "steam")
+					
+					if steamPath and steamPath.exists(): # found a steam executable
+						usedSteamLaunchHack = True
 						exeWithArgs = [
-							str(factorioPath)
+							str(steamPath),
+							"-applaunch",
+							"427520"
 						] + launchArgs
 
-					if args.verbose:
-						printErase(exeWithArgs)
-
-					condition = mp.Condition()
-					results = manager.list()
-
-					printErase("starting factorio")
-					startLogProcess = mp.Process(
-						target=startGameAndReadGameLogs,
-						args=(results, condition, exeWithArgs, usedSteamLaunchHack, tmpDir, pidBlacklist, rawTags, args)
-					)
-					startLogProcess.daemon = True
-					startLogProcess.start()
-
-					with condition:
-						condition.wait()
-					isSteam, pid = results[:]
-
-					if isSteam is None:
-						raise Exception("isSteam error")
-					if pid is None:
-						raise Exception("pid error")
-
-					while not datapath.exists():
-						time.sleep(0.4)
-
-					# empty autorun.lua
-					Path(__file__, "..", "autorun.lua").resolve().open('w', encoding="utf-8").close()
-
-					latest = []
-					with datapath.open('r', encoding="utf-8") as f:
-						for line in f:
-							latest.append(line.rstrip("\n"))
-					if args.verbose:
-						printErase(latest)
-
-					firstOutFolder, timestamp, surface, daytime = latest[-1].split(" ")
-					firstOutFolder = firstOutFolder.replace("/", " ")
-					waitfilename = Path(args.basepath, firstOutFolder, "images", timestamp, surface, daytime, "done.txt")
-
-					isKilled = [False]
-					def waitKill(isKilled, pid):
-						while not isKilled[0]:
-							#print(f"Can I kill yet? {os.path.isfile(waitfilename)} {waitfilename}")
-							if os.path.isfile(waitfilename):
-								isKilled[0] = True
-								kill(pid)
-								break
-							else:
-								time.sleep(0.4)
-
-					killThread = threading.Thread(target=waitKill, args=(isKilled, pid))
-					killThread.daemon = True
-					killThread.start()
-
-					if workthread and workthread.is_alive():
-						#print("waiting for workthread")
-						workthread.join()
-
-					timestamp = None
-					daytimeSurfaces = {}
-					for jindex, screenshot in enumerate(latest):
-						outFolder, timestamp, surface, daytime = list(map(lambda s: s.replace("|", " "), screenshot.split(" ")))
-						outFolder = outFolder.replace("/", " ")
-						print(f"Processing {outFolder}/{'/'.join([timestamp, surface, daytime])} ({len(latest) * index + jindex + 1 + daytimeIndex} of {len(latest) * len(saveGames) * len(daytimes)})")
-
-						if daytime in daytimeSurfaces:
-							daytimeSurfaces[daytime].append(surface)
-						else:
-							daytimeSurfaces[daytime] = [surface]
+				if not usedSteamLaunchHack:	# if non steam factorio, or if steam factorio but steam executable isnt found.
+					exeWithArgs = [
+						str(factorioPath)
+					] + launchArgs
+
+				if args.verbose:
+					printErase(exeWithArgs)
+
+				condition = mp.Condition()
+				results = manager.list()
+				traceEvents = manager.list() if tracing.enabled else None
+
+				printErase("starting factorio")
+				captureStart = time.perf_counter()
+				traceStart = tracing.now()
+				startLogProcess = mp.Process(
+					target=startGameAndReadGameLogs,
+					args=(results, condition, exeWithArgs, usedSteamLaunchHack, tmpDir, pidBlacklist, rawTags, args, traceEvents)
+				)
+				startLogProcess.daemon = True
+				startLogProcess.start()
+
+				with condition:
+					condition.wait()
+				isSteam, pid = results[:]
+
+				if isSteam is None:
+					raise Exception("isSteam error")
+				if pid is None:
+					raise Exception("pid error")
+				pids.add(pid)
 
-						#print("Cropping %s images" % screenshot)
-						crop(outFolder, timestamp, surface, daytime, args.basepath, args)
-						waitlocalfilename = os.path.join(args.basepath, outFolder, "Images", timestamp, surface, daytime, "done.txt")
-						if not os.path.exists(waitlocalfilename):
-							#print("waiting for done.txt")
-							while not os.path.exists(waitlocalfilename):
-								time.sleep(0.4)
+				waitForData(datapath)
 
+				# empty autorun.lua
+				Path(__file__, "..", "autorun.lua").resolve().open('w', encoding="utf-8").close()
 
+				latest = []
+				with datapath.open('r', encoding="utf-8") as f:
+					for line in f:
+						latest.append(line.rstrip("\n"))
+				if args.verbose:
+					printErase(latest)
 
-						def refZoom():
-							needsThumbnail = index + 1 == len(saveGames)
-							#print("Crossreferencing %s images" % screenshot)
-							ref(outFolder, timestamp, surface, daytime, args.basepath, args)
-							#print("downsampling %s images" % screenshot)
-							zoom(outFolder, timestamp, surface, daytime, args.basepath, needsThumbnail, args)
+				firstOutFolder, timestamp, surface, daytime = latest[-1].split(" ")
+				firstOutFolder = firstOutFolder.replace("/", " ")
 
-							if jindex == len(latest) - 1:
-								print("zooming renderboxes", timestamp)
-								zoomRenderboxes(daytimeSurfaces, workfolder, timestamp, Path(args.basepath, firstOutFolder, "Images"), args)
+				checkpoint.update("captures", captureKey, latest=latest, firstOutFolder=firstOutFolder, done=False)
+				addScreenshotJobs(index, latest, firstOutFolder, captureInfoPath)
 
-						if screenshot != latest[-1]:
-							refZoom()
-						else:
-							startLogProcess.terminate()
+				waitForScan(captureInfoPath, timestamp, {line.split(" ")[2].replace("|", " ") for line in latest})
+				mergeMapInfo(captureInfoPath, timestamp)
+				scanned[index].set()
 
-							# I have receieved a bug report from feidan in which he describes what seems like that this doesnt kill factorio?
+				# factorio takes the screenshots in the order of latest.txt.
+				waitForFile(Path(args.basepath, firstOutFolder, "Images", *(s.replace("|", " ") for s in (timestamp, surface, daytime)), "done.txt"))
+				startLogProcess.terminate()
 
-							onlyStall = isKilled[0]
-							isKilled[0] = True
-							kill(pid, onlyStall)
+				# I have receieved a bug report from feidan in which he describes what seems like that this doesnt kill factorio?
 
-							if savename == saveGames[-1] and daytimeIndex == len(daytimes) - 1:
-								refZoom()
+				kill(pid)
+				pids.discard(pid)
 
-							else:
-								workthread = threading.Thread(target=refZoom)
-								workthread.daemon = True
-								workthread.start()
+				tracing.complete("factorio", traceStart, "factorio", save=savename)
+				if traceEvents is not None:
+					tracing.events.extend(traceEvents)
+				if pool.metrics:
+					pool.metrics.add(("capture", timestamp.replace("|", " "), None, None), "factorioSeconds", time.perf_counter() - captureStart)
 
+			mergeMapInfo(captureInfoPath, timestamp, remove=True)
+			checkpoint.update("captures", captureKey, done=True)
 
 
+		captureJobs = []
+		for index, savename in () if args.dry else enumerate(saveGames):
+			# a capture only starts once the one --captures saves before it ended, so at most that many factorios run. it only
+			# waits for factorio and takes no worker, so it does not count against the cpu budget.
+			captureJobs.append(scheduler.add(
+				f"capture {savename}",
+				partial(capture, index, savename, isFirstSnapshot),
+				after=(captureJobs[index - args.captures] if index >= args.captures else None,),
+				cpu=0,
+			))
+			isFirstSnapshot = False
 
+		dedupBefore = dedupSavings(Path(workfolder, "Images"))
+		scheduler.run()
 
+		finishStart = tracing.now()
 
+		if args.dedup:
+			copies, size = dedupSavings(Path(workfolder, "Images"))
+			print(f"deduplication: {copies - dedupBefore[0]} tiles ({(size - dedupBefore[1]) / 2**20:.1f} MB) saved in this run, {copies} tiles ({size / 2**20:.1f} MB) in the whole timeline")
 
 
 
@@ -736,6 +941,8 @@ def auto(*args):
 				json.dump(data, destf)
 				destf.truncate()
 			os.remove(os.path.join(workfolder, "mapInfo.out.json"))
+			with TileCatalog(workfolder) as catalog:
+				catalog.sync(data["maps"])
 
 
 		modVersions = sorted(
@@ -834,10 +1041,32 @@ def auto(*args):
 		print("applying configuration")
 		with Path(workfolder, "mapInfo.json").open("r+", encoding='utf-8') as f:
 			mapInfo = json.load(f)
+			changed = False
 			if args.default_timestamp != None or "defaultTimestamp" not in mapInfo["options"]:
 				if args.default_timestamp == None:
 					args.default_timestamp = -1
 				mapInfo["options"]["defaultTimestamp"] = args.default_timestamp
+				changed = True
+			# the viewer asks for every zoom level in the format zoom wrote it in, and paints the single colour tiles itself.
+			for mapObj in mapInfo["maps"]:
+				for surfaceName, surface in mapObj["surfaces"].items():
+					tileFormats = None
+					uniform = {}
+					for daytime in ("day", "night"):
+						folder = Path(workfolder, "Images", str(mapObj["path"]), surfaceName, daytime)
+						formats = readFormats(folder)
+						if formats and tileFormats is None:
+							tileFormats = {str(z): ENCODERS[name][0] for z, (name, quality) in formats.items()}
+						daytimeTiles = uniformTiles(folder)
+						if daytimeTiles:
+							uniform[daytime] = daytimeTiles
+					if tileFormats and surface.get("tileFormats") != tileFormats:
+						surface["tileFormats"] = tileFormats
+						changed = True
+					if surface.get("uniformTiles", {}) != uniform:
+						surface["uniformTiles"] = uniform
+						changed = True
+			if changed:
 				f.seek(0)
 				json.dump(mapInfo, f)
 				f.truncate()
@@ -860,19 +1089,38 @@ def auto(*args):
 			pass
 		copytree(Path(__file__, "..", "web", "lib").resolve(), os.path.join(workfolder, "lib"))
 
+		tracing.complete("finish", finishStart)
+		checkpoint.delete()
+
 
 
 	except KeyboardInterrupt:
 		print("keyboardinterrupt")
-		kill(pid)
+		for pid in list(pids):
+			kill(pid)
+		pool.terminate()
 		raise
 
+	except:
+		pool.terminate()
+		raise
+
+	else:
+		pool.close()
+
 	finally:
 
-		try:
-			kill(pid)
-		except:
-			pass
+		for pid in list(pids):
+			try:
+				kill(pid)
+			except:
+				pass
+
+		closeConnections()
+		if pool.metrics:
+			pool.metrics.close()
+		if args.trace:
+			tracing.write(args.trace)
 
 		changeModlist(args.mod_path, False)
 
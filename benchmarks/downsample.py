@@ -0,0 +1,81 @@
+# compares the zoom.py downsampling backends on random tiles.
+# run from the FactorioMaps folder: python -m benchmarks.downsample [--size 512] [--count 64]
+
+import argparse
+import time
+
+import numpy
+from PIL import Image
+
+import zoom
+
+COORDS = [(0, 0), (1, 0), (0, 1), (1, 1)]
+
+
+def randomTiles(count, size, seed=0):
+	rng = numpy.random.default_rng(seed)
+	tiles = []
+	for _ in range(count):
+		base = rng.integers(0, 256, (size // 16, size // 16, 3), dtype=numpy.uint8)
+		tiles.append(Image.fromarray(base).resize((size, size), Image.BILINEAR))
+	return tiles
+
+
+def combine(tiles, size):
+	results = []
+	for i in range(0, len(tiles) - 3, 4):
+		canvas = zoom.parentCanvas(size)
+		for coord, img in zip(COORDS, tiles[i:i+4]):
+			zoom.pasteChild(canvas, coord, img, size)
+		results.append(zoom.finishParent(canvas, size))
+	return results
+
+
+def halveAll(tiles):
+	return [zoom.halve(img) for img in tiles]
+
+
+def timeit(function, repeat):
+	best = float("inf")
+	for _ in range(repeat):
+		start = time.perf_counter()
+		result = function()
+		best = min(best, time.perf_counter() - start)
+	return best, result
+
+
+def benchmark(downsamplers, size, count, repeat):
+	tiles = randomTiles(count, size)
+	results = {}
+	reference = None
+	for downsampler in downsamplers:
+		zoom.DOWNSAMPLER = downsampler
+		combineTime, parents = timeit(lambda: combine(tiles, size), repeat)
+		halveTime, _ = timeit(lambda: halveAll(tiles), repeat)
+		if reference is None:
+			reference = parents
+		diff = max(int(numpy.abs(numpy.asarray(a, dtype=numpy.int16) - numpy.asarray(b, dtype=numpy.int16)).max()) for a, b in zip(parents, reference))
+		results[downsampler] = {
+			"parentsPerSecond": len(parents) / combineTime,
+			"halvesPerSecond": len(tiles) / halveTime,
+			"maxDiff": diff,
+		}
+	return results
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark the zoom.py downsampling backends.")
+	parser.add_argument("--size", type=int, default=512, help="Tile size in pixels.")
+	parser.add_argument("--count", type=int, default=64, help="Number of random tiles to downsample.")
+	parser.add_argument("--repeat", type=int, default=3, help="Number of repetitions, the fastest one is reported.")
+	parser.add_argument("downsamplers", nargs="*", default=["antialias", "box", "bilinear"], help="Backends to compare, the first one is the reference for maxDiff.")
+	args = parser.parse_args()
+
+	results = benchmark(args.downsamplers, args.size, args.count, args.repeat)
+	print(f"{'downsampler':<12} {'parents/s':>10} {'halves/s':>10} {'maxDiff':>8}")
+	for downsampler, result in results.items():
+		print(f"{downsampler:<12} {result['parentsPerSecond']:>10.1f} {result['halvesPerSecond']:>10.1f} {result['maxDiff']:>8}")
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,157 @@
+# runs auto.py from start to end with benchmarks/fakefactorio.py instead of the game, in a throwaway factorio user
+# folder with fake saves, and reports the wall time of the whole run and of every step as json.
+# run from the FactorioMaps folder: python -m benchmarks.endtoend [--saves 3] [--tiles 12] [--rate 0] [--output result.json]
+# [--baseline old.json] [-- auto.py flags like --captures 2 --screenshotformat bmp]
+
+import argparse
+import json
+import os
+import platform
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from shutil import copytree, ignore_patterns
+
+from benchmarks.fakefactorio import writeSave
+from updateLib import CURRENTVERSION
+
+ROOT = Path(__file__, "..", "..").resolve()
+MODNAME = "L0laapk3_FactorioMaps"
+OUTFOLDER = "bench"
+
+
+def makeUserFolder(folder, config):
+	# the layout auto.py expects around itself: mods, saves, config, player-data.json and a factorio executable.
+	mod = Path(folder, "mods", MODNAME)
+	copytree(ROOT, mod, ignore=ignore_patterns(".git", "__pycache__", "requests.jsonl"))
+	# the web libraries would be downloaded otherwise.
+	Path(mod, "web", "lib").mkdir(parents=True, exist_ok=True)
+	Path(mod, "web", "lib", "VERSION").write_text(str(CURRENTVERSION))
+	Path(mod, "autorun.lua").write_text("")
+	with Path(folder, "mods", "mod-list.json").open("w", encoding="utf-8") as f:
+		json.dump({"mods": [{"name": "base", "enabled": True}]}, f)
+	Path(folder, "config").mkdir()
+	Path(folder, "player-data.json").write_text("{}")
+
+	Path(folder, "saves").mkdir()
+	for index in range(config["saves"]):
+		writeSave(
+			Path(folder, "saves", f"{OUTFOLDER}{index + 1}.zip"),
+			tick=(index + 1) * config["hours"] * 60 * 60 * 60,
+			index=index,
+			seed=config["seed"],
+			surfaces=[f"surface{i}" if i else "nauvis" for i in range(config["surfaces"])],
+			tiles=config["tiles"],
+			size=config["size"],
+			change=config["change"],
+			crop=config["crop"],
+			rate=config["rate"],
+			loadSeconds=config["load"],
+			replay=config["replay"],
+		)
+
+	# started through a script so the fake runs with this python.
+	executable = Path(folder, "bin", "x64", "factorio")
+	executable.parent.mkdir(parents=True)
+	executable.write_text(f'#!/bin/sh\nexec "{sys.executable}" "{Path(mod, "benchmarks", "fakefactorio.py")}" "$@"\n')
+	executable.chmod(executable.stat().st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+	return mod, executable
+
+
+def steps(metricsPath):
+	# wall time per step summed over snapshots, surfaces and daytimes, and the time factorio ran.
+	with metricsPath.open("r", encoding="utf-8") as f:
+		metrics = json.load(f)
+	result = {}
+	for unit in metrics["units"]:
+		result[unit["step"]] = result.get(unit["step"], 0.0) + unit["wallSeconds"]
+		if "factorioSeconds" in unit["counters"]:
+			result["factorio"] = result.get("factorio", 0.0) + unit["counters"]["factorioSeconds"]
+	return result
+
+
+def benchmark(config, folder, autoArgs, verbose):
+	mod, executable = makeUserFolder(folder, config)
+	metricsPath = Path(folder, "metrics.json")
+	surfaceArgs = [arg for i in range(config["surfaces"]) for arg in ("--surface", f"surface{i}" if i else "nauvis")] if config["surfaces"] > 1 else []
+	command = [sys.executable, str(Path(mod, "auto.py")), "--factorio", str(executable), "--no-update", "--metrics-file", str(metricsPath)] + surfaceArgs + autoArgs + [OUTFOLDER, f"{OUTFOLDER}*"]
+	if verbose:
+		print(" ".join(command))
+
+	start = time.perf_counter()
+	result = subprocess.run(command, cwd=mod, stdout=None if verbose else subprocess.DEVNULL, stderr=None if verbose else subprocess.PIPE)
+	seconds = time.perf_counter() - start
+	if result.returncode:
+		sys.stderr.write(result.stderr.decode("utf-8", "replace") if result.stderr else "")
+		raise Exception(f"auto.py exited with {result.returncode}")
+
+	imageFolder = Path(folder, "script-output", "FactorioMaps", OUTFOLDER, "Images")
+	tiles = sum(len(files) for _, _, files in os.walk(imageFolder))
+	return {"seconds": seconds, "tiles": tiles, "tilesPerSecond": tiles / seconds, "steps": steps(metricsPath)}
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark a whole auto.py run against a fake factorio.", epilog="Arguments after -- are passed on to auto.py.")
+	parser.add_argument("--saves", type=int, default=3, help="Number of saves, every one becomes a snapshot of the timeline.")
+	parser.add_argument("--surfaces", type=int, default=1, help="Number of surfaces in every save.")
+	parser.add_argument("--tiles", type=int, default=12, help="Diameter of the map in max zoom tiles.")
+	parser.add_argument("--change", type=float, default=0.25, help="Fraction of tiles that change between snapshots.")
+	parser.add_argument("--crop", type=float, default=0.05, help="Fraction of screenshots that need cropping.")
+	parser.add_argument("--size", type=int, default=512, help="Tile size in pixels.")
+	parser.add_argument("--rate", type=float, default=0, help="Screenshots per second the fake factorio writes, 0 for as fast as it can.")
+	parser.add_argument("--load", type=float, default=0, help="Seconds the fake factorio takes to load a save.")
+	parser.add_argument("--hours", type=int, default=10, help="In game hours between the saves.")
+	parser.add_argument("--replay", type=lambda p: Path(p).resolve(), default=None, help="Replay the screenshots of this recorded snapshot folder (Images/<snapshot> of an output folder whose screenshots were not cropped yet, python -m benchmarks.synthetic writes one) in every save instead of synthetic ones.")
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--folder", type=Path, default=None, help="Where to build the factorio user folder, a temporary folder by default. Has to be empty.")
+	parser.add_argument("--output", type=Path, default=None, help="Write the report to this json file.")
+	parser.add_argument("--baseline", type=Path, default=None, help="Compare against a report written by an earlier run.")
+	parser.add_argument("--tolerance", type=float, default=0.1, help="Exit with an error if the run is this much slower than the baseline.")
+	parser.add_argument("--verbose", action="store_true", help="Show the output of auto.py.")
+	args, autoArgs = parser.parse_known_args()
+	autoArgs = [arg for arg in autoArgs if arg != "--"]
+
+	if os.name == "nt":
+		raise Exception("The fake factorio is started through a shell script, which only works on linux and macos.")
+
+	config = {key: getattr(args, key) for key in ("saves", "surfaces", "tiles", "change", "crop", "size", "rate", "load", "hours", "seed")}
+	config["replay"] = str(args.replay) if args.replay else None
+	config["auto"] = autoArgs
+	if args.folder:
+		args.folder.mkdir(parents=True, exist_ok=True)
+		results = benchmark(config, args.folder.resolve(), autoArgs, args.verbose)
+	else:
+		with tempfile.TemporaryDirectory() as folder:
+			results = benchmark(config, Path(folder), autoArgs, args.verbose)
+
+	report = {
+		"config": config,
+		"machine": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+		"result": results,
+	}
+	if args.output:
+		with args.output.open("w", encoding="utf-8") as f:
+			json.dump(report, f, indent=2)
+
+	print(f"{results['seconds']:.2f}s for {config['saves']} saves, {results['tiles']} files, {results['tilesPerSecond']:.1f} files/s")
+	print(f"{'step':<12} {'seconds':>9}")
+	for name, seconds in sorted(results["steps"].items()):
+		print(f"{name:<12} {seconds:>9.2f}")
+
+	if args.baseline:
+		with args.baseline.open("r", encoding="utf-8") as f:
+			baseline = json.load(f)
+		if baseline.get("config") != config:
+			print("WARNING: the baseline was run with different settings:", baseline.get("config"))
+		ratio = results["seconds"] / baseline["result"]["seconds"] - 1
+		print(f"{ratio * 100:+.1f}% against the baseline")
+		if ratio > args.tolerance:
+			print("slower than the baseline")
+			sys.exit(1)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+# stands in for the factorio executable so auto.py can run from start to end without the game: pass it with --factorio.
+# it takes the command line auto.py starts factorio with, prints the version banner and the log lines auto.py reads, and
+# then does what the mod does in game: latest.txt, and for every surface and daytime crop.txt, chunkCache.json, the
+# mapInfo file, the screenshots and done.txt. the screenshots are synthetic or replayed from a recorded snapshot, at the
+# rate the save asks for. afterwards it waits to be killed, like the game.
+# the saves are zip files with a fakefactorio.json in them, see writeSave. benchmarks.endtoend sets all of this up.
+
+import argparse
+import configparser
+import datetime
+import json
+import math
+import re
+import shutil
+import sys
+import time
+import zipfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))	# started as a program, not with python -m
+
+import numpy
+from PIL import Image
+
+from benchmarks.synthetic import CROPFLAGS, addBuilding, saveScreenshot, tileCoords, tileImage
+
+
+VERSION = "1.1.0"
+BUILD = 57957
+SAVEFILE = "fakefactorio.json"
+TICKSPERHOUR = 60 * 60 * 60
+NIGHTBRIGHTNESS = 0.35
+SAVEDEFAULTS = {
+	"tick": TICKSPERHOUR,
+	"index": 0,			# snapshot number in the timeline, the synthetic tiles change with it
+	"seed": 0,
+	"surfaces": ["nauvis"],
+	"tiles": 12,		# diameter of the map in max zoom tiles
+	"size": 512,
+	"change": 0.25,		# fraction of tiles that change from one snapshot to the next
+	"crop": 0.05,		# fraction of screenshots that need cropping
+	"rate": 0,			# screenshots per second, 0 writes them as fast as possible
+	"loadSeconds": 0,	# time it takes to load the save
+	"replay": None,		# folder with <surface>/<daytime>/crop.txt and the screenshots below it, like Images/<snapshot>
+}
+
+
+def writeSave(path, **settings):
+	save = dict(SAVEDEFAULTS, **settings)
+	with zipfile.ZipFile(path, "w") as f:
+		f.writestr(SAVEFILE, json.dumps(save))
+
+
+def readSave(path):
+	path = Path(path)
+	if not path.is_file():
+		path = path.with_name(path.name + ".zip")
+	with zipfile.ZipFile(path, "r") as f:
+		return dict(SAVEDEFAULTS, **json.loads(f.read(SAVEFILE)))
+
+
+class Log:
+	# factorio prints its log to stdout and to factorio-current.log in the write data folder.
+
+	def __init__(self, folder):
+		self.start = time.perf_counter()
+		self.file = Path(folder, "factorio-current.log").open("w", encoding="utf-8")
+
+	def __call__(self, line):
+		line = f"{time.perf_counter() - self.start:8.3f} {line}"
+		print(line, flush=True)
+		self.file.write(line + "\n")
+		self.file.flush()
+
+	def script(self, line):
+		self(f"Script @__L0laapk3_FactorioMaps__/control.lua:1: {line}")
+
+
+def readAutorun(modFolder):
+	# only the simple values of autorun.lua, mapInfo and chunkCache are read from the json files auto.py built them from.
+	for folder in sorted(Path(modFolder).glob("L0laapk3_FactorioMaps*")):
+		path = Path(folder, "autorun.lua")
+		if path.is_file():
+			text = path.read_text(encoding="utf-8")
+			break
+	else:
+		return None
+	if not text.strip():
+		return None
+
+	autorun = {}
+	for key, value in re.findall(r"^\s*(\w+) = (.*?),?$", text, re.MULTILINE):
+		if key in autorun or key in ("mapInfo", "chunkCache", "connect_types"):
+			continue
+		if value.startswith("{"):
+			autorun[key] = re.findall(r'"([^"]*)"', value)
+		elif value.startswith('"'):
+			autorun[key] = value[1:-1]
+		elif value in ("true", "false"):
+			autorun[key] = value == "true"
+		elif value == "nil":
+			autorun[key] = None
+		else:
+			autorun[key] = float(value) if "." in value else int(value)
+	return autorun
+
+
+def readJson(path, default):
+	if not path.is_file():
+		return default
+	with path.open("r", encoding="utf-8") as f:
+		return json.load(f)
+
+
+def writeJson(path, data, indent=None):
+	with path.open("w", encoding="utf-8") as f:
+		json.dump(data, f, indent=indent)
+
+
+def seedFor(save, surface, *parts):
+	# numpy seeds have to be positive.
+	return [save["seed"], save["surfaces"].index(surface)] + [part + 2**20 for part in parts]
+
+
+class Synthetic:
+	# the same map as benchmarks.synthetic, worked out from the save alone: a tile looks the same in every snapshot until it changes.
+
+	def __init__(self, save, surface, daytime):
+		self.save = save
+		self.surface = surface
+		self.daytime = daytime
+		self.coords = tileCoords(save["tiles"], numpy.random.default_rng(seedFor(save, surface)))
+
+	def image(self, x, y):
+		version = sum(numpy.random.default_rng(seedFor(self.save, self.surface, x, y, index)).random() < self.save["change"] for index in range(1, self.save["index"] + 1))
+		rng = numpy.random.default_rng(seedFor(self.save, self.surface, x, y, -1 - version))
+		array = tileImage(rng, self.save["size"])
+		if version:
+			addBuilding(array, rng)
+		if self.daytime != "day":
+			array = (array * NIGHTBRIGHTNESS).astype(numpy.uint8)
+		return Image.fromarray(array)
+
+	def screenshots(self, ext, quality):
+		# (x, y, crop line without its path, write(path)) of every screenshot, screenshots that need no cropping have a width of 0.
+		size = self.save["size"]
+		rng = numpy.random.default_rng(seedFor(self.save, self.surface, self.save["index"], -1))
+		for x, y in self.coords:
+			if rng.random() < self.save["crop"]:
+				xOffset, yOffset, xExtra, yExtra = (int(v) for v in rng.integers(1, 32, 4))
+				flags = CROPFLAGS[rng.integers(len(CROPFLAGS))]
+				def write(path, x=x, y=y, xOffset=xOffset, yOffset=yOffset, xExtra=xExtra, yExtra=yExtra):
+					padded = Image.new("RGB", (size + xOffset + xExtra, size + yOffset + yExtra), (0, 0, 0))
+					padded.paste(self.image(x, y), (xOffset, yOffset))
+					saveScreenshot(padded, path, quality)
+				yield x, y, f"{xOffset} {yOffset} {size} {size} {flags:x}", write
+			else:
+				yield x, y, "0 0 0 0 0", lambda path, x=x, y=y: saveScreenshot(self.image(x, y), path, quality)
+
+
+class Replay:
+	# screenshots and crop.txt of a snapshot that was recorded before crop.py got to it.
+
+	def __init__(self, save, surface, daytime):
+		self.folder = Path(save["replay"], surface, daytime)
+		with Path(self.folder, "crop.txt").open("r", encoding="utf-8") as f:
+			lines = f.read().splitlines()[1:]
+		# crop.txt paths start with the snapshot, surface and daytime they were recorded as.
+		self.crops = {"/".join(line.split(" ", 5)[5].split("/")[3:]): " ".join(line.split(" ", 5)[:5]) for line in lines if line.count(" ") >= 5}
+		self.files = sorted(path for path in self.folder.glob("*/*/*") if path.is_file())
+
+	def screenshots(self, ext, quality):
+		for path in self.files:
+			relative = path.relative_to(self.folder).as_posix()
+			def write(dest, path=path):
+				if path.suffix == dest.suffix:
+					shutil.copyfile(path, dest)
+				else:
+					with Image.open(path) as img:
+						saveScreenshot(img.convert("RGB"), dest, quality)
+			yield int(path.parent.name), int(path.stem), self.crops.get(relative, "0 0 0 0 0"), write
+
+
+def capture(save, autorun, scriptOutput, log):
+	log.script("Start world capture")
+	topFolder = Path(scriptOutput, autorun["name"])
+	topFolder.mkdir(parents=True, exist_ok=True)
+	mapInfoPath = Path(topFolder, autorun.get("mapinfo_file") or "mapInfo.json")
+	mapInfo = readJson(Path(topFolder, "mapInfo.json"), {})
+	chunkCachePath = Path(topFolder, "chunkCache.json")
+	chunkCache = readJson(chunkCachePath, {})
+	tick = save["tick"]
+	maxZoom = 21 if autorun["HD"] else 20
+
+	if "options" not in mapInfo:
+		mapInfo["options"] = {
+			"ranges": {"build": autorun["around_build_range"], "connect": autorun["around_connect_range"], "tag": autorun["around_tag_range"]},
+			"HD": autorun["HD"],
+		}
+		mapInfo["seed"] = save["seed"]
+		mapInfo["mapExchangeString"] = ">>>fakefactorio<<<"
+		mapInfo["maps"] = []
+
+	hour = math.ceil(tick / TICKSPERHOUR)
+	filePath = str(hour)
+	i = 1
+	while any(m["path"] == filePath and m["tick"] != tick for m in mapInfo["maps"]):
+		filePath = f"{hour}-{i}"
+		i += 1
+
+	surfaces = autorun.get("surfaces")
+	if not surfaces:
+		mapInfo.setdefault("defaultSurface", save["surfaces"][0])
+		surfaces = [mapInfo["defaultSurface"]]
+	for surface in surfaces:
+		if surface not in save["surfaces"]:
+			log(f"ERROR: surface \"{surface}\" not found.")
+			raise Exception(f"surface \"{surface}\" not found.")
+
+	captures = [(surface, daytime) for surface in surfaces for daytime in autorun["daytimes"]]
+	outFolder = autorun["name"][:-1].replace(" ", "/")
+	with Path(topFolder, "latest.txt").open("w", encoding="utf-8") as f:
+		f.writelines(f"{outFolder} {filePath} {surface.replace(' ', '|')} {daytime}\n" for surface, daytime in captures)
+
+	mapObj = next((m for m in mapInfo["maps"] if m["tick"] == tick), None)
+	if mapObj is None:
+		mapObj = {"tick": tick, "path": filePath, "date": autorun["date"], "mods": {"base": VERSION}, "surfaces": {}}
+		mapInfo["maps"].append(mapObj)
+
+	ext = autorun.get("screenshot_extension") or ".png"
+	quality = autorun.get("jpeg_quality")
+	interval = 1 / save["rate"] if save["rate"] else 0
+	for surface, daytime in captures:
+		subPath = Path(topFolder, "Images", filePath, surface, daytime)
+		shutil.rmtree(subPath, ignore_errors=True)
+		subPath.mkdir(parents=True)
+		source = Replay(save, surface, daytime) if save["replay"] else Synthetic(save, surface, daytime)
+		screenshots = list(source.screenshots(ext, quality))
+
+		if not mapObj["surfaces"].get(surface, {}).get("captured"):
+			xs = [0] + [x for x, _, _, _ in screenshots]
+			ys = [0] + [y for _, y, _, _ in screenshots]
+			minZoom = maxZoom - max(2, math.ceil(min(math.log2(max(1, max(xs) - min(xs))), math.log2(max(1, max(ys) - min(ys)))) + 0.01 - 1))
+			mapObj["surfaces"][surface] = {
+				"spawn": {"x": 0, "y": 0},
+				"zoom": {"min": minZoom, "max": maxZoom},
+				"tags": [],
+				"hidden": False,
+				"captured": True,
+				"links": [],
+			}
+			chunkCache.setdefault(str(tick), {})[surface] = " ".join(f"{x} {y}" for x, y, _, _ in screenshots)
+			writeJson(chunkCachePath, chunkCache, indent=4)
+		mapObj["surfaces"][surface][daytime] = True
+
+		log.script(f"[info]Surface capture {autorun['name']}{filePath}/{surface}/{daytime}")
+
+		# the mod queues every screenshot and writes crop.txt and the mapInfo file in one tick, the game saves the screenshots after that.
+		writeJson(mapInfoPath, mapInfo)
+		with Path(subPath, "crop.txt").open("w", encoding="utf-8") as f:
+			f.write("v2" + "".join(f"\n{crop} {filePath}/{surface}/{daytime}/{maxZoom}/{x}/{y}{ext}" for x, y, crop, _ in screenshots if crop.split(" ")[2] != "0"))
+
+		started = time.perf_counter()
+		for i, (x, y, _, write) in enumerate(screenshots):
+			path = Path(subPath, str(maxZoom), str(x), f"{y}{ext}")
+			path.parent.mkdir(parents=True, exist_ok=True)
+			write(path)
+			wait = started + (i + 1) * interval - time.perf_counter()
+			if wait > 0:
+				time.sleep(wait)
+
+		Path(subPath, "done.txt").touch()
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Stand-in for the factorio executable, takes the arguments auto.py starts factorio with.")
+	parser.add_argument("--load-game", type=Path, required=True)
+	parser.add_argument("--config", type=Path, required=True)
+	parser.add_argument("--mod-directory", type=Path, required=True)
+	args, _ = parser.parse_known_args()
+
+	config = configparser.ConfigParser()
+	config.read(args.config)
+	writeData = Path(config["path"]["write-data"])
+	scriptOutput = Path(config["path"]["script-output"])
+
+	log = Log(writeData)
+	log(f"{datetime.datetime.now():%Y-%m-%d %H:%M:%S}; Factorio {VERSION} (build {BUILD}, fakefactorio, {sys.platform})")
+	log(f"Loading map {args.load_game}")
+	save = readSave(args.load_game)
+	time.sleep(save["loadSeconds"])
+	log("Loading map: done")
+
+	autorun = readAutorun(args.mod_directory)
+	if autorun is not None:
+		capture(save, autorun, scriptOutput, log)
+		log.script("[info]FactorioMaps is now finished capturing your game")
+
+	while True:
+		time.sleep(1)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,102 @@
+# runs the same synthetic snapshots through crop, ref and zoom once with png and once with jpeg screenshots, and reports
+# how far the finished tiles of the jpeg run drift from those of the png run per zoom level.
+# run from the FactorioMaps folder: python -m benchmarks.jpegdrift [--tiles 8] [--snapshots 2] [--minpsnr 30]
+
+import argparse
+import math
+import os
+import sys
+import tempfile
+import time
+from argparse import Namespace
+from pathlib import Path
+
+import numpy
+
+import tilestore
+from benchmarks.synthetic import DAYTIME, MAXZOOM, MINZOOM, SURFACE, addSnapshot, tileCoords
+from crop import crop
+from encoders import parseProfile
+from rawimage import jpegQuality, screenshotExt
+from ref import ref
+from workerpool import WorkerPool
+from zoom import zoom
+
+
+def run(config, folder, screenshotformat):
+	args = Namespace(maxthreads=config["threads"], cropthreads=None, refthreads=None, zoomthreads=None, verbose=0, zoommemory=256, downsampler="antialias", refmode="signature", tilestore="files", tileformat=config["tileformat"], dedup=False, screenshotformat=screenshotformat)
+	rng = numpy.random.default_rng(config["seed"])
+	coords = tileCoords(config["tiles"], rng)
+	images = {}
+	top = Path(folder, screenshotformat)
+	snapshots = []
+	start = time.perf_counter()
+	with WorkerPool(config["threads"]) as pool, open(os.devnull, "w") as devnull:
+		for index in range(config["snapshots"]):
+			snapshot = addSnapshot(top, index, coords, images, rng, config["change"], config["crop"], config["size"], ext=screenshotExt(args), quality=jpegQuality(parseProfile(args.tileformat)))
+			stdout, sys.stdout = sys.stdout, devnull
+			try:
+				crop(screenshotformat, snapshot, SURFACE, DAYTIME, folder, args, pool)
+				ref(screenshotformat, snapshot, SURFACE, DAYTIME, folder, args, pool)
+				zoom(screenshotformat, snapshot, SURFACE, DAYTIME, folder, True, args, pool)
+			finally:
+				sys.stdout = stdout
+			snapshots.append(snapshot)
+	seconds = time.perf_counter() - start
+
+	tiles = {}
+	for snapshot in snapshots:
+		for z, x, y, path in tilestore.listTiles(Path(top, "Images", snapshot, SURFACE, DAYTIME)):
+			tiles[(snapshot, z, x, y)] = path
+	return seconds, tiles
+
+
+def psnr(a, b):
+	error = numpy.square(a.astype(numpy.float32) - b).mean()
+	return math.inf if error == 0 else 10 * math.log10(255**2 / error)
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Measure the quality drift of jpeg screenshots against png screenshots.")
+	parser.add_argument("--tiles", type=int, default=8, help="Diameter of the map in max zoom tiles.")
+	parser.add_argument("--snapshots", type=int, default=2, help="Number of snapshots.")
+	parser.add_argument("--change", type=float, default=0.25, help="Fraction of tiles that change between snapshots.")
+	parser.add_argument("--crop", type=float, default=0.05, help="Fraction of screenshots that need cropping. The synthetic crops are not aligned to the jpeg blocks, so these are decoded and encoded again.")
+	parser.add_argument("--size", type=int, default=512, help="Tile size in pixels.")
+	parser.add_argument("--threads", type=int, default=os.cpu_count(), help="Worker processes.")
+	parser.add_argument("--tileformat", default="jpg", help="Same as the auto.py flag. The screenshots are only kept as tiles when the max zoom level is jpg.")
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--minpsnr", type=float, default=30, help="Exit with an error if the average PSNR of a zoom level is lower than this.")
+	args = parser.parse_args()
+
+	config = {key: getattr(args, key) for key in ("tiles", "snapshots", "change", "crop", "size", "threads", "tileformat", "seed")}
+	with tempfile.TemporaryDirectory() as folder:
+		pngSeconds, pngTiles = run(config, folder, "png")
+		jpegSeconds, jpegTiles = run(config, folder, "jpeg")
+
+		levels = {}
+		for key, path in pngTiles.items():
+			if key in jpegTiles:
+				a = numpy.asarray(tilestore.openImage(path).convert("RGB"))
+				b = numpy.asarray(tilestore.openImage(jpegTiles[key]).convert("RGB"))
+				levels.setdefault(key[1], []).append((psnr(a, b), int(numpy.abs(a.astype(numpy.int16) - b).max())))
+
+	print(f"png screenshots {pngSeconds:.2f}s, jpeg screenshots {jpegSeconds:.2f}s")
+	print(f"{len(set(pngTiles) ^ set(jpegTiles))} of {len(pngTiles)} tiles were only kept in one of the runs")
+	print(f"{'zoom':<6} {'tiles':>6} {'mean dB':>8} {'min dB':>8} {'max err':>8}")
+	worse = []
+	for z in range(MAXZOOM, MINZOOM - 1, -1):
+		if z not in levels:
+			continue
+		finite = [value for value, _ in levels[z] if value != math.inf] or [math.inf]
+		mean = sum(finite) / len(finite)
+		print(f"{z:<6} {len(levels[z]):>6} {mean:>8.2f} {min(finite):>8.2f} {max(error for _, error in levels[z]):>8}")
+		if mean < args.minpsnr:
+			worse.append(str(z))
+	if worse:
+		print("below the minimum psnr:", ", ".join(worse))
+		sys.exit(1)
+
+
+if __name__ == "__main__":
+	main()
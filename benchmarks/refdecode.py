@@ -0,0 +1,91 @@
+# checks that the scaled jpeg and the signature comparisons in ref.py keep and delete the same sample tiles as the exact one, and times them.
+# run from the FactorioMaps folder: python -m benchmarks.refdecode [--size 512] [--count 32] [--screenshotformat png]
+
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy
+from PIL import Image
+
+import ref
+import zoom
+from benchmarks.downsample import randomTiles
+from rawimage import PNGEXT, SCREENSHOTEXTS
+from signature import appendSignatures, readIndex, signature
+
+
+def changed(img, rng, kind):
+	array = numpy.array(img)
+	size = array.shape[0]
+	if kind == "same":
+		pass
+	elif kind == "noise":
+		array = numpy.clip(array.astype(numpy.int16) + rng.integers(-3, 4, array.shape), 0, 255).astype(numpy.uint8)
+	elif kind == "entity":
+		x, y = rng.integers(0, size - 32, 2)
+		array[y:y+32, x:x+32] = rng.integers(0, 256, 3)
+	elif kind == "building":
+		x, y = rng.integers(0, size // 2, 2)
+		array[y:y+size//4, x:x+size//4] = rng.integers(0, 256, 3)
+	elif kind == "tint":
+		array = numpy.clip(array.astype(numpy.int16) + 12, 0, 255).astype(numpy.uint8)
+	return Image.fromarray(array)
+
+
+def samplePairs(folder, size, count, seed=0, screenshotExt=PNGEXT):
+	rng = numpy.random.default_rng(seed)
+	pairs = []
+	signatures = []
+	for i, img in enumerate(randomTiles(count, size, seed)):
+		signatures.append((str(i), signature(img)))
+		for kind in ("same", "noise", "entity", "building", "tint"):
+			newPath = Path(folder, f"{i}_{kind}{screenshotExt}")
+			oldPath = Path(folder, f"{i}_{kind}.jpg")
+			changed(img, rng, kind).save(newPath)
+			zoom.saveCompress(img, oldPath)
+			pairs.append((kind, (str(newPath), str(oldPath)), str(i)))
+	appendSignatures(folder, signatures)
+	index = readIndex(folder)
+	return [(kind, paths, index[key]) for kind, paths, key in pairs]
+
+
+def timeit(test, pairs):
+	start = time.perf_counter()
+	results = [test(paths, location) for _, paths, location in pairs]
+	return time.perf_counter() - start, results
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Compare the exact and the scaled ref.py image comparison.")
+	parser.add_argument("--size", type=int, default=512, help="Tile size in pixels.")
+	parser.add_argument("--count", type=int, default=32, help="Number of random base tiles, each is compared in 5 variants.")
+	parser.add_argument("--screenshotformat", choices=("png", "bmp"), default="png", help="Format of the new screenshots.")
+	args = parser.parse_args()
+
+	with tempfile.TemporaryDirectory() as folder:
+		pairs = samplePairs(folder, args.size, args.count, screenshotExt=SCREENSHOTEXTS[args.screenshotformat])
+		results = {
+			"exact": timeit(lambda paths, location: ref.test(paths), pairs),
+			"scaled": timeit(lambda paths, location: ref.scaledTest(paths), pairs),
+			"signature": timeit(ref.signatureTest, pairs),
+		}
+
+	print(f"{'kept':<10}", *(f"{name:>10}" for name in results))
+	for kind in dict.fromkeys(kind for kind, _, _ in pairs):
+		indices = [i for i, pair in enumerate(pairs) if pair[0] == kind]
+		print(f"{kind:<10}", *(f"{sum(decisions[i] for i in indices):>10}" for _, decisions in results.values()))
+	for name, (seconds, _) in results.items():
+		print(f"{name:<10} {len(pairs) / seconds:8.1f} comparisons/s")
+
+	exactResults = results["exact"][1]
+	mismatches = [pairs[i][1][0] for i in range(len(pairs)) if any(decisions[i] != exactResults[i] for _, decisions in results.values())]
+	if mismatches:
+		print(f"{len(mismatches)} of {len(pairs)} decisions differ:", *mismatches, sep="\n  ")
+		sys.exit(1)
+
+
+if __name__ == "__main__":
+	main()
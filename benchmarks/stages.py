@@ -0,0 +1,183 @@
+# runs crop, ref and zoom on synthetic output folders and reports wall time, tiles/s and peak memory per step as json.
+# run from the FactorioMaps folder: python -m benchmarks.stages [--tiles 12] [--snapshots 3] [--output result.json] [--baseline old.json]
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+from argparse import Namespace
+from pathlib import Path
+
+import numpy
+import psutil
+
+from benchmarks.synthetic import DAYTIME, MAXZOOM, SURFACE, addSnapshot, tileCoords
+from crop import crop
+from encoders import parseProfile
+from rawimage import jpegQuality, screenshotExt
+from ref import ref
+from workerpool import WorkerPool
+from zoom import zoom
+
+STAGES = ("crop", "ref", "zoom")
+SAMPLEINTERVAL = 0.05
+
+
+class PeakMemory:
+	# samples the resident memory of this process and all its worker processes while a step runs.
+
+	def __init__(self):
+		self.process = psutil.Process(os.getpid())
+		self.peak = 0
+		self.stopped = threading.Event()
+		self.thread = threading.Thread(target=self.sample)
+		self.thread.daemon = True
+
+	def rss(self):
+		total = self.process.memory_info().rss
+		for child in self.process.children(recursive=True):
+			try:
+				total += child.memory_info().rss
+			except psutil.Error:
+				pass
+		return total
+
+	def sample(self):
+		while True:
+			self.peak = max(self.peak, self.rss())
+			if self.stopped.wait(SAMPLEINTERVAL):
+				break
+
+	def __enter__(self):
+		self.thread.start()
+		return self
+
+	def __exit__(self, excType, excValue, traceback):
+		self.stopped.set()
+		self.thread.join()
+
+
+def countTiles(folder):
+	return sum(len(files) for _, _, files in os.walk(folder))
+
+
+def runStage(name, func, tiles, results):
+	with PeakMemory() as memory:
+		start = time.perf_counter()
+		func()
+		seconds = time.perf_counter() - start
+	result = results.setdefault(name, {"seconds": 0.0, "tiles": 0, "peakRss": 0})
+	result["seconds"] += seconds
+	result["tiles"] += tiles
+	result["peakRss"] = max(result["peakRss"], memory.peak)
+
+
+def benchmark(config, folder):
+	args = Namespace(maxthreads=config["threads"], cropthreads=None, refthreads=None, zoomthreads=None, verbose=0, zoommemory=config["zoommemory"], downsampler=config["downsampler"], refmode="signature", tilestore=config["tilestore"], tileformat=config["tileformat"], dedup=config["dedup"], screenshotformat=config["screenshotformat"])
+	rng = numpy.random.default_rng(config["seed"])
+	coords = tileCoords(config["tiles"], rng)
+	images = {}
+	top = Path(folder, "bench")
+	if top.exists():
+		raise Exception(f"{top} already exists, the snapshots have to be generated from scratch.")
+	results = {}
+	devnull = open(os.devnull, "w")
+	try:
+		with WorkerPool(config["threads"]) as pool:
+			for index in range(config["snapshots"]):
+				snapshot = addSnapshot(top, index, coords, images, rng, config["change"], config["crop"], config["size"], ext=screenshotExt(args), quality=jpegQuality(parseProfile(args.tileformat)))
+				snapshotFolder = Path(top, "Images", snapshot, SURFACE, DAYTIME)
+				# the progress bars would drown out the report.
+				stdout, sys.stdout = sys.stdout, devnull
+				try:
+					runStage("crop", lambda: crop("bench", snapshot, SURFACE, DAYTIME, folder, args, pool), len(coords), results)
+					runStage("ref", lambda: ref("bench", snapshot, SURFACE, DAYTIME, folder, args, pool), len(coords), results)
+					kept = countTiles(Path(snapshotFolder, str(MAXZOOM)))
+					runStage("zoom", lambda: zoom("bench", snapshot, SURFACE, DAYTIME, folder, True, args, pool), kept, results)
+				finally:
+					sys.stdout = stdout
+	finally:
+		devnull.close()
+
+	for result in results.values():
+		result["tilesPerSecond"] = result["tiles"] / result["seconds"] if result["seconds"] else 0.0
+	return results
+
+
+def compare(results, baseline, tolerance):
+	# prints the change against a stored report, returns the steps that got slower by more than tolerance.
+	slower = []
+	print(f"{'step':<6} {'seconds':>9} {'baseline':>9} {'tiles/s':>9} {'change':>8} {'peak MB':>8}")
+	for name in STAGES:
+		if name not in results:
+			continue
+		result = results[name]
+		old = baseline.get("stages", {}).get(name)
+		change = ""
+		if old and old["tilesPerSecond"]:
+			ratio = result["tilesPerSecond"] / old["tilesPerSecond"] - 1
+			change = f"{ratio * 100:+.1f}%"
+			if ratio < -tolerance:
+				slower.append(name)
+		print(f"{name:<6} {result['seconds']:>9.2f} {old['seconds'] if old else float('nan'):>9.2f} {result['tilesPerSecond']:>9.1f} {change:>8} {result['peakRss'] / 2**20:>8.0f}")
+	return slower
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark crop, ref and zoom on synthetic snapshots.")
+	parser.add_argument("--tiles", type=int, default=12, help="Diameter of the map in max zoom tiles.")
+	parser.add_argument("--snapshots", type=int, default=3, help="Number of snapshots, every one is cropped, crossreferenced and zoomed.")
+	parser.add_argument("--change", type=float, default=0.25, help="Fraction of tiles that change between snapshots.")
+	parser.add_argument("--crop", type=float, default=0.05, help="Fraction of screenshots that need cropping.")
+	parser.add_argument("--size", type=int, default=512, help="Tile size in pixels.")
+	parser.add_argument("--threads", type=int, default=os.cpu_count(), help="Worker processes.")
+	parser.add_argument("--zoommemory", type=int, default=256, help="Same as the auto.py flag.")
+	parser.add_argument("--downsampler", choices=("antialias", "box"), default="antialias", help="Same as the auto.py flag.")
+	parser.add_argument("--tilestore", choices=("files", "sqlite"), default="files", help="Same as the auto.py flag.")
+	parser.add_argument("--tileformat", default="jpg", help="Same as the auto.py flag.")
+	parser.add_argument("--dedup", action="store_true", help="Same as the auto.py flag.")
+	parser.add_argument("--screenshotformat", choices=("png", "bmp", "jpeg"), default="png", help="Same as the auto.py flag, the synthetic screenshots are written in this format.")
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--folder", type=Path, default=None, help="Where to write the synthetic snapshots, a temporary folder by default.")
+	parser.add_argument("--output", type=Path, default=None, help="Write the report to this json file.")
+	parser.add_argument("--baseline", type=Path, default=None, help="Compare against a report written by an earlier run.")
+	parser.add_argument("--tolerance", type=float, default=0.1, help="Exit with an error if a step is this much slower than the baseline.")
+	args = parser.parse_args()
+
+	config = {key: getattr(args, key) for key in ("tiles", "snapshots", "change", "crop", "size", "threads", "zoommemory", "downsampler", "tilestore", "tileformat", "dedup", "screenshotformat", "seed")}
+	if args.folder:
+		args.folder.mkdir(parents=True, exist_ok=True)
+		results = benchmark(config, args.folder)
+	else:
+		with tempfile.TemporaryDirectory() as folder:
+			results = benchmark(config, Path(folder))
+
+	report = {
+		"config": config,
+		"machine": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+		"stages": results,
+	}
+	if args.output:
+		with args.output.open("w", encoding="utf-8") as f:
+			json.dump(report, f, indent=2)
+
+	baseline = {}
+	if args.baseline:
+		with args.baseline.open("r", encoding="utf-8") as f:
+			baseline = json.load(f)
+		if baseline.get("config") != config:
+			print("WARNING: the baseline was run with different settings:", baseline.get("config"))
+	slower = compare(results, baseline, args.tolerance)
+	if not args.output:
+		print(json.dumps(report))
+	if slower:
+		print("slower than the baseline:", ", ".join(slower))
+		sys.exit(1)
+
+
+if __name__ == "__main__":
+	main()
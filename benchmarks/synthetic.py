@@ -0,0 +1,123 @@
+# generates output folders that look like the ones factorio leaves behind for crop.py, ref.py and zoom.py.
+# python -m benchmarks.synthetic FOLDER [--tiles 12] [--snapshots 3] [--change 0.25] only writes the raw screenshots.
+
+import argparse
+import json
+from pathlib import Path
+
+import numpy
+from PIL import Image
+
+
+SURFACE = "nauvis"
+DAYTIME = "day"
+MINZOOM = 16
+MAXZOOM = 20
+CROPFLAGS = (1, 2, 4, 8, 3, 12)
+GROUNDCOLORS = ((74, 62, 42), (96, 84, 58), (58, 72, 40))
+
+
+def tileImage(rng, size):
+	# ground texture with a few buildings on it, and now and then an empty tile of one colour like water or out of map.
+	if rng.random() < 0.1:
+		return numpy.full((size, size, 3), GROUNDCOLORS[rng.integers(len(GROUNDCOLORS))], dtype=numpy.uint8)
+	ground = rng.integers(-12, 13, (size // 16, size // 16, 3)) + GROUNDCOLORS[rng.integers(len(GROUNDCOLORS))]
+	array = numpy.asarray(Image.fromarray(numpy.clip(ground, 0, 255).astype(numpy.uint8)).resize((size, size), Image.BILINEAR)).copy()
+	for _ in range(rng.integers(0, 12)):
+		addBuilding(array, rng)
+	return array
+
+
+def addBuilding(array, rng):
+	size = array.shape[0]
+	w, h = rng.integers(size // 32, size // 4, 2)
+	x, y = rng.integers(0, size - w), rng.integers(0, size - h)
+	array[y:y+h, x:x+w] = rng.integers(40, 220, 3)
+	array[y+h//4:y+h-h//4, x+w//4:x+w-w//4] = rng.integers(40, 220, 3)
+
+
+def tileCoords(tiles, rng, fill=0.8):
+	# a roughly round base, tiles are (x, y) at max zoom.
+	radius = tiles / 2
+	return [
+		(x, y)
+		for x in range(-tiles // 2, tiles - tiles // 2)
+		for y in range(-tiles // 2, tiles - tiles // 2)
+		if (x + 0.5) ** 2 + (y + 0.5) ** 2 <= radius ** 2 and rng.random() < fill
+	]
+
+
+def saveScreenshot(img, path, quality):
+	if path.suffix == ".jpeg":
+		img.save(path, quality=quality)
+	else:
+		img.save(path)
+
+
+def addSnapshot(top, index, coords, images, rng, change=0.25, cropRatio=0.05, size=512, minzoom=MINZOOM, maxzoom=MAXZOOM, ext=".png", quality=95):
+	# writes the screenshots, crop.txt, done.txt and the mapInfo.json entry of the next snapshot. images holds the
+	# current image of every tile and is updated with the changes of this snapshot.
+	path = str(index + 1)
+	Path(top).mkdir(parents=True, exist_ok=True)
+	mapInfoPath = Path(top, "mapInfo.json")
+	if mapInfoPath.exists():
+		with mapInfoPath.open("r", encoding="utf-8") as f:
+			mapInfo = json.load(f)
+	else:
+		mapInfo = {"options": {"HD": False, "day": True, "night": False}, "maps": []}
+	mapInfo["maps"].append({
+		"tick": index * 216000,
+		"path": path,
+		"date": "01/01/20",
+		"surfaces": {SURFACE: {"zoom": {"min": minzoom, "max": maxzoom}, DAYTIME: True, "links": [], "tags": [], "captured": True, "spawn": {"x": 0, "y": 0}}},
+	})
+	with mapInfoPath.open("w", encoding="utf-8") as f:
+		json.dump(mapInfo, f)
+
+	for coord in coords:
+		if coord not in images:
+			images[coord] = tileImage(rng, size)
+		elif rng.random() < change:
+			images[coord] = images[coord].copy()
+			addBuilding(images[coord], rng)
+
+	folder = Path(top, "Images", path, SURFACE, DAYTIME)
+	cropLines = ["v2"]
+	for x, y in coords:
+		tilePath = Path(folder, str(maxzoom), str(x), f"{y}{ext}")
+		tilePath.parent.mkdir(parents=True, exist_ok=True)
+		if rng.random() < cropRatio:
+			# screenshots at the edge of the map come out bigger and are cropped back to size.
+			xOffset, yOffset = rng.integers(1, 32, 2)
+			padded = Image.new("RGB", (size + xOffset + rng.integers(1, 32), size + yOffset + rng.integers(1, 32)), (0, 0, 0))
+			padded.paste(Image.fromarray(images[(x, y)]), (int(xOffset), int(yOffset)))
+			saveScreenshot(padded, tilePath, quality)
+			cropLines.append(f"{xOffset} {yOffset} {size} {size} {CROPFLAGS[rng.integers(len(CROPFLAGS))]:x} {path}/{SURFACE}/{DAYTIME}/{maxzoom}/{x}/{y}{ext}")
+		else:
+			saveScreenshot(Image.fromarray(images[(x, y)]), tilePath, quality)
+	with Path(folder, "crop.txt").open("w", encoding="utf-8") as f:
+		f.write("\n".join(cropLines))
+	Path(folder, "done.txt").touch()
+	return path
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Write a synthetic output folder with unprocessed screenshots.")
+	parser.add_argument("folder", type=Path, help="Output folder, mapInfo.json and Images are written into it.")
+	parser.add_argument("--tiles", type=int, default=12, help="Diameter of the map in max zoom tiles.")
+	parser.add_argument("--snapshots", type=int, default=3, help="Number of snapshots.")
+	parser.add_argument("--change", type=float, default=0.25, help="Fraction of tiles that change between snapshots.")
+	parser.add_argument("--size", type=int, default=512, help="Tile size in pixels.")
+	parser.add_argument("--seed", type=int, default=0)
+	args = parser.parse_args()
+
+	rng = numpy.random.default_rng(args.seed)
+	coords = tileCoords(args.tiles, rng)
+	images = {}
+	for index in range(args.snapshots):
+		addSnapshot(args.folder, index, coords, images, rng, args.change, size=args.size)
+	print(f"{len(coords)} tiles in {args.snapshots} snapshots")
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,190 @@
+import os
+import sqlite3
+from pathlib import Path
+
+import tilestore
+
+
+CATALOGFILE = "catalog.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tiles (surface TEXT, daytime TEXT, z INTEGER, x INTEGER, y INTEGER, mapIndex INTEGER, snapshot TEXT, PRIMARY KEY (surface, daytime, z, x, y)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS crops (surface TEXT, daytime TEXT, z INTEGER, x INTEGER, y INTEGER, mapIndex INTEGER, flags INTEGER, PRIMARY KEY (surface, daytime, z, x, y)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS snapshots (mapIndex INTEGER, snapshot TEXT, surface TEXT, daytime TEXT, size INTEGER, complete INTEGER, PRIMARY KEY (mapIndex, surface, daytime)) WITHOUT ROWID;
+"""
+
+workerConnections = {}		# catalog path: the connection every task a worker process runs shares
+workerPid = None
+
+
+def workerConnection(path):
+	# catalogs sent to a worker with a task open one connection per process, instead of one per task.
+	global workerPid
+	if workerPid != os.getpid():
+		# connections inherited from the parent process are not ours to use.
+		workerPid = os.getpid()
+		workerConnections.clear()
+	if path not in workerConnections:
+		workerConnections[path] = connect(path)
+	return workerConnections[path]
+
+
+def connect(path):
+	db = sqlite3.connect(str(path), timeout=60)
+	db.executescript(SCHEMA)
+	return db
+
+
+def readCropFile(path, z):
+	# yields (z, x, y, flags) for every screenshot in a crop.txt, v1 files do not store the zoom level so z is used.
+	with open(path, "r", encoding="utf-8") as f:
+		version = 2 if f.readline().rstrip('\n') == "v2" else 1
+		for line in f:
+			split = line.rstrip("\n").split(" ", 5)
+			if version == 1:
+				yield (z, int(split[0]), int(os.path.splitext(split[1])[0]), int(split[4], 16))
+			elif len(split) == 6:
+				pathSplit = split[5].split("/", 5)
+				if not pathSplit[3].isdigit():	# renderboxes
+					continue
+				# ref has always read the width column as the crop flags, keep doing that so the same tiles are kept.
+				yield (int(pathSplit[3]), int(pathSplit[4]), int(os.path.splitext(pathSplit[5])[0]), int(split[2], 16))
+
+
+class TileCatalog:
+	# remembers the newest snapshot that holds every tile of an output folder, so ref and zoom do not have to list
+	# or probe the folders of all older snapshots. rows only ever move forward to newer snapshots.
+
+	def __init__(self, topPath):
+		self.path = Path(topPath, CATALOGFILE)
+		self.connection = None
+		self.worker = False
+		self.synced = None
+
+	@property
+	def db(self):
+		if self.worker:
+			return workerConnection(self.path)
+		if self.connection is None:
+			self.connection = connect(self.path)
+		return self.connection
+
+	def close(self):
+		# the connection of a worker stays open for its next task.
+		if self.connection is not None:
+			self.connection.close()
+			self.connection = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, excType, excValue, traceback):
+		self.close()
+
+	def __getstate__(self):
+		# workers use their own connection.
+		return {"path": self.path, "connection": None, "worker": True, "synced": None}
+
+
+	def sync(self, maps):
+		# forget everything about a surface once one of its snapshots no longer matches mapInfo.json, it will be indexed again from disk.
+		# only checked again once mapInfo.json changes, ref and zoom index every surface and daytime they work on.
+		snapshots = [(str(map["path"]), sorted(map["surfaces"])) for map in maps]
+		if snapshots == self.synced:
+			return
+		stale = set()
+		for mapIndex, snapshot, surfaceName, daytime in self.db.execute("SELECT mapIndex, snapshot, surface, daytime FROM snapshots").fetchall():
+			if mapIndex >= len(maps) or str(maps[mapIndex]["path"]) != snapshot or surfaceName not in maps[mapIndex]["surfaces"]:
+				stale.add((surfaceName, daytime))
+		for surfaceName, daytime in stale:
+			self.forget(surfaceName, daytime)
+		self.synced = snapshots
+
+	def forget(self, surfaceName, daytime):
+		with self.db:
+			for table in ("tiles", "crops", "snapshots"):
+				self.db.execute(f"DELETE FROM {table} WHERE surface = ? AND daytime = ?", (surfaceName, daytime))
+
+	def index(self, topPath, maps, before, surfaceName, daytime):
+		# adds older snapshots the catalog does not fully know about yet, like output folders from before the catalog existed.
+		self.sync(maps)
+		for mapIndex in range(before):
+			snapshot = str(maps[mapIndex]["path"])
+			if surfaceName not in maps[mapIndex]["surfaces"] or self.isComplete(mapIndex, surfaceName, daytime):
+				continue
+			folder = Path(topPath, "Images", snapshot, surfaceName, daytime)
+			if not folder.is_dir():
+				continue
+			maxzoom = maps[mapIndex]["surfaces"][surfaceName]["zoom"]["max"]
+			self.markSnapshot(mapIndex, snapshot, surfaceName, daytime)
+			size = None
+			coords = {}
+			for z, x, y, path in tilestore.listTiles(folder):
+				coords.setdefault(z, set()).add((x, y))
+				if size is None and z == maxzoom:
+					size = tilestore.openImage(path).size[0]
+			for z, zCoords in coords.items():
+				self.addTiles(mapIndex, snapshot, surfaceName, daytime, z, zCoords)
+			if Path(folder, "crop.txt").is_file():
+				self.addCrops(mapIndex, surfaceName, daytime, readCropFile(Path(folder, "crop.txt"), maxzoom))
+			self.markSnapshot(mapIndex, snapshot, surfaceName, daytime, True, size)
+
+
+	def markSnapshot(self, mapIndex, snapshot, surfaceName, daytime, complete=False, size=None):
+		with self.db:
+			self.db.execute("INSERT OR IGNORE INTO snapshots VALUES (?, ?, ?, ?, NULL, 0)", (mapIndex, snapshot, surfaceName, daytime))
+			self.db.execute("UPDATE snapshots SET complete = ?, size = COALESCE(?, size) WHERE mapIndex = ? AND surface = ? AND daytime = ?", (int(complete), size, mapIndex, surfaceName, daytime))
+
+	def hasSnapshot(self, mapIndex, surfaceName, daytime):
+		return self.db.execute("SELECT 1 FROM snapshots WHERE mapIndex = ? AND surface = ? AND daytime = ?", (mapIndex, surfaceName, daytime)).fetchone() is not None
+
+	def isComplete(self, mapIndex, surfaceName, daytime):
+		row = self.db.execute("SELECT complete FROM snapshots WHERE mapIndex = ? AND surface = ? AND daytime = ?", (mapIndex, surfaceName, daytime)).fetchone()
+		return row is not None and bool(row[0])
+
+	def size(self, mapIndex, surfaceName, daytime):
+		row = self.db.execute("SELECT size FROM snapshots WHERE mapIndex = ? AND surface = ? AND daytime = ?", (mapIndex, surfaceName, daytime)).fetchone()
+		return row[0] if row else None
+
+
+	def addTiles(self, mapIndex, snapshot, surfaceName, daytime, z, coords):
+		rows = [(surfaceName, daytime, z, x, y, mapIndex, snapshot) for x, y in coords]
+		with self.db:
+			self.db.executemany("INSERT OR IGNORE INTO tiles VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+			self.db.executemany(
+				"UPDATE tiles SET mapIndex = ?6, snapshot = ?7 WHERE surface = ?1 AND daytime = ?2 AND z = ?3 AND x = ?4 AND y = ?5 AND mapIndex < ?6",
+				rows,
+			)
+
+	def addCrops(self, mapIndex, surfaceName, daytime, entries):
+		rows = [(surfaceName, daytime, z, x, y, mapIndex, flags) for z, x, y, flags in entries]
+		with self.db:
+			self.db.executemany("INSERT OR IGNORE INTO crops VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+			self.db.executemany(
+				"UPDATE crops SET mapIndex = ?6, flags = ?7 WHERE surface = ?1 AND daytime = ?2 AND z = ?3 AND x = ?4 AND y = ?5 AND mapIndex < ?6",
+				rows,
+			)
+
+
+	def snapshotTiles(self, mapIndex, surfaceName, daytime, z):
+		return self.db.execute("SELECT x, y FROM tiles WHERE surface = ? AND daytime = ? AND z = ? AND mapIndex = ?", (surfaceName, daytime, z, mapIndex)).fetchall()
+
+	def tiles(self, surfaceName, daytime, z, before):
+		# {(x, y): snapshot} of the newest snapshot before the given one, None if the catalog already moved past it.
+		rows = self.db.execute("SELECT x, y, mapIndex, snapshot FROM tiles WHERE surface = ? AND daytime = ? AND z = ?", (surfaceName, daytime, z)).fetchall()
+		if any(row[2] >= before for row in rows):
+			return None
+		return {(x, y): snapshot for x, y, _, snapshot in rows}
+
+	def crops(self, surfaceName, daytime, z, before):
+		rows = self.db.execute("SELECT x, y, mapIndex, flags FROM crops WHERE surface = ? AND daytime = ? AND z = ?", (surfaceName, daytime, z)).fetchall()
+		if any(row[2] >= before for row in rows):
+			return None
+		return {(x, y): flags for x, y, _, flags in rows}
+
+	def newest(self, surfaceName, daytime, z, x, y, before):
+		# snapshot path, False if no older snapshot has the tile, None if the catalog cannot tell.
+		row = self.db.execute("SELECT mapIndex, snapshot FROM tiles WHERE surface = ? AND daytime = ? AND z = ? AND x = ? AND y = ?", (surfaceName, daytime, z, x, y)).fetchone()
+		if row is None:
+			return False
+		return row[1] if row[0] < before else None
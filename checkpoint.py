@@ -0,0 +1,87 @@
+import json
+import os
+import threading
+from pathlib import Path
+
+
+CHECKPOINTFILE = "checkpoint.json"
+SAVEINTERVAL = 10		# seconds between saves of finished zoom nodes
+
+
+class Checkpoint:
+	# remembers which captures and which steps of every snapshot, surface and daytime are finished, so an interrupted run
+	# continues where it stopped. the file is replaced atomically on every change and deleted once a run is complete.
+	# one instance is shared by every step working on the same output folder, get it with openCheckpoint().
+
+	def __init__(self, topPath):
+		self.path = Path(topPath, CHECKPOINTFILE)
+		self.lock = threading.RLock()
+		self.data = {"captures": {}, "units": {}, "renderboxes": {}}
+		if self.path.is_file():
+			with self.path.open("r", encoding="utf-8") as f:
+				self.data.update(json.load(f))
+
+	def save(self):
+		with self.lock:
+			tmpPath = self.path.with_name(self.path.name + ".tmp")
+			with tmpPath.open("w", encoding="utf-8") as f:
+				json.dump(self.data, f, separators=(",", ":"))
+				f.flush()
+				os.fsync(f.fileno())
+			os.replace(tmpPath, self.path)
+
+	def get(self, section, key):
+		with self.lock:
+			return dict(self.data[section].get(key, {}))
+
+	def update(self, section, key, **values):
+		with self.lock:
+			self.data[section].setdefault(key, {}).update(values)
+			self.save()
+
+	def remove(self, section, key):
+		with self.lock:
+			if self.data[section].pop(key, None) is not None:
+				self.save()
+
+	def delete(self):
+		with self.lock:
+			self.data = {"captures": {}, "units": {}, "renderboxes": {}}
+			if self.path.exists():
+				self.path.unlink()
+
+
+	def isDone(self, key, stage):
+		return bool(self.get("units", key).get(stage))
+
+	def markDone(self, key, stage):
+		self.update("units", key, **{stage: True})
+
+	def zoomNodes(self, key):
+		# (splitLevel, set of finished (z, x, y) nodes) of an unfinished zoom.
+		unit = self.get("units", key)
+		return unit.get("zoomSplit"), {tuple(node) for node in unit.get("zoomNodes", ())}
+
+	def addZoomNodes(self, key, splitLevel, nodes):
+		with self.lock:
+			unit = self.data["units"].setdefault(key, {})
+			if unit.get("zoomSplit") != splitLevel:
+				unit["zoomNodes"] = []
+			unit["zoomSplit"] = splitLevel
+			unit.setdefault("zoomNodes", []).extend(list(node) for node in nodes)
+			self.save()
+
+
+def unitKey(snapshot, surfaceName, daytime):
+	return f"{snapshot}/{surfaceName}/{daytime}"
+
+
+checkpoints = {}
+checkpointsLock = threading.Lock()
+
+def openCheckpoint(topPath):
+	path = Path(topPath).resolve()
+	with checkpointsLock:
+		if path not in checkpoints:
+			checkpoints[path] = Checkpoint(path)
+		return checkpoints[path]
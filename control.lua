@@ -155,10 +155,15 @@ script.on_event(defines.events.on_tick, function(event)
 				end
 			end
 
+			-- every surface is captured at each daytime before moving on to the next one, latest.txt lists them in that order.
+			fm.captures = {}
 			latest = ""
-			for _, surfaceName in pairs(fm.autorun.surfaces) do
-				local surface = game.surfaces[surfaceName]
-				latest = fm.autorun.name:sub(1, -2):gsub(" ", "/") .. " " .. fm.autorun.filePath .. " " .. surfaceName:gsub(" ", "|") .. " " .. fm.autorun.daytime .. "\n" .. latest
+			for i = #fm.autorun.surfaces, 1, -1 do
+				local surfaceName = fm.autorun.surfaces[i]
+				for _, daytime in pairs(fm.autorun.daytimes) do
+					table.insert(fm.captures, 1, { surface = surfaceName, daytime = daytime })
+					latest = latest .. fm.autorun.name:sub(1, -2):gsub(" ", "/") .. " " .. fm.autorun.filePath .. " " .. surfaceName:gsub(" ", "|") .. " " .. daytime .. "\n"
+				end
 			end
 			game.write_file(fm.topfolder .. "latest.txt", latest, false, event.player_index)
 			
@@ -175,28 +180,33 @@ script.on_event(defines.events.on_tick, function(event)
 
 		if fm.ticks == nil then
 
-			fm.currentSurface = game.surfaces[table.remove(fm.autorun.surfaces, #fm.autorun.surfaces)]
-			-- if currentSurface ~= player.surface.name then
-			-- 	player.teleport({0, 0}, currentSurface)
-			-- 	fm.teleportedPlayer = true
-			-- end
-			
-			-- remove no path sign and ghost entities
-			for key, entity in pairs(fm.currentSurface.find_entities_filtered({type={"flying-text","entity-ghost","tile-ghost"}})) do
-				entity.destroy()
-			end
+			local capture = table.remove(fm.captures)
+			fm.autorun.daytime = capture.daytime
+
+			if fm.currentSurface == nil or fm.currentSurface.name ~= capture.surface then
+				fm.currentSurface = game.surfaces[capture.surface]
+				-- if currentSurface ~= player.surface.name then
+				-- 	player.teleport({0, 0}, currentSurface)
+				-- 	fm.teleportedPlayer = true
+				-- end
+				
+				-- remove no path sign and ghost entities
+				for key, entity in pairs(fm.currentSurface.find_entities_filtered({type={"flying-text","entity-ghost","tile-ghost"}})) do
+					entity.destroy()
+				end
 
-			--spawn a bunch of hidden energy sources on lamps
-			for _, t in pairs(fm.currentSurface.find_entities_filtered{type="lamp"}) do
-				local control = t.get_control_behavior()
-				if t.energy > 1 and (control and not control.disabled) or (not control) then
-					fm.currentSurface.create_entity{name="hidden-electric-energy-interface", position=t.position}
+				--spawn a bunch of hidden energy sources on lamps
+				for _, t in pairs(fm.currentSurface.find_entities_filtered{type="lamp"}) do
+					local control = t.get_control_behavior()
+					if t.energy > 1 and (control and not control.disabled) or (not control) then
+						fm.currentSurface.create_entity{name="hidden-electric-energy-interface", position=t.position}
+					end
 				end
-			end
 
-			-- freeze all entities. Eventually, stuff will run out of power, but for just 2 ticks, it should be fine.
-			for key, entity in pairs(fm.currentSurface.find_entities_filtered({invert=true, name="hidden-electric-energy-interface"})) do
-				entity.active = false
+				-- freeze all entities. Eventually, stuff will run out of power, but for just a few ticks per daytime, it should be fine.
+				for key, entity in pairs(fm.currentSurface.find_entities_filtered({invert=true, name="hidden-electric-energy-interface"})) do
+					entity.active = false
+				end
 			end
 
 
@@ -223,6 +233,9 @@ script.on_event(defines.events.on_tick, function(event)
 	
 			fm.ticks = 2
 
+		elseif #fm.captures > 0 then
+			fm.ticks = nil
+
 		else
 			fm.topfolder = nil
 
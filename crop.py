@@ -1,4 +1,3 @@
-import multiprocessing as mp
 import os
 import sys
 import time
@@ -10,33 +9,58 @@ from shutil import get_terminal_size as tsize
 import psutil
 from PIL import Image
 
-ext = ".png"
+import tracing
+from filewatch import FileWatcher, waitForData
+from metrics import measure
+from encoders import jpeg, parseProfile
+from rawimage import JPEGEXT, RAWEXT, addWindows, cropJpeg, isComplete, isCompleteJpeg, jpegQuality
+from workerpool import WorkerPool
 
 
-def work(line, folder, progressQueue):
+def parseLine(line, folder):
 	arg = line.rstrip("\n").split(" ", 5)
-	path = Path(folder, arg.pop(5))
-	arg = list(map(int, arg[:4]))
-	top, left, width, height = arg
+	top, left, width, height = map(int, arg[:4])
+	return Path(folder, arg[5]), (top, left, top + width, left + height)
+
+
+def work(line, folder, progress, quality):
+	path, box = parseLine(line, folder)
+	width, height = box[2] - box[0], box[3] - box[1]
 	try:
-		Image.open(path).convert("RGB").crop(
-			(top, left, top + width, left + height)
-		).save(path)
+		if path.suffix == RAWEXT:	# the screenshot stays as it is, crop only records the box, see rawimage.py
+			if not isComplete(path):
+				return line
+			progress.add()
+			return False
+		if path.suffix == JPEGEXT:
+			data = path.read_bytes()
+			if not isCompleteJpeg(data):
+				return line
+			if jpeg.decode_header(data)[:2] != (width, height):
+				with measure("encode", path):
+					data = cropJpeg(data, box, quality)
+				path.write_bytes(data)
+			progress.add()
+			return False
+		img = Image.open(path)
+		if img.size != (width, height):	# otherwise an interrupted run already cropped it
+			with measure("decode", path):
+				img = img.convert("RGB")
+			with measure("encode", path):
+				img.crop(box).save(path)
 	except IOError:
-		progressQueue.put(False, True)
 		return line
 	except:
-		progressQueue.put(False, True)
 		import traceback
 
 		traceback.print_exc()
 		pass
 		return False
-	progressQueue.put(True, True)
+	progress.add()
 	return False
 
 
-def crop(outFolder, timestamp, surface, daytime, basePath=None, args: Namespace = Namespace()):
+def crop(outFolder, timestamp, surface, daytime, basePath=None, args: Namespace = Namespace(), pool: WorkerPool = None):
 
 	psutil.Process(os.getpid()).nice(psutil.BELOW_NORMAL_PRIORITY_CLASS if os.name == "nt" else 10)
 
@@ -50,42 +74,53 @@ def crop(outFolder, timestamp, surface, daytime, basePath=None, args: Namespace
 
 	datapath = Path(imagePath, subname, "crop.txt")
 	maxthreads = args.cropthreads if args.cropthreads else args.maxthreads
+	quality = jpegQuality(parseProfile(args.tileformat))
 
-	while not datapath.exists():
-		time.sleep(1)
+	waitForData(datapath)
+
+	if pool is None:
+		with WorkerPool(maxthreads) as pool:
+			return crop(outFolder, timestamp, surface, daytime, basePath, args, pool)
+	stage = pool.stage(maxthreads, ("crop", timestamp, surface, daytime))
 
 	print(f"crop {0:5.1f}% [{' ' * (tsize()[0]-15)}]", end="")
 
 	files = []
+
+	def show(doneSize):
+		progress = float(doneSize) / originalSize
+		tsiz = tsize()[0] - 15
+		print(f"\rcrop {round(progress * 100, 1):5.1f}% [{'=' * int(progress * tsiz)}{' ' * (tsiz - int(progress * tsiz))}]",end="",)
+
 	with datapath.open("r", encoding="utf-8") as data:
 		assert data.readline().rstrip("\n") == "v2"
 		for line in data:
-			files.append(line)
-
-	pool = mp.Pool(processes=maxthreads)
-
-	m = mp.Manager()
-	progressQueue = m.Queue()
+			if line.strip():
+				files.append(line.rstrip("\n"))
 	originalSize = len(files)
-	doneSize = 0
 
 	try:
-		while len(files) > 0:
-			workers = pool.map_async(
-				partial(work, folder=imagePath, progressQueue=progressQueue),
-				files,
-				128,
-			)
-			for _ in range(len(files)):
-				if progressQueue.get(True):
-					doneSize += 1
-					progress = float(doneSize) / originalSize
-					tsiz = tsize()[0] - 15
-					print(f"\rcrop {round(progress * 100, 1):5.1f}% [{'=' * int(progress * tsiz)}{' ' * (tsiz - int(progress * tsiz))}]",end="",)
-			workers.wait()
-			files = [x for x in workers.get() if x]
-			if len(files) > 0:
-				time.sleep(10 if len(files) > 1000 else 1)
+		with pool.progress() as progress:
+			while len(files) > 0:
+				workers = stage.map_async(
+					partial(work, folder=imagePath, progress=progress, quality=quality),
+					files,
+					128,
+				)
+				progress.follow(workers, show)
+				done = files
+				files = [x for x in workers.get() if x]
+				retrying = set(files)
+				addWindows(parseLine(line, imagePath) for line in done if line not in retrying and line.split(" ", 5)[5].endswith(RAWEXT))
+				if len(files) > 0:
+					# retry as soon as factorio writes to one of the images that were not complete yet
+					waitStart = time.perf_counter()
+					with tracing.span("wait for screenshots", "crop", retrying=len(files)), FileWatcher(*(Path(imagePath, line.split(" ", 5)[5]) for line in files)) as watcher:
+						woken = watcher.wait(10 if len(files) > 1000 else 1)
+					if stage.metrics is not None:
+						stage.metrics.add(stage.key, "factorioWaitSeconds", time.perf_counter() - waitStart)
+					if woken:
+						time.sleep(0.1)	# factorio writes images in batches, let it finish a few more before trying again
 		print(f"\rcrop {100:5.1f}% [{'=' * (tsize()[0]-15)}]")
 	except KeyboardInterrupt:
 
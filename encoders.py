@@ -0,0 +1,113 @@
+import io
+import json
+import os
+from pathlib import Path
+
+import numpy
+from turbojpeg import TurboJPEG
+
+
+# the finished tiles of every zoom level can use a different format. zoom writes the formats it used to formats.json in
+# every <snapshot>/<surface>/<daytime> folder, folders without one are from before and hold jpg tiles.
+
+FORMATFILE = "formats.json"
+DEFAULTFORMAT = ("jpg", 85)		# tiles without a formats.json, and renderboxes
+
+
+# note that these are all 64 bit libraries since factorio doesnt support 32 bit.
+if os.name == "nt":
+	jpeg = TurboJPEG(Path(__file__, "..", "mozjpeg/turbojpeg.dll").resolve().as_posix())
+# elif _platform == "darwin":						# I'm not actually sure if mac can run linux libraries or not.
+# 	jpeg = TurboJPEG("mozjpeg/libturbojpeg.dylib")	# If anyone on mac has problems with the line below please make an issue :)
+else:
+	jpeg = TurboJPEG(Path(__file__, "..", "mozjpeg/libturbojpeg.so").resolve().as_posix())
+
+
+def encodeJpeg(img, quality):
+	return jpeg.encode(numpy.array(img)[:, :, ::-1].copy(), quality=quality)
+
+
+def encodeWebp(img, quality):
+	buffer = io.BytesIO()
+	img.save(buffer, format="WEBP", quality=quality, method=4)
+	return buffer.getvalue()
+
+
+def encodeWebpLossless(img, quality):
+	# quality is how hard webp tries to make the file smaller, the pixels are always exact.
+	buffer = io.BytesIO()
+	img.save(buffer, format="WEBP", lossless=True, quality=quality, method=4)
+	return buffer.getvalue()
+
+
+def encodeAvif(img, quality):
+	buffer = io.BytesIO()
+	img.save(buffer, format="AVIF", quality=quality)
+	return buffer.getvalue()
+
+
+# name: (extension, default quality, encoder). png is not on the list, it is the format of the unfinished tiles.
+ENCODERS = {
+	"jpg": (".jpg", 85, encodeJpeg),
+	"webp": (".webp", 80, encodeWebp),
+	"webp-lossless": (".webp", 50, encodeWebpLossless),
+	"avif": (".avif", 60, encodeAvif),
+}
+
+
+def parseProfile(spec):
+	# "webp-lossless,webp:75,jpg" -> [(name, quality), ...] from the max zoom level outwards, the last one is used for
+	# every remaining level.
+	profile = []
+	for part in spec.split(","):
+		name, _, quality = part.strip().partition(":")
+		if name not in ENCODERS:
+			raise ValueError(f"unknown tile format '{name}', use one of {', '.join(ENCODERS)}")
+		if name == "avif":
+			try:
+				import pillow_avif
+			except ImportError:
+				raise ValueError("avif tiles need the pillow-avif-plugin package: pip install pillow-avif-plugin")
+		profile.append((name, int(quality) if quality else ENCODERS[name][1]))
+	return profile
+
+
+def writeFormats(folder, profile, minzoom, maxzoom):
+	formats = {str(z): profile[min(maxzoom - z, len(profile) - 1)] for z in range(minzoom, maxzoom + 1)}
+	with Path(folder, FORMATFILE).open("w", encoding="utf-8") as f:
+		json.dump(formats, f)
+	cache[str(folder)] = {int(z): tuple(value) for z, value in formats.items()}
+
+
+cache = {}
+
+def readFormats(folder):
+	# {z: (name, quality)}, None for folders without a formats.json.
+	folder = str(folder)
+	if folder not in cache:
+		try:
+			with open(os.path.join(folder, FORMATFILE), "r", encoding="utf-8") as f:
+				cache[folder] = {int(z): tuple(value) for z, value in json.load(f).items()}
+		except FileNotFoundError:
+			cache[folder] = None
+	return cache[folder]
+
+
+def tileFormat(path):
+	# (name, quality) of the finished tile at .../<daytime>/<z>/<x>/<y>
+	path = Path(path)
+	if len(path.parts) < 4 or not path.parts[-3].isdigit():
+		return DEFAULTFORMAT
+	formats = readFormats(path.parents[2])
+	if formats is None:
+		return DEFAULTFORMAT
+	return formats.get(int(path.parts[-3]), DEFAULTFORMAT)
+
+
+def finalPath(path):
+	return Path(path).with_suffix(ENCODERS[tileFormat(path)[0]][0])
+
+
+def encode(img, path):
+	name, quality = tileFormat(path)
+	return ENCODERS[name][2](img, quality)
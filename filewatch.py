@@ -0,0 +1,140 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import sys
+import time
+from pathlib import Path
+
+import tracing
+
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCHMASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+POLLMIN = 0.02
+POLLMAX = 0.5
+POLLPATHS = 256			# polling only stats this many of the watched paths, any of them changing is enough to wake up.
+SAFETYINTERVAL = 2		# even inotify waits are woken up this often, in case a filesystem does not report its changes.
+
+
+def loadInotify():
+	if not sys.platform.startswith("linux"):
+		return None
+	try:
+		libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+		libc.inotify_init1.argtypes = [ctypes.c_int]
+		libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+		return libc
+	except (OSError, AttributeError):
+		return None
+
+libc = loadInotify()
+
+
+def existingParent(path):
+	while not path.exists() and path.parent != path:
+		path = path.parent
+	return path
+
+
+class FileWatcher:
+	# wakes up as soon as one of the given files changes or appears. uses inotify on the folders that contain them on linux,
+	# and polls the files themselves with a growing interval everywhere else. folders that do not exist yet are watched through
+	# their closest existing parent.
+
+	def __init__(self, *paths):
+		self.paths = [Path(path) for path in paths]
+		self.fd = None
+		self.watched = set()
+		if libc is not None:
+			fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+			if fd >= 0:
+				self.fd = fd
+		self.interval = POLLMIN
+		self.state = self.pollState()
+		self.refresh()
+
+	def close(self):
+		if self.fd is not None:
+			os.close(self.fd)
+			self.fd = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, excType, excValue, traceback):
+		self.close()
+
+
+	def refresh(self):
+		if self.fd is None:
+			return
+		for folder in {existingParent(path.parent) for path in self.paths}:
+			if folder not in self.watched and libc.inotify_add_watch(self.fd, os.fsencode(str(folder)), WATCHMASK) >= 0:
+				self.watched.add(folder)
+
+	def pollState(self):
+		state = []
+		for path in self.paths[:POLLPATHS]:
+			path = existingParent(path)
+			try:
+				stat = path.stat()
+				state.append((path, stat.st_mtime_ns, stat.st_size))
+			except OSError:
+				state.append(None)
+		return state
+
+
+	def wait(self, timeout=None):
+		# True if something changed, False if the timeout passed first.
+		if self.fd is not None:
+			readable, _, _ = select.select([self.fd], [], [], timeout)
+			if not readable:
+				return False
+			try:
+				while os.read(self.fd, 65536):
+					pass
+			except BlockingIOError:
+				pass
+			self.refresh()
+			return True
+
+		deadline = None if timeout is None else time.monotonic() + timeout
+		while True:
+			state = self.pollState()
+			if state != self.state:
+				self.state = state
+				self.interval = POLLMIN
+				return True
+			remaining = POLLMAX if deadline is None else deadline - time.monotonic()
+			if remaining <= 0:
+				return False
+			time.sleep(min(self.interval, remaining))
+			self.interval = min(self.interval * 1.5, POLLMAX)
+
+
+def waitForFile(path, until=None):
+	# blocks until path exists. returns False instead if until() becomes true first.
+	path = Path(path)
+	with tracing.span("wait for " + path.name, "wait", path=path), FileWatcher(path) as watcher:
+		while not path.exists():
+			if until is not None and until():
+				return False
+			watcher.wait(SAFETYINTERVAL if until is None else POLLMAX)
+	return True
+
+
+def waitForData(path):
+	# blocks until path exists and is not empty, factorio creates the files it writes a moment before writing them.
+	waitForFile(path)
+	path = Path(path)
+	with FileWatcher(path) as watcher:
+		while path.stat().st_size == 0:
+			watcher.wait(SAFETYINTERVAL)
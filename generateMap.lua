@@ -547,7 +547,7 @@ function fm.generateMap(data)
 	-- todo: if fm.autorun.mapInfo.maps[mapIndex].surfaces[fm.currentSurface.name].hidden is true, only care about the chunks linked to by renderboxes.
 
    
-	local extension = ".png"
+	local extension = fm.autorun.screenshot_extension or ".png"
 
 
 	
@@ -556,6 +556,7 @@ function fm.generateMap(data)
 
 
 	local cropText = ""
+
 	local function capture(positionTable, surface, path)
 		local box = { positionTable[1].x, positionTable[1].y, positionTable[2].x, positionTable[2].y } -- -X -Y X Y
 		local initialBox = { box[1], box[2], box[3], box[4] }
@@ -583,8 +584,9 @@ function fm.generateMap(data)
 			resolution = {(box[3] - box[1])*pixelsPerTile, (box[4] - box[2])*pixelsPerTile},
 			zoom = fm.autorun.mapInfo.options.HD and 2 or 1,
 			path = basePath .. "Images/" .. path,
+			quality = fm.autorun.jpeg_quality,
 			show_entity_info = fm.autorun.alt_mode
-		})                        
+		})
 	end
 
 
@@ -639,7 +641,7 @@ function fm.generateMap(data)
 
 	
 	
-	game.write_file(basePath .. "mapInfo.json", json(fm.autorun.mapInfo), false, data.player_index)
+	game.write_file(basePath .. (fm.autorun.mapinfo_file or "mapInfo.json"), json(fm.autorun.mapInfo), false, data.player_index)
 	game.write_file(subPath .. "crop.txt", "v2" .. cropText, false, data.player_index)
 	
 end
\ No newline at end of file
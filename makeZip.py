@@ -25,6 +25,7 @@ excludeDirs = (
 	".vscode",
 	"__pycache__",
 	"API_ExampleMod_0.0.1",
+	"benchmarks",
 )
 excludeFiles = (
 	".gitignore",
@@ -0,0 +1,189 @@
+import json
+import math
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+
+HISTOGRAMBUCKETS = 16	# per tile latency buckets, bucket i counts tiles that took up to 2**i ms, the last one everything slower.
+WRITEINTERVAL = 5		# seconds between rewrites of the metrics file
+
+
+# worker side. the pool only turns these on in workers that run a task for a step that is measured, everywhere else they
+# cost one global lookup.
+
+enabled = False
+counters = {}
+latencies = [0] * HISTOGRAMBUCKETS
+
+
+def add(name, value):
+	if enabled:
+		counters[name] = counters.get(name, 0) + value
+
+
+def observe(seconds):
+	if enabled:
+		latencies[min(HISTOGRAMBUCKETS - 1, max(0, math.ceil(math.log2(max(seconds * 1000, 1)))))] += 1
+
+
+class measure:
+	# adds the time spent in the block to "<kind>Seconds" and the size of path to bytesRead for decodes or bytesWritten for encodes.
+
+	def __init__(self, kind, path=None):
+		self.kind = kind
+		self.path = path
+
+	def __enter__(self):
+		if enabled:
+			self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, excType, excValue, traceback):
+		if enabled and excType is None:
+			add(self.kind + "Seconds", time.perf_counter() - self.start)
+			if self.path is not None:
+				try:
+					add("bytesRead" if self.kind == "decode" else "bytesWritten", os.path.getsize(self.path))
+				except OSError:
+					pass
+
+
+def runMeasured(func, args, observeTask):
+	# runs one pool task with measuring turned on and returns its result with everything measured while it ran.
+	global enabled
+	enabled = True
+	counters.clear()
+	latencies[:] = [0] * HISTOGRAMBUCKETS
+	start = time.perf_counter()
+	try:
+		result = func(*args)
+		busy = time.perf_counter() - start
+		if observeTask:
+			observe(busy)
+	finally:
+		enabled = False
+	return result, {"tasks": 1, "busySeconds": busy, "counters": dict(counters), "latency": list(latencies)}
+
+
+# main process side.
+
+class Metrics:
+	# collects the samples of all pool tasks per step, snapshot, surface and daytime, and writes them to a json file
+	# and/or serves them on a local http port while the run goes on.
+
+	def __init__(self, path=None, port=None):
+		self.path = Path(path) if path else None
+		self.lock = threading.Lock()
+		self.started = time.time()
+		self.units = {}
+		self.saves = {}
+		self.lastWrite = 0
+		self.writeLock = threading.Lock()
+		self.server = None
+		if port:
+			self.serve(port)
+
+	def unit(self, key):
+		# key is (step, snapshot, surface, daytime)
+		name = "/".join(str(part) for part in key if part is not None)
+		if name not in self.units:
+			self.units[name] = {
+				"step": key[0],
+				"snapshot": key[1],
+				"surface": key[2] if len(key) > 2 else None,
+				"daytime": key[3] if len(key) > 3 else None,
+				"tasks": 0,
+				"busySeconds": 0.0,
+				"wallSeconds": 0.0,
+				"threads": 0,
+				"counters": {},
+				"latency": [0] * HISTOGRAMBUCKETS,
+			}
+		return self.units[name]
+
+	def nameSave(self, snapshot, savename):
+		with self.lock:
+			self.saves[str(snapshot)] = savename
+
+	def merge(self, key, sample):
+		with self.lock:
+			unit = self.unit(key)
+			unit["tasks"] += sample["tasks"]
+			unit["busySeconds"] += sample["busySeconds"]
+			for name, value in sample["counters"].items():
+				unit["counters"][name] = unit["counters"].get(name, 0) + value
+			unit["latency"] = [a + b for a, b in zip(unit["latency"], sample["latency"])]
+		self.maybeWrite()
+
+	def add(self, key, name, value):
+		with self.lock:
+			counters = self.unit(key)["counters"]
+			counters[name] = counters.get(name, 0) + value
+
+	def addWall(self, key, seconds, threads):
+		with self.lock:
+			unit = self.unit(key)
+			unit["wallSeconds"] += seconds
+			unit["threads"] = max(unit["threads"], threads)
+
+
+	def report(self):
+		with self.lock:
+			units = []
+			for unit in self.units.values():
+				unit = dict(unit, counters=dict(unit["counters"]))
+				unit["save"] = self.saves.get(str(unit["snapshot"]))
+				if unit["wallSeconds"] and unit["threads"]:
+					unit["utilisation"] = unit["busySeconds"] / (unit["wallSeconds"] * unit["threads"])
+				tiles = sum(unit["latency"])
+				if tiles and unit["wallSeconds"]:
+					unit["tilesPerSecond"] = tiles / unit["wallSeconds"]
+				units.append(unit)
+			return {
+				"started": self.started,
+				"elapsedSeconds": time.time() - self.started,
+				"latencyBucketsMs": [2 ** i for i in range(HISTOGRAMBUCKETS - 1)] + [None],
+				"units": units,
+			}
+
+	def write(self):
+		if self.path is None:
+			return
+		with self.writeLock:
+			tmpPath = self.path.with_name(self.path.name + ".tmp")
+			with tmpPath.open("w", encoding="utf-8") as f:
+				json.dump(self.report(), f, indent=1)
+			os.replace(tmpPath, self.path)
+			self.lastWrite = time.monotonic()
+
+	def maybeWrite(self):
+		if self.path is not None and time.monotonic() - self.lastWrite > WRITEINTERVAL:
+			self.write()
+
+
+	def serve(self, port):
+		metrics = self
+		class Handler(BaseHTTPRequestHandler):
+			def do_GET(self):
+				body = json.dumps(metrics.report()).encode("utf-8")
+				self.send_response(200)
+				self.send_header("Content-Type", "application/json")
+				self.send_header("Content-Length", str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+			def log_message(self, *args):
+				pass
+		self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+		thread = threading.Thread(target=self.server.serve_forever)
+		thread.daemon = True
+		thread.start()
+
+	def close(self):
+		self.write()
+		if self.server is not None:
+			self.server.shutdown()
+			self.server.server_close()
+			self.server = None
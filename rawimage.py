@@ -0,0 +1,151 @@
+import os
+import struct
+import threading
+from pathlib import Path
+
+import numpy
+from PIL import Image
+from turbojpeg import TJPF_RGB, TJSAMP_420, TJSAMP_422, TJSAMP_440, TJSAMP_444, TJSAMP_GRAY, tjMCUHeight, tjMCUWidth
+
+from encoders import jpeg
+from signature import SCALE, signature
+
+
+# with --screenshotformat=bmp factorio saves its screenshots as uncompressed bmp. they are never decoded: crop only records
+# the part of every screenshot that is kept in windows.txt next to crop.txt, everything that reads a screenshot maps the
+# pixels straight from the file and cuts that part out. zoom writes its unfinished tiles as bmp as well.
+# with --screenshotformat=jpeg crop cuts the screenshots without decoding them where the jpeg blocks allow it, and zoom
+# keeps them as the finished max zoom tiles when those are jpg of the same quality.
+
+PNGEXT = ".png"
+RAWEXT = ".bmp"
+JPEGEXT = ".jpeg"		# not .jpg, that is what the finished tiles are called
+SCREENSHOTEXTS = {"png": PNGEXT, "bmp": RAWEXT, "jpeg": JPEGEXT}
+JPEGQUALITY = 95		# jpeg screenshots that zoom encodes again anyway, the max zoom tiles are not jpg
+WINDOWFILE = "windows.txt"
+
+# the smallest fraction libjpeg-turbo decodes a jpeg at, by chroma subsampling, that still looks like the full image made
+# smaller. 4:2:0 chroma would be 1/16 at 1/8 size, 4:2:2 and 4:4:0 come out with the wrong colours below 1/2.
+JPEGSCALES = {TJSAMP_444: 8, TJSAMP_GRAY: 8, TJSAMP_420: 4, TJSAMP_422: 2, TJSAMP_440: 2}
+
+windows = {}			# folder: (stat of its windows.txt, {name: box})
+windowLock = threading.Lock()
+
+
+def screenshotExt(args):
+	return SCREENSHOTEXTS[args.screenshotformat]
+
+
+def unfinishedExt(args):
+	# the intermediate tiles zoom writes between two of its tasks, never jpeg.
+	return RAWEXT if args.screenshotformat == "bmp" else PNGEXT
+
+
+def jpegQuality(profile):
+	# the quality factorio saves jpeg screenshots with, that of the max zoom tiles when they are jpg so zoom can keep them.
+	name, quality = profile[0]
+	return quality if name == "jpg" else JPEGQUALITY
+
+
+def isComplete(path):
+	# factorio writes the header first, the file is done once it is as long as the header says.
+	with open(path, "rb") as f:
+		header = f.read(6)
+		f.seek(0, os.SEEK_END)
+		return len(header) == 6 and header[:2] == b"BM" and f.tell() >= struct.unpack_from("<I", header, 2)[0]
+
+
+def isCompleteJpeg(data):
+	return data[:2] == b"\xff\xd8" and data[-2:] == b"\xff\xd9"
+
+
+def cropJpeg(data, box, quality):
+	# lossless when the box starts on a block boundary and does not need the partial blocks at the right or bottom edge,
+	# otherwise the part is decoded and encoded again.
+	width, height, subsample, _ = jpeg.decode_header(data)
+	blockWidth, blockHeight = tjMCUWidth[subsample], tjMCUHeight[subsample]
+	if box[0] % blockWidth == 0 and box[1] % blockHeight == 0 and box[2] <= width - width % blockWidth and box[3] <= height - height % blockHeight:
+		return jpeg.crop(data, box[0], box[1], box[2] - box[0], box[3] - box[1])
+	return jpeg.encode(jpeg.decode(data)[box[1]:box[3], box[0]:box[2]].copy(), quality=quality, jpeg_subsample=subsample)
+
+
+def decodeJpeg(path, scale=1):
+	# decodes at up to 1/scale of the size straight from the dct coefficients, returns the image and the scale it got.
+	with open(path, "rb") as f:
+		data = f.read()
+	scale = min(scale, JPEGSCALES.get(jpeg.decode_header(data)[2], 1))
+	return Image.fromarray(jpeg.decode(data, pixel_format=TJPF_RGB, scaling_factor=(1, scale))), scale
+
+
+def screenshotSignature(path):
+	# jpeg screenshots are signed from a smaller decode. zoom and ref both sign new screenshots with this, so the
+	# signatures they compare are made the same way.
+	if Path(path).suffix == JPEGEXT:
+		img, scale = decodeJpeg(path, SCALE)
+		return numpy.asarray(img.reduce(SCALE // scale))
+	return signature(openImage(path).convert("RGB"))
+
+
+def mapPixels(path):
+	# (height, width, 3) RGB view of the pixels of an uncompressed 24 or 32 bit bmp, nothing is read until it is used.
+	data = numpy.memmap(path, dtype=numpy.uint8, mode="r")
+	offset, = struct.unpack_from("<I", data, 10)
+	width, height, _, bits, compression = struct.unpack_from("<iiHHI", data, 18)
+	if bits not in (24, 32) or compression not in (0, 3):
+		raise ValueError(f"{path} is not an uncompressed 24 or 32 bit bmp")
+	channels = bits // 8
+	stride = (width * channels + 3) & ~3
+	pixels = numpy.ndarray((abs(height), width, channels), numpy.uint8, data, offset, (stride, channels, 1))
+	if height > 0:	# rows are stored bottom up
+		pixels = pixels[::-1]
+	return pixels[:, :, 2::-1]
+
+
+def readWindows(folder):
+	# {name: (left, top, right, bottom)} for the screenshots of a <snapshot>/<surface>/<daytime> folder that crop cut down.
+	path = Path(folder, WINDOWFILE)
+	try:
+		stat = path.stat()
+	except FileNotFoundError:
+		return {}
+	key = (stat.st_mtime_ns, stat.st_size)
+	if folder not in windows or windows[folder][0] != key:
+		boxes = {}
+		with path.open("r", encoding="utf-8") as f:
+			for line in f:
+				split = line.rstrip("\n").split(" ", 4)
+				if len(split) == 5:
+					boxes[split[4]] = tuple(map(int, split[:4]))
+		windows[folder] = (key, boxes)
+	return windows[folder][1]
+
+
+def addWindows(entries):
+	# entries are (path, box) for screenshots at <snapshot>/<surface>/<daytime>/<z>/<x>/<y> or .../renderboxes/<z>/<name>
+	folders = {}
+	for path, box in entries:
+		path = Path(path)
+		folders.setdefault(path.parents[2], []).append(f"{box[0]} {box[1]} {box[2]} {box[3]} {path.relative_to(path.parents[2]).as_posix()}\n")
+	with windowLock:
+		for folder, lines in folders.items():
+			with Path(folder, WINDOWFILE).open("a", encoding="utf-8") as f:
+				f.writelines(lines)
+
+
+def screenshotPixels(path):
+	path = Path(path)
+	pixels = mapPixels(path)
+	box = readWindows(path.parents[2]).get(path.relative_to(path.parents[2]).as_posix())
+	if box is not None:
+		pixels = pixels[box[1]:box[3], box[0]:box[2]]
+	return pixels
+
+
+def openImage(path):
+	# screenshots and unfinished tiles of any format, bmp screenshots cut down to what crop kept.
+	path = Path(path)
+	if path.suffix == JPEGEXT:
+		return decodeJpeg(path)[0]
+	if path.suffix != RAWEXT:
+		return Image.open(path, mode="r")
+	return Image.fromarray(numpy.ascontiguousarray(screenshotPixels(path)))
@@ -2,21 +2,34 @@ from argparse import Namespace
 import os, sys, math, time, json, psutil
 from pathlib import Path
 from PIL import Image, ImageChops, ImageStat
-import multiprocessing as mp
 from functools import partial
 from shutil import get_terminal_size as tsize
 import traceback
 
+import numpy
+from turbojpeg import TJFLAG_FASTUPSAMPLE, TJPF_RGB
 
+import tilestore
+import tracing
+from catalog import TileCatalog, readCropFile
+from checkpoint import openCheckpoint
+from metrics import measure
+from rawimage import JPEGEXT, PNGEXT, screenshotExt, screenshotSignature, openImage as openScreenshot
+from signature import SCALE, loadSignature, readIndex
+from workerpool import WorkerPool
+from encoders import finalPath, jpeg
 
-ext = ".png"
-outext = ".jpg"
+
+
+outext = ".jpg"		# renderboxes, and the keys of old tiles. the old tiles themselves are in the format zoom recorded for them.
 
 
 
 def test(paths):
-	newImg = Image.open(paths[0], mode='r').convert("RGB")
-	oldImg = Image.open(paths[1], mode='r').convert("RGB")
+	with measure("decode", paths[0]):
+		newImg = openScreenshot(paths[0]).convert("RGB")
+	with measure("decode", paths[1]):
+		oldImg = tilestore.openImage(paths[1]).convert("RGB")
 	treshold = .03 * newImg.size[0]**2
 	# jpeg artifacts always average out perfectly over 8x8 sections, we take advantage of that and scale down by 8 so we can compare compressed images with uncompressed images.
 	size = (newImg.size[0] / 8, newImg.size[0] / 8)
@@ -26,31 +39,92 @@ def test(paths):
 	return sum(ImageStat.Stat(diff).sum2) > treshold
 
 
-def compare(path, basePath, new, progressQueue):
+def scaledTest(paths):
+	# same test, but libjpeg-turbo decodes the old jpeg at 1/4 size straight from its DCT coefficients and both sides are box averaged down to 1/8.
+	# 1/8 would drop the 4:2:0 chroma to 1/16 and make every colourful tile look changed. only pays off when the new
+	# screenshot is cheap to decode, a png takes several times longer than the old jpeg. the artifacts of a jpeg
+	# screenshot come on top of the scaling error and push unchanged tiles over the treshold.
+	if Path(paths[0]).suffix == JPEGEXT:
+		return test(paths)
+	with measure("decode", paths[0]):
+		newImg = openScreenshot(paths[0]).convert("RGB")
+	treshold = .03 * newImg.size[0]**2
+	with measure("decode", paths[1]):
+		oldImg = jpeg.decode(tilestore.read(paths[1]), pixel_format=TJPF_RGB, scaling_factor=(1, 4), flags=TJFLAG_FASTUPSAMPLE)
+	if oldImg.shape[:2] != (newImg.size[1] // 4, newImg.size[0] // 4) or newImg.size[0] % 8 or newImg.size[1] % 8:
+		return test(paths)
+	old = numpy.asarray(oldImg, dtype=numpy.float32)
+	old = (old[0::2, 0::2] + old[0::2, 1::2] + old[1::2, 0::2] + old[1::2, 1::2]) / 4
+	return float(numpy.square(numpy.asarray(newImg.reduce(8), dtype=numpy.float32) - old).sum()) > treshold
+
+
+def signatureTest(paths, location):
+	# compares with the signature zoom stored when the old image was written, so the old image is not opened at all.
+	# jpeg screenshots are signed from a smaller decode, the same way zoom signed the old one.
+	with measure("decode", paths[0]):
+		newSignature = screenshotSignature(paths[0])
+	treshold = .03 * (newSignature.shape[1] * SCALE)**2
+	oldSignature = loadSignature(location)
+	if newSignature.shape != oldSignature.shape:
+		return test(paths)
+	diff = newSignature.astype(numpy.int32) - oldSignature
+	return int(numpy.square(diff).sum()) > treshold
+
+
+def signatureLocator(basePath):
+	# finds the stored signature of an old image, every sidecar index is only read once.
+	sidecars = {}
+	def locate(snapshot, surfaceName, daytime, key):
+		folder = os.path.join(basePath, snapshot, surfaceName, daytime)
+		if folder not in sidecars:
+			sidecars[folder] = readIndex(folder)
+		return sidecars[folder].get(key)
+	return locate
+
+
+def compare(item, basePath, new, progress, mode="signature"):
+	# location is None for tiles without a stored signature, and for all tiles in the exact mode.
+	path, location = item
 	testResult = False
 	try:
-		testResult = test((os.path.join(basePath, new, *path[1:]), os.path.join(basePath, *path).replace(ext, outext)))
+		paths = (os.path.join(basePath, new, *path[1:]), str(finalPath(os.path.join(basePath, *path))))
+		if location is not None:
+			testResult = signatureTest(paths, location)
+		else:
+			testResult = scaledTest(paths) if mode == "scaled" and paths[1].endswith(".jpg") else test(paths)
 	except:
 		print("\r")
 		traceback.print_exc()
 		print("\n")
 		raise
 	finally:
-		progressQueue.put(True, True)
+		progress.add()
 	return (testResult, path[1:])
 
-def compareRenderbox(renderbox, basePath, new):
+def compareRenderbox(renderbox, basePath, new, ext=PNGEXT):
 	newPath = os.path.join(basePath, new, renderbox[0]) + ext
 	testResult = False
 	try:
-		testResult = test((newPath, os.path.join(basePath, renderbox[1], renderbox[0]) + outext))
+		paths = (newPath, os.path.join(basePath, renderbox[1], renderbox[0]) + outext)
+		testResult = test(paths) if renderbox[3] is None else signatureTest(paths, renderbox[3])
 	except:
 		print("\r")
 		raise
 	return (testResult, newPath, renderbox[1], renderbox[2])
 
 
-def neighbourScan(coord, keepList, cropList):
+NEIGHBOURMASKS = (
+	( 1,  1, 0b1000),
+	( 1, -1, 0b0100),
+	(-1,  1, 0b0010),
+	(-1, -1, 0b0001),
+	( 1,  0, 0b1100),
+	(-1,  0, 0b0011),
+	( 0,  1, 0b1010),
+	( 0, -1, 0b0101),
+)
+
+def neighbourScan(removeList, keepList, cropList, ext=PNGEXT):
 		"""
 		x+ = UP, y+ = RIGHT
 		corners:
@@ -58,16 +132,37 @@ def neighbourScan(coord, keepList, cropList):
 		X
 		4   3
 		"""
-		surfaceName, daytime, z = coord[:3]
-		x, y = int(coord[3]), int(os.path.splitext(coord[4])[0])
-		return (((surfaceName, daytime, z, str(x+1), str(y+1) + ext) in keepList and cropList.get((surfaceName, daytime, z, x+1, y+1), 0) & 0b1000) \
-			 or ((surfaceName, daytime, z, str(x+1), str(y-1) + ext) in keepList and cropList.get((surfaceName, daytime, z, x+1, y-1), 0) & 0b0100) \
-			 or ((surfaceName, daytime, z, str(x-1), str(y+1) + ext) in keepList and cropList.get((surfaceName, daytime, z, x-1, y+1), 0) & 0b0010) \
-			 or ((surfaceName, daytime, z, str(x-1), str(y-1) + ext) in keepList and cropList.get((surfaceName, daytime, z, x-1, y-1), 0) & 0b0001) \
-			 or ((surfaceName, daytime, z, str(x+1), str(y  ) + ext) in keepList and cropList.get((surfaceName, daytime, z, x+1, y  ), 0) & 0b1100) \
-			 or ((surfaceName, daytime, z, str(x-1), str(y  ) + ext) in keepList and cropList.get((surfaceName, daytime, z, x-1, y  ), 0) & 0b0011) \
-			 or ((surfaceName, daytime, z, str(x  ), str(y+1) + ext) in keepList and cropList.get((surfaceName, daytime, z, x  , y+1), 0) & 0b1010) \
-			 or ((surfaceName, daytime, z, str(x  ), str(y-1) + ext) in keepList and cropList.get((surfaceName, daytime, z, x  , y-1), 0) & 0b0101), coord)
+		# for every coord in removeList, is there a kept neighbour that was cropped towards it?
+		result = [False] * len(removeList)
+		layers = {}
+		for i, coord in enumerate(removeList):
+			layers.setdefault(coord[:3], ([], []))[0].append((i, int(coord[3]), int(os.path.splitext(coord[4])[0])))
+		for coord in keepList:
+			if coord[:3] in layers:
+				x, y = int(coord[3]), int(os.path.splitext(coord[4])[0])
+				if coord[3] == str(x) and coord[4] == str(y) + ext:
+					layers[coord[:3]][1].append((x, y))
+
+		for layer, (removeCoords, keepCoords) in layers.items():
+			if len(keepCoords) == 0:
+				continue
+			minX = min(min(x for _, x, _ in removeCoords), min(x for x, _ in keepCoords)) - 1
+			maxX = max(max(x for _, x, _ in removeCoords), max(x for x, _ in keepCoords)) + 1
+			minY = min(min(y for _, _, y in removeCoords), min(y for _, y in keepCoords)) - 1
+			maxY = max(max(y for _, _, y in removeCoords), max(y for _, y in keepCoords)) + 1
+
+			cropped = numpy.zeros((maxX - minX + 1, maxY - minY + 1), dtype=numpy.uint8)
+			for x, y in keepCoords:
+				cropped[x - minX, y - minY] = cropList.get((*layer, x, y), 0) & 0b1111
+
+			found = numpy.zeros(cropped.shape, dtype=bool)
+			w, h = cropped.shape
+			for dx, dy, mask in NEIGHBOURMASKS:
+				found[1:w-1, 1:h-1] |= (cropped[1+dx:w-1+dx, 1+dy:h-1+dy] & mask) != 0
+
+			for i, x, y in removeCoords:
+				result[i] = bool(found[x - minX, y - minY])
+		return result
 
 
 
@@ -103,6 +198,7 @@ def ref(
 	daytimeReference: str = None,
 	basepath: Path = None,
 	args: Namespace = Namespace(),
+	pool: WorkerPool = None,
 ):
 
 	psutil.Process(os.getpid()).nice(psutil.BELOW_NORMAL_PRIORITY_CLASS if os.name == 'nt' else 10)
@@ -111,10 +207,12 @@ def ref(
 	topPath = Path(workFolder, outFolder)
 	dataPath = Path(topPath, "mapInfo.json")
 	maxthreads = args.refthreads if args.refthreads else args.maxthreads
+	ext = screenshotExt(args)
 
-
-
-	pool = mp.Pool(processes=maxthreads)
+	if pool is None:
+		with WorkerPool(maxthreads) as pool:
+			return ref(outFolder, timestamp, surfaceReference, daytimeReference, basepath, args, pool)
+	stage = pool.stage(maxthreads, ("ref", timestamp, surfaceReference, daytimeReference))
 
 	with open(dataPath, "r", encoding="utf-8") as f:
 		data = json.load(f)
@@ -144,6 +242,8 @@ def ref(
 
 
 	newMap = data["maps"][new]
+	catalog = TileCatalog(topPath)
+	checkpoint = openCheckpoint(topPath)
 	allImageIndex = {}
 	allDayImages = {}
 
@@ -161,7 +261,7 @@ def ref(
 					z = surface["zoom"]["max"]
 
 
-					dayImages = []
+					dayImages = set()
 
 					newComparedSurfaces.append((surfaceName, daytime))
 
@@ -172,40 +272,37 @@ def ref(
 
 
 					def readCropList(path, combinePrevious):
-						with open(path, "r", encoding="utf-8") as f:
-							version = 2 if f.readline().rstrip('\n') == "v2" else 1
-							for line in f:
-								if version == 1:
-									split = line.rstrip("\n").split(" ", 5)
-									key = (surfaceName, daytime, str(z), int(split[0]), int(os.path.splitext(split[1])[0]))
-									value = split[4]
-								else:
-									split = line.rstrip("\n").split(" ", 5)
-									pathSplit = split[5].split("/", 5)
-									if pathSplit[3] != str(z):
-										continue
-									#(surfaceName, daytime, z, str(x+1), str(y+1) + ext)
-									key = (surfaceName, daytime, str(z), int(pathSplit[4]), int(os.path.splitext(pathSplit[5])[0]))
-									value = split[2]
-
-								cropList[key] = int(value, 16) | cropList.get(key, 0) if combinePrevious else int(value, 16)
-
-					for old in oldMapsList:
-						readCropList(os.path.join(topPath, "Images", data["maps"][old]["path"], surfaceName, daytime, "crop.txt"), False)
+						for cropZ, x, y, value in readCropFile(path, z):
+							if cropZ != z:
+								continue
+							#(surfaceName, daytime, z, str(x+1), str(y+1) + ext)
+							key = (surfaceName, daytime, str(z), x, y)
+							cropList[key] = value | cropList.get(key, 0) if combinePrevious else value
+
+					catalog.index(topPath, data["maps"], new, surfaceName, daytime)
+					oldCrops = catalog.crops(surfaceName, daytime, z, new)
+					if oldCrops is None:
+						for old in oldMapsList:
+							readCropList(os.path.join(topPath, "Images", data["maps"][old]["path"], surfaceName, daytime, "crop.txt"), False)
+					else:
+						for (x, y), value in oldCrops.items():
+							cropList[(surfaceName, daytime, str(z), x, y)] = value
 
 					readCropList(os.path.join(topPath, "Images", newMap["path"], surfaceName, daytime, "crop.txt"), True)
 
 
 
 					oldImages = {}
-					for old in oldMapsList:
-						if surfaceName in data["maps"][old]["surfaces"] and daytime in surface and z == surface["zoom"]["max"]:
-							if surfaceName not in allImageIndex:
-								allImageIndex[surfaceName] = {}
-							path = os.path.join(topPath, "Images", data["maps"][old]["path"], surfaceName, daytime, str(z))
-							for x in os.listdir(path):
-								for y in os.listdir(os.path.join(path, x)):
-									oldImages[(x, y.replace(ext, outext))] = data["maps"][old]["path"]
+					if len(oldMapsList) > 0 and surfaceName not in allImageIndex:
+						allImageIndex[surfaceName] = {}
+					oldTiles = catalog.tiles(surfaceName, daytime, z, new)
+					if oldTiles is None:
+						for old in oldMapsList:
+							for _, x, y, _ in tilestore.listTiles(os.path.join(topPath, "Images", data["maps"][old]["path"], surfaceName, daytime), z):
+								oldImages[(str(x), str(y) + outext)] = data["maps"][old]["path"]
+					else:
+						for (x, y), snapshot in oldTiles.items():
+							oldImages[(str(x), str(y) + outext)] = snapshot
 
 					if daytime != "day":
 						if not os.path.isfile(os.path.join(topPath, "Images", newMap["path"], surfaceName, "day", "ref.txt")):
@@ -215,7 +312,7 @@ def ref(
 
 							with Path(topPath, "Images", newMap["path"], surfaceName, "day", "ref.txt").open("r", encoding="utf-8") as f:
 								for line in f:
-									dayImages.append(tuple(line.rstrip("\n").split(" ", 2)))
+									dayImages.add(tuple(line.rstrip("\n").split(" ", 2)))
 
 
 						allDayImages[surfaceName] = dayImages
@@ -241,19 +338,17 @@ def ref(
 		if args.verbose: print("found %s new images" % len(keepList))
 		if len(compareList) > 0:
 			if args.verbose: print("comparing %s existing images" % len(compareList))
-			m = mp.Manager()
-			progressQueue = m.Queue()
-			#compare(compareList[0], treshold=treshold, basePath=os.path.join(topPath, "Images"), new=str(newMap["path"]), progressQueue=progressQueue)
-			workers = pool.map_async(partial(compare, basePath=os.path.join(topPath, "Images"), new=str(newMap["path"]), progressQueue=progressQueue), compareList, 128)
-			doneSize = 0
-			print("ref  {:5.1f}% [{}]".format(0, " " * (tsize()[0]-15)), end="")
-			for i in range(len(compareList)):
-				progressQueue.get(True)
-				doneSize += 1
+			locate = signatureLocator(os.path.join(topPath, "Images"))
+			compareWork = [(path, None if args.refmode == "exact" else locate(*path[:3], "%s/%s/%s" % (path[3], path[4], os.path.splitext(path[5])[0]))) for path in compareList]
+			def show(doneSize):
 				progress = float(doneSize) / len(compareList)
 				tsiz = tsize()[0]-15
 				print("\rref  {:5.1f}% [{}{}]".format(round(progress * 100, 1), "=" * int(progress * tsiz), " " * (tsiz - int(progress * tsiz))), end="")
-			workers.wait()
+			print("ref  {:5.1f}% [{}]".format(0, " " * (tsize()[0]-15)), end="")
+			with pool.progress() as progress:
+				#compare(compareWork[0], treshold=treshold, basePath=os.path.join(topPath, "Images"), new=str(newMap["path"]), progress=progress)
+				workers = stage.map_async(partial(compare, basePath=os.path.join(topPath, "Images"), new=str(newMap["path"]), progress=progress, mode=args.refmode), compareWork, 128)
+				progress.follow(workers, show)
 			resultList = workers.get()
 
 			newList = [x[1] for x in [x for x in resultList if x[0]]]
@@ -264,9 +359,10 @@ def ref(
 
 
 		if args.verbose: print("scanning %s chunks for neighbour cropping" % len(firstRemoveList))
-		resultList = pool.map(partial(neighbourScan, keepList=keepList, cropList=cropList), firstRemoveList, 64)
-		neighbourList = [x[1] for x in [x for x in resultList if x[0]]]
-		removeList = [x[1] for x in [x for x in resultList if not x[0]]]
+		with tracing.span("neighbour scan", "ref", chunks=len(firstRemoveList)):
+			resultList = neighbourScan(firstRemoveList, keepList, cropList, ext)
+		neighbourList = [coord for coord, isNeighbour in zip(firstRemoveList, resultList) if isNeighbour]
+		removeList = [coord for coord, isNeighbour in zip(firstRemoveList, resultList) if not isNeighbour]
 		if args.verbose: print("keeping %s neighbouring images" % len(neighbourList))
 
 
@@ -287,6 +383,12 @@ def ref(
 						if coord[0] == surfaceName and coord[1] == daytime and coord[2] == str(z):
 							f.write("%s %s\n" % (coord[3], os.path.splitext(coord[4])[0]))
 
+		for surfaceName, daytime in newComparedSurfaces:
+			z = newMap["surfaces"][surfaceName]["zoom"]["max"]
+			catalog.markSnapshot(new, str(newMap["path"]), surfaceName, daytime)
+			catalog.addTiles(new, str(newMap["path"]), surfaceName, daytime, z, [(int(coord[3]), int(os.path.splitext(coord[4])[0])) for aList in (keepList, neighbourList) for coord in aList if coord[:3] == (surfaceName, daytime, str(z))])
+			catalog.addCrops(new, surfaceName, daytime, readCropFile(os.path.join(topPath, "Images", newMap["path"], surfaceName, daytime, "crop.txt"), z))
+
 
 
 
@@ -347,13 +449,25 @@ def ref(
 										compareList[path] = (path, oldPath, linksByPath[path])
 
 
-			compareList = compareList.values()
-			resultList = pool.map(partial(compareRenderbox, basePath=os.path.join(topPath, "Images"), new=str(newMap["path"])), compareList, 16)
+			locate = signatureLocator(os.path.join(topPath, "Images"))
+			renderboxes = compareList.values()
+			compareList = []
+			for (path, oldPath, links) in renderboxes:
+				parts = Path(path).parts
+				compareList.append((path, oldPath, links, None if args.refmode == "exact" else locate(oldPath, parts[0], parts[1], "/".join(parts[2:]))))
+			# removing the unchanged renderboxes can be interrupted, the checkpoint keeps the results so they are not compared again.
+			compared = checkpoint.get("renderboxes", str(newMap["path"])).get("compared", {})
+			remaining = [renderbox for renderbox in compareList if renderbox[0] not in compared]
+			for renderbox, result in zip(remaining, stage.map(partial(compareRenderbox, basePath=os.path.join(topPath, "Images"), new=str(newMap["path"]), ext=ext), remaining, 16)):
+				compared[renderbox[0]] = bool(result[0])
+			checkpoint.update("renderboxes", str(newMap["path"]), compared=compared)
 
 			count = 0
-			for (isDifferent, path, oldPath, links) in resultList:
-				if not isDifferent:
-					os.remove(path)
+			for (path, oldPath, links, location) in compareList:
+				if not compared[path]:
+					newPath = os.path.join(topPath, "Images", str(newMap["path"]), path) + ext
+					if os.path.exists(newPath):
+						os.remove(newPath)
 
 					for (surfaceName, linkIndex) in links:
 						outdata["maps"][str(new)]["surfaces"][surfaceName]["links"][linkIndex] = { "path": oldPath }
@@ -403,6 +517,8 @@ def ref(
 
 
 
+	catalog.close()
+
 	if changed:
 		if args.verbose: print("writing mapInfo.out.json")
 		with outFile.open("w+", encoding="utf-8") as f:
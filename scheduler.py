@@ -0,0 +1,103 @@
+import threading
+
+import tracing
+
+
+STAGESHARE = 2		# steps that may use every worker, like crop, ref and zoom by default, that run at the same time
+
+
+def stageCpu(threads):
+	# the cpu a step job reserves. its Stage may still run threads tasks, the jobs that run at the same time share the
+	# pool, so one that is down to its last few tasks does not keep the others from starting.
+	return max(1, threads // STAGESHARE)
+
+
+class Job:
+
+	def __init__(self, name, func, after, cpu, memory, resources):
+		self.name = name
+		self.func = func
+		self.after = [job for job in after if job is not None]
+		self.cpu = cpu
+		self.memory = memory
+		self.resources = set(resources)
+		self.started = False
+		self.done = False
+
+
+class Scheduler:
+	# runs a graph of jobs, every job starts in its own thread as soon as the jobs it comes after are done. jobs are started
+	# in the order they were added while their cpu and memory fit in the budget, the actual work is spread over the shared
+	# WorkerPool anyway, see stageCpu. jobs that need the same resource (like a file they rewrite) never run at
+	# the same time. jobs may add more jobs while the scheduler is running.
+
+	def __init__(self, cpu, memory):
+		self.cpu = cpu
+		self.memory = memory
+		self.jobs = []
+		self.condition = threading.Condition()
+		self.cpuUsed = 0
+		self.memoryUsed = 0
+		self.resources = set()
+		self.running = 0
+		self.error = None
+
+	def add(self, name, func, after=(), cpu=1, memory=0, resources=()):
+		job = Job(name, func, after, cpu, memory, resources)
+		with self.condition:
+			self.jobs.append(job)
+			self.condition.notify_all()
+		return job
+
+
+	def ready(self, job):
+		return not job.started and all(dep.done for dep in job.after) and not job.resources & self.resources
+
+	def fits(self, job):
+		# a job may always start if nothing else runs, otherwise it could never start at all.
+		return self.running == 0 or (self.cpuUsed + job.cpu <= self.cpu and self.memoryUsed + job.memory <= self.memory)
+
+	def start(self, job):
+		job.started = True
+		self.cpuUsed += job.cpu
+		self.memoryUsed += job.memory
+		self.resources |= job.resources
+		self.running += 1
+		thread = threading.Thread(target=self.execute, args=(job,), name=job.name)
+		thread.daemon = True
+		thread.start()
+
+	def execute(self, job):
+		try:
+			with tracing.span(job.name, "job"):
+				job.func()
+		except BaseException as e:
+			with self.condition:
+				if self.error is None:
+					self.error = e
+		else:
+			job.done = True
+		finally:
+			with self.condition:
+				self.cpuUsed -= job.cpu
+				self.memoryUsed -= job.memory
+				self.resources -= job.resources
+				self.running -= 1
+				self.condition.notify_all()
+
+
+	def run(self):
+		# blocks until every job is done, raises the first exception a job raised.
+		with self.condition:
+			while True:
+				if self.error is not None:
+					raise self.error
+				for job in self.jobs:
+					if self.ready(job) and self.fits(job):
+						self.start(job)
+				if self.running == 0:
+					if all(job.done for job in self.jobs):
+						return
+					raise Exception("jobs can never start: " + ", ".join(job.name for job in self.jobs if not job.done))
+				# wake up regularly so KeyboardInterrupt still works on windows.
+				self.condition.wait(1)
@@ -0,0 +1,58 @@
+import os
+import struct
+from pathlib import Path
+
+import numpy
+
+
+SIGNATUREFILE = "signatures.bin"
+MAGIC = b"FMSIG1\n"
+SCALE = 8
+
+
+def signature(img):
+	# 1/8 scale box average, jpeg artifacts average out over 8x8 blocks so this is what ref compares tiles by anyway.
+	return numpy.asarray(img.reduce(SCALE))
+
+
+def appendSignatures(folder, signatures):
+	# signatures is a list of (key, array), a key that is written twice is read back as its last value.
+	if not signatures:
+		return
+	with Path(folder, SIGNATUREFILE).open("ab") as f:
+		if f.tell() == 0:
+			f.write(MAGIC)
+		for key, array in signatures:
+			keyBytes = key.encode("utf-8")
+			f.write(struct.pack("<HHH", len(keyBytes), array.shape[0], array.shape[1]))
+			f.write(keyBytes)
+			f.write(numpy.ascontiguousarray(array, dtype=numpy.uint8).tobytes())
+
+
+def readIndex(folder):
+	# {key: (path, offset, shape)} without reading the signatures themselves.
+	path = Path(folder, SIGNATUREFILE)
+	index = {}
+	if not path.is_file():
+		return index
+	with path.open("rb") as f:
+		if f.read(len(MAGIC)) != MAGIC:
+			return index
+		fileSize = os.fstat(f.fileno()).st_size
+		while True:
+			header = f.read(6)
+			if len(header) < 6:
+				break
+			keyLength, h, w = struct.unpack("<HHH", header)
+			key = f.read(keyLength).decode("utf-8", errors="replace")
+			offset = f.tell()
+			if offset + h * w * 3 > fileSize:
+				break
+			index[key] = (str(path), offset, (h, w, 3))
+			f.seek(h * w * 3, os.SEEK_CUR)
+	return index
+
+
+def loadSignature(location):
+	path, offset, shape = location
+	return numpy.fromfile(path, dtype=numpy.uint8, count=shape[0] * shape[1] * shape[2], offset=offset).reshape(shape)
@@ -0,0 +1,50 @@
+from pathlib import Path
+
+import numpy
+import pytest
+from PIL import Image
+
+import zoom
+
+
+KINDS = ("same", "noise", "entity", "building", "tint")
+
+
+def randomTile(rng, size):
+	base = rng.integers(0, 256, (size // 16, size // 16, 3), dtype=numpy.uint8)
+	return Image.fromarray(base).resize((size, size), Image.BILINEAR)
+
+
+def changed(img, rng, kind):
+	# the new screenshot of a tile: unchanged, jpeg-like noise, or a small, large or tinted change.
+	array = numpy.array(img)
+	size = array.shape[0]
+	if kind == "noise":
+		array = numpy.clip(array.astype(numpy.int16) + rng.integers(-3, 4, array.shape), 0, 255).astype(numpy.uint8)
+	elif kind == "entity":
+		x, y = rng.integers(0, size - 32, 2)
+		array[y:y+32, x:x+32] = rng.integers(0, 256, 3)
+	elif kind == "building":
+		x, y = rng.integers(0, size // 2, 2)
+		array[y:y+size//4, x:x+size//4] = rng.integers(0, 256, 3)
+	elif kind == "tint":
+		array = numpy.clip(array.astype(numpy.int16) + 12, 0, 255).astype(numpy.uint8)
+	return Image.fromarray(array)
+
+
+@pytest.fixture
+def refPairs(tmp_path):
+	# writes count old jpg tiles with a new screenshot of every kind next to them, and returns (kind, (new, old), tile) for each.
+	def write(size, count, screenshotExt, seed=0):
+		rng = numpy.random.default_rng(seed)
+		pairs = []
+		for i in range(count):
+			img = randomTile(rng, size)
+			for kind in KINDS:
+				newPath = Path(tmp_path, f"{i}_{kind}{screenshotExt}")
+				oldPath = Path(tmp_path, f"{i}_{kind}.jpg")
+				changed(img, rng, kind).save(newPath)
+				zoom.saveCompress(img, oldPath)
+				pairs.append((kind, (str(newPath), str(oldPath)), img))
+		return pairs
+	return write
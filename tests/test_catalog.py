@@ -0,0 +1,33 @@
+import pickle
+
+import catalog
+from catalog import TileCatalog
+
+
+MAPS = [{"path": "s1", "surfaces": {"nauvis": {}}}, {"path": "s2", "surfaces": {"nauvis": {}}}]
+
+
+def test_worker_copies_share_a_connection(tmp_path):
+	with TileCatalog(tmp_path) as parent:
+		parent.addTiles(0, "s1", "nauvis", "day", 20, [(1, 2)])
+		sent = pickle.dumps(parent)
+		first, second = pickle.loads(sent), pickle.loads(sent)
+		assert first.newest("nauvis", "day", 20, 1, 2, 1) == "s1"
+		assert second.newest("nauvis", "day", 20, 1, 3, 1) is False
+		assert first.db is second.db is catalog.workerConnections[parent.path]
+		assert parent.db is not first.db
+
+		# the parent keeps writing, the workers see it on their next task.
+		parent.addTiles(1, "s2", "nauvis", "day", 20, [(1, 2)])
+		assert pickle.loads(sent).newest("nauvis", "day", 20, 1, 2, 2) == "s2"
+	catalog.workerConnections.pop(parent.path).close()
+
+
+def test_sync_checks_again_once_mapinfo_changes(tmp_path):
+	with TileCatalog(tmp_path) as tiles:
+		tiles.markSnapshot(1, "s2", "nauvis", "day", True)
+		tiles.sync(MAPS)
+		tiles.sync(MAPS)
+		assert tiles.hasSnapshot(1, "nauvis", "day")
+		tiles.sync(MAPS[:1])
+		assert not tiles.hasSnapshot(1, "nauvis", "day")
@@ -0,0 +1,120 @@
+import json
+import math
+import os
+import sys
+from argparse import Namespace
+from pathlib import Path
+
+import numpy
+from PIL import Image
+
+import tilestore
+from crop import crop
+from encoders import parseProfile
+from rawimage import jpegQuality
+from ref import ref
+from workerpool import WorkerPool
+from zoom import zoom
+
+
+SURFACE = "nauvis"
+DAYTIME = "day"
+MINZOOM = 18
+MAXZOOM = 20
+SIZE = 512
+COORDS = [(x, y) for x in range(-2, 2) for y in range(-2, 2)]
+CHANGED = (1, 1)				# gets a new building in the second snapshot
+CROPPED = ((0, 0), (-1, -1))	# the screenshot of these comes out bigger in the first and the second snapshot
+MINPSNR = 35
+MAXDISAGREE = 8					# the two screenshots cropped in only one snapshot are encoded again, with the neighbours they were cropped towards
+
+
+def building(array, rng):
+	w, h = rng.integers(SIZE // 32, SIZE // 4, 2)
+	x, y = rng.integers(0, SIZE - w), rng.integers(0, SIZE - h)
+	array[y:y+h, x:x+w] = rng.integers(40, 220, 3)
+
+
+def tileImage(rng):
+	ground = rng.integers(60, 100, (SIZE // 16, SIZE // 16, 3)).astype(numpy.uint8)
+	array = numpy.asarray(Image.fromarray(ground).resize((SIZE, SIZE), Image.BILINEAR)).copy()
+	for _ in range(6):
+		building(array, rng)
+	return array
+
+
+def addSnapshot(top, index, images, ext):
+	# the screenshots, crop.txt, done.txt and mapInfo.json entry of a snapshot, like the mod writes them.
+	path = str(index + 1)
+	Path(top).mkdir(parents=True, exist_ok=True)
+	mapInfoPath = Path(top, "mapInfo.json")
+	mapInfo = json.loads(mapInfoPath.read_text()) if mapInfoPath.exists() else {"options": {"HD": False, "day": True, "night": False}, "maps": []}
+	mapInfo["maps"].append({
+		"tick": index * 216000,
+		"path": path,
+		"date": "01/01/20",
+		"surfaces": {SURFACE: {"zoom": {"min": MINZOOM, "max": MAXZOOM}, DAYTIME: True, "links": [], "tags": [], "captured": True, "spawn": {"x": 0, "y": 0}}},
+	})
+	mapInfoPath.write_text(json.dumps(mapInfo))
+
+	folder = Path(top, "Images", path, SURFACE, DAYTIME)
+	cropLines = ["v2"]
+	for x, y in COORDS:
+		tilePath = Path(folder, str(MAXZOOM), str(x), f"{y}{ext}")
+		tilePath.parent.mkdir(parents=True, exist_ok=True)
+		img = Image.fromarray(images[(x, y)])
+		if (x, y) == CROPPED[index]:
+			padded = Image.new("RGB", (SIZE + 20, SIZE + 40), (0, 0, 0))
+			padded.paste(img, (3, 23))
+			img = padded
+			cropLines.append(f"3 23 {SIZE} {SIZE} 3 {path}/{SURFACE}/{DAYTIME}/{MAXZOOM}/{x}/{y}{ext}")
+		img.save(tilePath, **({"quality": jpegQuality(parseProfile("jpg"))} if ext == ".jpeg" else {}))
+	Path(folder, "crop.txt").write_text("\n".join(cropLines))
+	Path(folder, "done.txt").touch()
+	return path
+
+
+def run(folder, screenshotformat):
+	args = Namespace(maxthreads=2, cropthreads=None, refthreads=None, zoomthreads=None, verbose=0, zoommemory=256, downsampler="antialias", refmode="signature", tilestore="files", tileformat="jpg", dedup=False, screenshotformat=screenshotformat)
+	rng = numpy.random.default_rng(0)
+	images = {coord: tileImage(rng) for coord in COORDS}
+	top = Path(folder, screenshotformat)
+	tiles = {}
+	with WorkerPool(2) as pool, open(os.devnull, "w") as devnull:
+		for index in range(2):
+			if index > 0:
+				images[CHANGED] = images[CHANGED].copy()
+				building(images[CHANGED], rng)
+			snapshot = addSnapshot(top, index, images, ".jpeg" if screenshotformat == "jpeg" else ".png")
+			stdout, sys.stdout = sys.stdout, devnull
+			try:
+				crop(screenshotformat, snapshot, SURFACE, DAYTIME, folder, args, pool)
+				ref(screenshotformat, snapshot, SURFACE, DAYTIME, folder, args, pool)
+				zoom(screenshotformat, snapshot, SURFACE, DAYTIME, folder, True, args, pool)
+			finally:
+				sys.stdout = stdout
+			for z, x, y, path in tilestore.listTiles(Path(top, "Images", snapshot, SURFACE, DAYTIME)):
+				tiles[(snapshot, z, x, y)] = path
+	return tiles
+
+
+def psnr(a, b):
+	error = numpy.square(a.astype(numpy.float32) - b).mean()
+	return math.inf if error == 0 else 10 * math.log10(255**2 / error)
+
+
+def test_jpeg_screenshots_stay_close_to_png(tmp_path):
+	pngTiles = run(tmp_path, "png")
+	jpegTiles = run(tmp_path, "jpeg")
+
+	# jpeg screenshots may keep a few unchanged tiles, but never lose a change.
+	assert ("2", MAXZOOM, *CHANGED) in pngTiles
+	assert [key for key in pngTiles if key not in jpegTiles] == []
+	disagree = [key for key in jpegTiles if key not in pngTiles and key[1] == MAXZOOM]
+	assert len(disagree) <= MAXDISAGREE, sorted(disagree)
+
+	for key, path in pngTiles.items():
+		if key in jpegTiles:
+			a = numpy.asarray(tilestore.openImage(path).convert("RGB"))
+			b = numpy.asarray(tilestore.openImage(jpegTiles[key]).convert("RGB"))
+			assert psnr(a, b) >= MINPSNR, key
@@ -0,0 +1,30 @@
+import pytest
+
+import ref
+from rawimage import SCREENSHOTEXTS
+from signature import appendSignatures, readIndex, signature
+
+
+@pytest.mark.parametrize("screenshotformat", ("png", "bmp"))
+def test_scaled_decisions_match_exact(refPairs, screenshotformat):
+	decisions = set()
+	for kind, paths, _ in refPairs(512, 4, SCREENSHOTEXTS[screenshotformat]):
+		exact = ref.test(paths)
+		assert ref.scaledTest(paths) == exact, paths[0]
+		decisions.add(exact)
+	# the samples have to contain both kept and deleted tiles for the comparison to mean anything.
+	assert decisions == {True, False}
+
+
+@pytest.mark.parametrize("screenshotformat", ("png", "bmp"))
+def test_signature_decisions_match_exact(tmp_path, refPairs, screenshotformat):
+	pairs = refPairs(512, 4, SCREENSHOTEXTS[screenshotformat])
+	# signed from the image before it was compressed, the way zoom signs the tiles it writes.
+	appendSignatures(tmp_path, [(paths[1], signature(img)) for _, paths, img in pairs])
+	index = readIndex(tmp_path)
+	decisions = set()
+	for kind, paths, _ in pairs:
+		exact = ref.test(paths)
+		assert ref.signatureTest(paths, index[paths[1]]) == exact, paths[0]
+		decisions.add(exact)
+	assert decisions == {True, False}
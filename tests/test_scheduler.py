@@ -0,0 +1,37 @@
+import threading
+
+from scheduler import Scheduler, stageCpu
+
+
+def stageJobs(scheduler, count, threads):
+	# jobs like the crop, ref and zoom jobs of auto.py at the default settings, where every step may use all threads.
+	lock = threading.Lock()
+	state = {"running": 0, "most": 0}
+	barrier = threading.Barrier(2, timeout=10)
+
+	def job():
+		with lock:
+			state["running"] += 1
+			state["most"] = max(state["most"], state["running"])
+		# only returns once another job runs at the same time.
+		barrier.wait()
+		with lock:
+			state["running"] -= 1
+
+	for i in range(count):
+		scheduler.add(f"zoom {i}", job, cpu=stageCpu(threads))
+	return state
+
+
+def test_independent_stage_jobs_overlap():
+	scheduler = Scheduler(4, 1024)
+	state = stageJobs(scheduler, 2, 4)
+	scheduler.run()
+	assert state["most"] == 2
+
+
+def test_stage_jobs_stay_within_cpu():
+	scheduler = Scheduler(4, 1024)
+	state = stageJobs(scheduler, 4, 4)
+	scheduler.run()
+	assert state["most"] == 2
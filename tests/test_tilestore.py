@@ -0,0 +1,79 @@
+import sqlite3
+from pathlib import Path
+
+import pytest
+
+import tilestore
+
+
+OLD = b"old tile"
+NEW = b"new tile"
+
+
+def tilePath(images, snapshot):
+	return Path(images, snapshot, "nauvis", "day", "3", "1", "2.jpg")
+
+
+def writeTiles(paths, data, packed, dedup):
+	with tilestore.writing(packed, dedup):
+		for path in paths:
+			path.parent.mkdir(parents=True, exist_ok=True)
+			tilestore.write(path, data)
+
+
+def refs(images, path):
+	key = tilestore.tileKey(path)
+	db = sqlite3.connect(str(key[0]))
+	try:
+		return db.execute("SELECT ref FROM tiles WHERE z = ? AND x = ? AND y = ? AND ext = ?", key[1]).fetchone()[0]
+	finally:
+		db.close()
+
+
+@pytest.fixture
+def images(tmp_path):
+	yield Path(tmp_path, "Images")
+	tilestore.closeConnections()
+
+
+@pytest.mark.parametrize("packed", (True, False))
+@pytest.mark.parametrize("dedup", (True, False))
+def test_overwrite_original_keeps_copies(images, packed, dedup):
+	paths = [tilePath(images, snapshot) for snapshot in ("s1", "s2", "s3")]
+	writeTiles(paths, OLD, True, True)
+	assert refs(images, paths[1]) == refs(images, paths[2]) == "s1/nauvis/day/3/1/2.jpg"
+
+	writeTiles(paths[:1], NEW, packed, dedup)
+	assert tilestore.read(paths[0]) == NEW
+	assert tilestore.read(paths[1]) == OLD
+	assert tilestore.read(paths[2]) == OLD
+	assert refs(images, paths[1]) is None
+	assert refs(images, paths[2]) == "s2/nauvis/day/3/1/2.jpg"
+
+	# the copy that took over the data is the one new copies refer to.
+	path = tilePath(images, "s4")
+	writeTiles([path], OLD, True, True)
+	assert refs(images, path) == "s2/nauvis/day/3/1/2.jpg"
+	assert tilestore.dedupSavings(images) == (2, 2 * len(OLD))
+
+
+def test_uniform_original_keeps_copies(images):
+	paths = [tilePath(images, snapshot) for snapshot in ("s1", "s2")]
+	writeTiles(paths, OLD, True, True)
+
+	with tilestore.writing(True, True):
+		tilestore.writeUniform(paths[0], (1, 2, 3), 512)
+	assert tilestore.uniformTile(paths[0]) == ((1, 2, 3), 512)
+	assert tilestore.read(paths[1]) == OLD
+	assert tilestore.dedupSavings(images) == (0, 0)
+
+
+def test_overwrite_copies_and_original(images):
+	paths = [tilePath(images, snapshot) for snapshot in ("s1", "s2", "s3")]
+	writeTiles(paths, OLD, True, True)
+
+	writeTiles(paths[:2], NEW, True, True)
+	assert tilestore.read(paths[0]) == NEW
+	assert tilestore.read(paths[1]) == NEW
+	assert tilestore.read(paths[2]) == OLD
+	assert refs(images, paths[2]) is None
@@ -0,0 +1,519 @@
+import argparse
+import hashlib
+import io
+import mimetypes
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from PIL import Image
+
+import encoders
+import metrics
+import rawimage
+
+
+# optional packed output: instead of one file per tile, the finished tiles of every Images/<snapshot>/<surface>/<daytime>
+# folder go into one sqlite file in that folder. tiles keep their usual paths as names, everything that reads a tile
+# looks for the loose file first and then in the store, so packed and unpacked snapshots can be mixed.
+
+STOREFILE = "tiles.sqlite"
+
+# packed tiles of a single colour are never encoded, the store only remembers the colour and the viewer paints them
+# without asking for a file. loose tiles are always written as images.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tiles (z INTEGER, x INTEGER, y INTEGER, ext TEXT, data BLOB, PRIMARY KEY (z, x, y, ext));
+CREATE TABLE IF NOT EXISTS uniform (z INTEGER, x INTEGER, y INTEGER, ext TEXT, color INTEGER, size INTEGER, PRIMARY KEY (z, x, y, ext));
+"""
+
+# optional deduplication: Images/dedup.sqlite knows one tile for every content hash that was written. a tile with the
+# same bytes becomes a hard link to that file, or in a store a row without data that names the tile holding them. the
+# index also knows every copy, a tile that is rewritten or removed first hands its data to one of its copies.
+
+DEDUPFILE = "dedup.sqlite"
+MAXCONNECTIONS = 32		# stores a process keeps open for reading, the one used longest ago is closed first
+
+DEDUPSCHEMA = """
+CREATE TABLE IF NOT EXISTS content (hash BLOB PRIMARY KEY, path TEXT, size INTEGER, refs INTEGER) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS contentPath ON content (path);
+CREATE TABLE IF NOT EXISTS copies (path TEXT PRIMARY KEY, hash BLOB) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS copiesHash ON copies (hash);
+"""
+
+writer = None		# the TileWriter of the task that runs in this process, if it packs or deduplicates its tiles
+connections = OrderedDict()		# store path: (connection, inode), shared by all threads of the process
+connectionsLock = threading.Lock()
+connectionsPid = None
+
+
+def tileKey(path):
+	# (store path, (z, x, y, ext)) for .../<daytime>/<z>/<x>/<y>.<ext>, None for paths that are no tile.
+	path = Path(path)
+	parts = path.parts
+	if len(parts) < 4 or not parts[-3].isdigit() or not parts[-2].lstrip("-").isdigit() or not path.stem.lstrip("-").isdigit():
+		return None
+	return Path(path.parents[2], STOREFILE), (int(parts[-3]), int(parts[-2]), int(path.stem), path.suffix)
+
+
+def connect(storePath, **kwargs):
+	db = sqlite3.connect(str(storePath), timeout=60, **kwargs)
+	db.executescript(SCHEMA)
+	# stores from before deduplication have no ref column.
+	if "ref" not in (column[1] for column in db.execute("PRAGMA table_info(tiles)")):
+		with db:
+			db.execute("ALTER TABLE tiles ADD COLUMN ref TEXT")
+	return db
+
+
+def imagesFolder(path):
+	# the Images folder of a tile at Images/<snapshot>/<surface>/<daytime>/<z>/<x>/<y>.<ext>
+	return Path(path).parents[5]
+
+
+def readStore(storePath, query, params=()):
+	# rows of a query on a store, None if there is no store. every thread of a process shares one connection per store,
+	# the scheduler starts a thread for every job and connections per thread would stay open until the process ends.
+	global connectionsPid
+	with connectionsLock:
+		if connectionsPid != os.getpid():
+			# connections inherited from the parent process are not ours to close.
+			connectionsPid = os.getpid()
+			connections.clear()
+		try:
+			inode = storePath.stat().st_ino
+		except FileNotFoundError:
+			inode = None
+		db, openInode = connections.pop(storePath, (None, None))
+		if db is not None and openInode != inode:
+			# the store was deleted, and maybe written again, since it was opened.
+			db.close()
+			db = None
+		if inode is None:
+			return None
+		if db is None:
+			db = connect(storePath, check_same_thread=False)
+		connections[storePath] = (db, inode)
+		while len(connections) > MAXCONNECTIONS:
+			connections.popitem(last=False)[1][0].close()
+		return db.execute(query, params).fetchall()
+
+
+def closeConnections():
+	with connectionsLock:
+		if connectionsPid == os.getpid():
+			for db, _ in connections.values():
+				db.close()
+		connections.clear()
+
+
+def storedData(path):
+	key = tileKey(path)
+	if key is None:
+		return None
+	rows = readStore(key[0], "SELECT data, ref FROM tiles WHERE z = ? AND x = ? AND y = ? AND ext = ?", key[1])
+	if not rows:
+		return None
+	row = rows[0]
+	if row[0] is None and row[1] is not None:
+		return read(Path(imagesFolder(path), row[1]))
+	return row[0]
+
+
+def uniformTile(path):
+	# ((r, g, b), size) of a single colour tile, None for every other one.
+	key = tileKey(path)
+	if key is None:
+		return None
+	rows = readStore(key[0], "SELECT color, size FROM uniform WHERE z = ? AND x = ? AND y = ? AND ext = ?", key[1])
+	return (unpackColor(rows[0][0]), rows[0][1]) if rows else None
+
+
+def packColor(color):
+	return color[0] << 16 | color[1] << 8 | color[2]
+
+
+def unpackColor(value):
+	return (value >> 16 & 255, value >> 8 & 255, value & 255)
+
+
+def exists(path):
+	path = Path(path)
+	return path.is_file() or storedData(path) is not None or uniformTile(path) is not None
+
+
+def read(path):
+	path = Path(path)
+	if path.is_file():
+		with path.open("rb") as f:
+			return f.read()
+	data = storedData(path)
+	if data is None:
+		uniform = uniformTile(path)
+		if uniform is None:
+			raise FileNotFoundError(path)
+		data = encoders.encode(Image.new("RGB", (uniform[1], uniform[1]), uniform[0]), path)
+	return data
+
+
+def openImage(path):
+	path = Path(path)
+	if path.is_file():
+		return rawimage.openImage(path)
+	data = storedData(path)
+	if data is None:
+		uniform = uniformTile(path)
+		if uniform is None:
+			raise FileNotFoundError(path)
+		return Image.new("RGB", (uniform[1], uniform[1]), uniform[0])
+	return Image.open(io.BytesIO(data), mode="r")
+
+
+def writeFile(path, data):
+	# never writes into an existing file, it may be a hard link that other tiles share.
+	try:
+		f = Path(path).open("xb")
+	except FileExistsError:
+		Path(path).unlink()
+		f = Path(path).open("xb")
+	with f:
+		f.write(data)
+
+
+def linkFile(source, path):
+	try:
+		os.link(source, path)
+	except FileExistsError:
+		Path(path).unlink()
+		os.link(source, path)
+
+
+def write(path, data):
+	key = tileKey(path)
+	if writer is not None and key is not None:
+		writer.add(path, key, data)
+	else:
+		writeFile(path, data)
+
+
+def packing():
+	return writer is not None and writer.packed
+
+
+def writeUniform(path, color, size):
+	# path has to be a tile, see tileKey.
+	if writer is not None:
+		writer.addUniform(path, color, size)
+	else:
+		TileWriter(False, False).addUniform(path, color, size).flush()
+
+
+def listTiles(folder, z=None):
+	# yields (z, x, y, path) for every tile of a <snapshot>/<surface>/<daytime> folder, loose or packed.
+	folder = Path(folder)
+	for zFolder in ([Path(folder, str(z))] if z is not None else folder.iterdir()):
+		if not zFolder.is_dir() or not zFolder.name.isdigit():
+			continue
+		for xFolder in zFolder.iterdir():
+			for yFile in xFolder.iterdir():
+				yield int(zFolder.name), int(xFolder.name), int(yFile.stem), yFile
+	for table in ("tiles", "uniform"):
+		query = f"SELECT z, x, y, ext FROM {table}" + (" WHERE z = ?" if z is not None else "")
+		for tileZ, x, y, ext in readStore(Path(folder, STOREFILE), query, () if z is None else (z,)) or ():
+			yield tileZ, x, y, Path(folder, str(tileZ), str(x), str(y) + ext)
+
+
+def uniformTiles(folder):
+	# {z: {"x,y": "rrggbb"}} of the single colour tiles of a <snapshot>/<surface>/<daytime> folder, for the viewer.
+	tiles = {}
+	for z, x, y, color in readStore(Path(folder, STOREFILE), "SELECT z, x, y, color FROM uniform") or ():
+		tiles.setdefault(str(z), {})[f"{x},{y}"] = f"{color:06x}"
+	return tiles
+
+
+def withIndex(folder, action):
+	# runs action(db) on the dedup index of an Images folder, which stays locked until it returns.
+	db = sqlite3.connect(str(Path(folder, DEDUPFILE)), timeout=60, isolation_level=None)
+	try:
+		db.executescript(DEDUPSCHEMA)
+		db.execute("BEGIN IMMEDIATE")
+		try:
+			result = action(db)
+			db.execute("COMMIT")
+		except:
+			db.execute("ROLLBACK")
+			raise
+		return result
+	finally:
+		db.close()
+
+
+def release(folder, names, db):
+	# the tiles in names are about to be rewritten or removed. copies among them are forgotten, and an original among
+	# them gives its data to one of its copies, the other copies refer to that one from then on.
+	names = list(names)
+	for i in range(0, len(names), 500):
+		chunk = names[i:i+500]
+		marks = ",".join("?" * len(chunk))
+		for digest, count in db.execute(f"SELECT hash, COUNT(*) FROM copies WHERE path IN ({marks}) GROUP BY hash", chunk).fetchall():
+			db.execute("UPDATE content SET refs = refs - ? WHERE hash = ?", (count, digest))
+		db.execute(f"DELETE FROM copies WHERE path IN ({marks})", chunk)
+	for i in range(0, len(names), 500):
+		chunk = names[i:i+500]
+		for digest, name in db.execute(f"SELECT hash, path FROM content WHERE path IN ({','.join('?' * len(chunk))})", chunk).fetchall():
+			copies = [row[0] for row in db.execute("SELECT path FROM copies WHERE hash = ? ORDER BY path", (digest,))]
+			if not copies:
+				db.execute("DELETE FROM content WHERE hash = ?", (digest,))
+				continue
+			heir = moveOriginal(folder, name, copies)
+			db.execute("DELETE FROM copies WHERE path = ?", (heir,))
+			db.execute("UPDATE content SET path = ?, refs = refs - 1 WHERE hash = ?", (heir, digest))
+
+
+def moveOriginal(folder, name, copies):
+	# hard links keep their data when the original goes away, copies in a store get it into the first of them and refer
+	# to that one. returns the copy that holds the data now.
+	heir = None
+	data = None
+	for copy in copies:
+		storePath, tile = tileKey(Path(folder, copy))
+		if not storePath.is_file():
+			continue
+		if heir is None and data is None:
+			data = read(Path(folder, name))
+		db = connect(storePath)
+		try:
+			with db:
+				if heir is None:
+					if db.execute("UPDATE tiles SET data = ?, ref = NULL WHERE z = ? AND x = ? AND y = ? AND ext = ? AND ref = ?", (data, *tile, name)).rowcount:
+						heir = copy
+				else:
+					db.execute("UPDATE tiles SET ref = ? WHERE z = ? AND x = ? AND y = ? AND ext = ? AND ref = ?", (heir, *tile, name))
+		finally:
+			db.close()
+	return heir or copies[0]
+
+
+def dedupSavings(folder):
+	# (tiles that are a copy of another one, bytes they would have taken) for an Images folder.
+	path = Path(folder, DEDUPFILE)
+	if not path.is_file():
+		return 0, 0
+	db = sqlite3.connect(str(path), timeout=60)
+	try:
+		copies, size = db.execute("SELECT SUM(refs - 1), SUM((refs - 1) * size) FROM content").fetchone()
+	finally:
+		db.close()
+	return copies or 0, size or 0
+
+
+class TileWriter:
+	# collects the tiles of one task and writes them when the task is done, with one transaction per store and one
+	# lookup in the dedup index per Images folder. loose tiles that are not deduplicated are written right away.
+
+	def __init__(self, packed, dedup):
+		self.packed = packed
+		self.dedup = dedup
+		self.tiles = []
+		self.written = []
+		self.uniform = []
+		self.indexed = {}
+
+	def hasIndex(self, folder):
+		# rewriting a tile of a deduplicated Images folder has to wait for release, even if this task does not deduplicate.
+		if folder not in self.indexed:
+			self.indexed[folder] = Path(folder, DEDUPFILE).is_file()
+		return self.indexed[folder]
+
+	def add(self, path, key, data):
+		if self.packed or self.dedup or self.hasIndex(imagesFolder(path)):
+			self.tiles.append((Path(path), key, data))
+		else:
+			writeFile(path, data)
+			self.written.append(key)
+
+	def addUniform(self, path, color, size):
+		self.uniform.append((Path(path), tileKey(path), packColor(color), size))
+		return self
+
+	def flush(self):
+		self.flushTiles()
+		self.flushUniform()
+
+	def flushUniform(self):
+		# single colour tiles replace whatever was written for them before, and the other way around.
+		folders = {}
+		for path, _, _, _ in self.uniform:
+			if self.hasIndex(imagesFolder(path)):
+				folders.setdefault(imagesFolder(path), []).append(path.relative_to(imagesFolder(path)).as_posix())
+		for folder, names in folders.items():
+			withIndex(folder, partial(release, folder, names))
+
+		stores = {}
+		for storePath, tile in self.written:
+			stores.setdefault(storePath, ([], []))[0].append(tile)
+		for path, (storePath, tile), color, size in self.uniform:
+			stores.setdefault(storePath, ([], []))[1].append((*tile, color, size))
+			try:
+				path.unlink()
+			except FileNotFoundError:
+				pass
+		for storePath, (written, uniform) in stores.items():
+			if not uniform and not storePath.is_file():
+				continue
+			db = connect(storePath)
+			try:
+				with db:
+					db.executemany("DELETE FROM uniform WHERE z = ? AND x = ? AND y = ? AND ext = ?", written)
+					db.executemany("DELETE FROM tiles WHERE z = ? AND x = ? AND y = ? AND ext = ?", (row[:4] for row in uniform))
+					db.executemany("INSERT OR REPLACE INTO uniform VALUES (?, ?, ?, ?, ?, ?)", uniform)
+			finally:
+				db.close()
+		self.written = []
+		self.uniform = []
+
+	def flushTiles(self):
+		folders = {}
+		for tile in self.tiles:
+			folders.setdefault(imagesFolder(tile[0]), []).append(tile)
+		for folder, tiles in folders.items():
+			# the index stays locked until the tiles are written, so no other task can link to a tile that is not there yet.
+			if self.dedup:
+				withIndex(folder, partial(self.writeDeduplicated, folder, tiles))
+			elif self.hasIndex(folder):
+				withIndex(folder, partial(self.writeReleased, folder, [(path, key, data, None) for path, key, data in tiles]))
+			else:
+				self.writeTiles([(path, key, data, None) for path, key, data in tiles], folder)
+		self.written.extend(key for _, key, _ in self.tiles)
+		self.tiles = []
+
+	def writeReleased(self, folder, tiles, db):
+		release(folder, (path.relative_to(folder).as_posix() for path, _, _, _ in tiles), db)
+		self.writeTiles(tiles, folder)
+
+	def writeDeduplicated(self, folder, tiles, db):
+		release(folder, (path.relative_to(folder).as_posix() for path, _, _ in tiles), db)
+		hashes = [hashlib.blake2b(data, digest_size=16).digest() for _, _, data in tiles]
+		known = {}
+		unique = list(set(hashes))
+		for i in range(0, len(unique), 500):
+			chunk = unique[i:i+500]
+			known.update(db.execute(f"SELECT hash, path FROM content WHERE hash IN ({','.join('?' * len(chunk))})", chunk).fetchall())
+
+		writes = []
+		written = set()
+		for (path, key, data), digest in zip(tiles, hashes):
+			name = path.relative_to(folder).as_posix()
+			ref = known.get(digest)
+			# loose tiles can only link to loose tiles, and no tile refers to itself.
+			if ref == name or (ref is not None and not self.packed and ref not in written and not Path(folder, ref).is_file()):
+				ref = None
+			if ref is None:
+				known[digest] = name
+				written.add(name)
+			writes.append((path, key, data, ref))
+
+		writes = self.writeTiles(writes, folder)
+
+		originals = [(digest, path.relative_to(folder).as_posix(), len(data)) for (path, _, data, ref), digest in zip(writes, hashes) if ref is None]
+		copies = [(digest, path.relative_to(folder).as_posix(), len(data)) for (path, _, data, ref), digest in zip(writes, hashes) if ref is not None]
+		db.executemany("INSERT OR REPLACE INTO content VALUES (?, ?, ?, 1)", originals)
+		db.executemany("UPDATE content SET refs = refs + 1 WHERE hash = ?", ((digest,) for digest, _, _ in copies))
+		db.executemany("INSERT OR REPLACE INTO copies VALUES (?, ?)", ((name, digest) for digest, name, _ in copies))
+		metrics.add("tilesDeduplicated", len(copies))
+		metrics.add("bytesDeduplicated", sum(size for _, _, size in copies))
+
+	def writeTiles(self, tiles, folder=None):
+		# returns the tiles with ref set to None for the copies that had to be written out after all.
+		if self.packed:
+			rows = {}
+			for path, (storePath, tile), data, ref in tiles:
+				rows.setdefault(storePath, []).append((*tile, None if ref else data, ref))
+			for storePath, storeRows in rows.items():
+				db = connect(storePath)
+				try:
+					with db:
+						db.executemany("INSERT OR REPLACE INTO tiles (z, x, y, ext, data, ref) VALUES (?, ?, ?, ?, ?, ?)", storeRows)
+				finally:
+					db.close()
+			return tiles
+		result = []
+		for path, key, data, ref in tiles:
+			if ref is not None:
+				try:
+					linkFile(Path(folder, ref), path)
+				except OSError:		# file systems without hard links
+					ref = None
+			if ref is None:
+				writeFile(path, data)
+			result.append((path, key, data, ref))
+		return result
+
+
+class writing:
+	# with writing(packed, dedup): every tile written with write() goes to the store of its folder and/or is
+	# deduplicated against all tiles written before.
+
+	def __init__(self, packed, dedup=False):
+		self.packed = packed
+		self.dedup = dedup
+
+	def __enter__(self):
+		global writer
+		writer = TileWriter(self.packed, self.dedup)
+		return self
+
+	def __exit__(self, excType, excValue, traceback):
+		global writer
+		try:
+			if excType is None:
+				writer.flush()
+		finally:
+			writer = None
+
+
+
+class TileRequestHandler(SimpleHTTPRequestHandler):
+	# serves an output folder like any static web server, tiles that are not on disk come out of their store.
+
+	def do_GET(self):
+		path = Path(self.translate_path(self.path))
+		if not path.exists():
+			try:
+				data = read(path)
+			except FileNotFoundError:
+				data = None
+			if data is not None:
+				self.send_response(200)
+				self.send_header("Content-Type", mimetypes.guess_type(path.name)[0] or "application/octet-stream")
+				self.send_header("Content-Length", str(len(data)))
+				self.end_headers()
+				self.wfile.write(data)
+				return
+		super().do_GET()
+
+	def log_message(self, *args):
+		pass
+
+
+def serve(folder, port):
+	server = ThreadingHTTPServer(("127.0.0.1", port), partial(TileRequestHandler, directory=str(folder)))
+	print(f"serving {folder} on http://127.0.0.1:{port}/")
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Serve an output folder with packed tiles to a browser.")
+	parser.add_argument("folder", type=Path, help="The output folder, the one with index.html in it.")
+	parser.add_argument("--port", type=int, default=8000)
+	args = parser.parse_args()
+	serve(args.folder.resolve(), args.port)
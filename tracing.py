@@ -0,0 +1,89 @@
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+
+# records begin/end spans as chrome trace events (https://ui.perfetto.dev opens them), one track per process and thread.
+# every process collects its own events: the main process keeps them in events, pool workers return theirs with the
+# result of each task, and the game log process appends them to a manager list (sink).
+
+enabled = False
+events = []
+sink = None
+processPid = None
+
+
+def now():
+	# perf_counter is a system wide clock on windows, linux and mac, so events of different processes line up.
+	return time.perf_counter_ns() // 1000
+
+
+def record(event):
+	if sink is not None:
+		sink.append(event)
+	else:
+		events.append(event)
+
+
+def start(name, traceSink=None):
+	global enabled, sink, processPid
+	enabled = True
+	sink = traceSink
+	processPid = os.getpid()
+	record({"name": "process_name", "ph": "M", "pid": os.getpid(), "tid": 0, "args": {"name": f"{name} ({os.getpid()})"}})
+
+
+class span:
+	# with span("name"): ... records the block as one complete event on the track of the current thread.
+
+	def __init__(self, name, category="main", **args):
+		self.name = name
+		self.category = category
+		self.args = args
+
+	def __enter__(self):
+		if enabled:
+			self.start = now()
+		return self
+
+	def __exit__(self, excType, excValue, traceback):
+		if enabled:
+			if excType is not None:
+				self.args["error"] = excType.__name__
+			complete(self.name, self.start, self.category, **self.args)
+
+
+def complete(name, start, category="main", **args):
+	# records a span that started at start (from now()) and ends now, for spans that do not fit in a with block.
+	if enabled:
+		event = {"name": name, "cat": category, "ph": "X", "ts": start, "dur": now() - start, "pid": os.getpid(), "tid": threading.get_ident()}
+		if args:
+			event["args"] = {key: str(value) for key, value in args.items()}
+		record(event)
+
+
+def instant(name, category="main", **args):
+	if enabled:
+		record({"name": name, "cat": category, "ph": "i", "s": "t", "ts": now(), "pid": os.getpid(), "tid": threading.get_ident(), "args": {key: str(value) for key, value in args.items()}})
+
+
+def runTraced(func, args, name, category):
+	# runs one pool task in a worker and returns its result with the events recorded while it ran.
+	global enabled
+	enabled = True
+	events.clear()
+	if processPid != os.getpid():
+		start("worker")
+	try:
+		with span(name, category):
+			result = func(*args)
+	finally:
+		enabled = False
+	return result, list(events)
+
+
+def write(path):
+	with Path(path).open("w", encoding="utf-8") as f:
+		json.dump({"traceEvents": list(events), "displayTimeUnit": "ms"}, f)
@@ -1,6 +1,6 @@
 "use strict";
 let DEBUG = false;
-const EXT = ".jpg";
+const EXT = ".jpg";	// snapshots from before the tile format could be chosen
 
 
 
@@ -11,13 +11,31 @@ let COORDSCALE = 2**19 / 16 * window.devicePixelRatio;
 //let _getTileUrl = L.TileLayer.prototype.getTileUrl;
 //L.TileLayer.prototype.getTileUrl = function(coords) { return _getTileUrl.call(this, {x: coords.x - 1 * Math.pow(2, coords.z - 2), y: coords.y, z: coords.z}); };
 
-L.TileLayer.prototype.getTileUrl = function(c) {
+L.TileLayer.prototype.getTileMapIndex = function(c) {
 	let mapIndex = this.tileIndex[c.z] && this.tileIndex[c.z][c.y] && this.tileIndex[c.z][c.y][c.x];
 	if (isNaN(mapIndex))
 		mapIndex = this.tileIndex.fallback;
+	return mapIndex;
+}
+L.TileLayer.prototype.getTileUrl = function(c) {
+	let mapIndex = this.getTileMapIndex(c);
 	if (isNaN(mapIndex))
 		return "";
-	return "Images/" + mapInfo.maps[mapIndex].path + "/" + this.surface + "/" + this.daytime + "/" + c.z + "/" + c.x + "/" + c.y + EXT;
+	let tileFormats = (mapInfo.maps[mapIndex].surfaces[this.surface] || {}).tileFormats;
+	return "Images/" + mapInfo.maps[mapIndex].path + "/" + this.surface + "/" + this.daytime + "/" + c.z + "/" + c.x + "/" + c.y + (tileFormats && tileFormats[c.z] || EXT);
+}
+// tiles of a single colour have no image, they are painted with the colour zoom recorded for them.
+let _createTile = L.TileLayer.prototype.createTile;
+L.TileLayer.prototype.createTile = function(c, done) {
+	let mapIndex = this.getTileMapIndex(c);
+	let uniformTiles = !isNaN(mapIndex) && ((mapInfo.maps[mapIndex].surfaces[this.surface] || {}).uniformTiles || {})[this.daytime];
+	let color = uniformTiles && uniformTiles[c.z] && uniformTiles[c.z][c.x + "," + c.y];
+	if (!color)
+		return _createTile.call(this, c, done);
+	let tile = document.createElement("div");
+	tile.style.backgroundColor = "#" + color;
+	L.Util.requestAnimFrame(L.bind(done, this, null, tile));
+	return tile;
 }
 
 //TODO: iterate over surfaces
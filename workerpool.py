@@ -0,0 +1,253 @@
+import multiprocessing as mp
+import os
+import threading
+import time
+
+import psutil
+
+import metrics
+import tracing
+
+
+PROGRESSSLOTS = 64		# progress counters that can be in use at the same time
+FLUSHINTERVAL = 0.1		# seconds a worker keeps progress to itself before adding it to the shared counter
+PRINTINTERVAL = 0.2		# seconds between progress bar reprints
+
+
+# worker side
+progressCounters = None
+pendingProgress = {}
+lastFlush = 0
+
+
+def initWorker(counters):
+	global progressCounters
+	progressCounters = counters
+	psutil.Process(os.getpid()).nice(psutil.BELOW_NORMAL_PRIORITY_CLASS if os.name == "nt" else 10)
+
+
+def addProgress(slot, count):
+	pendingProgress[slot] = pendingProgress.get(slot, 0) + count
+	if time.monotonic() - lastFlush > FLUSHINTERVAL:
+		flushProgress()
+
+
+def flushProgress():
+	global lastFlush
+	if pendingProgress:
+		with progressCounters.get_lock():
+			for slot, count in pendingProgress.items():
+				progressCounters[slot] += count
+		pendingProgress.clear()
+	lastFlush = time.monotonic()
+
+
+def runChunk(func, chunk):
+	results = []
+	try:
+		for item in chunk:
+			start = time.perf_counter()
+			results.append(func(item))
+			metrics.observe(time.perf_counter() - start)
+	finally:
+		flushProgress()
+	return results
+
+
+def taskName(func, args):
+	if func is runChunk:
+		func = args[0]
+		return f"{taskName(func, ())} x{len(args[1])}"
+	while not hasattr(func, "__name__") and hasattr(func, "func"):
+		func = func.func
+	return getattr(func, "__name__", "task")
+
+
+class WorkerPool:
+	# one set of worker processes that is shared by all steps for the whole run, so PIL, numpy and TurboJPEG
+	# only have to be imported once per worker instead of once per step, surface and daytime.
+
+	def __init__(self, processes):
+		self.processes = max(1, processes)
+		# the workers get the counters when they start, shared memory can not be sent along with a task.
+		self.progressCounters = mp.Array("q", PROGRESSSLOTS)
+		self.freeSlots = list(range(PROGRESSSLOTS))
+		self.slotLock = threading.Lock()
+		self.pool = mp.Pool(processes=self.processes, initializer=initWorker, initargs=(self.progressCounters,))
+		self.manager = mp.Manager()
+		self.metrics = None		# a metrics.Metrics, stages that pass a key then measure their tasks
+
+	def stage(self, threads, key=None):
+		return Stage(self, threads, key)
+
+	def progress(self):
+		with self.slotLock:
+			if not self.freeSlots:
+				raise Exception("all progress counters are in use")
+			slot = self.freeSlots.pop()
+		self.progressCounters[slot] = 0
+		return Progress(self, slot)
+
+	def close(self):
+		self.pool.close()
+		self.pool.join()
+		self.manager.shutdown()
+
+	def terminate(self):
+		self.pool.terminate()
+		self.pool.join()
+		self.manager.shutdown()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, excType, excValue, traceback):
+		if excType is None:
+			self.close()
+		else:
+			self.terminate()
+
+
+class Progress:
+	# counts finished tiles in shared memory. tasks get this object as an argument and call add(), workers batch their
+	# additions so a tile costs no round trip to another process. the main process reads value.
+
+	def __init__(self, workerPool, slot):
+		self.workerPool = workerPool
+		self.slot = slot
+
+	def __getstate__(self):
+		return {"workerPool": None, "slot": self.slot}
+
+	def add(self, count=1):
+		addProgress(self.slot, count)
+
+	@property
+	def value(self):
+		return self.workerPool.progressCounters[self.slot]
+
+	def follow(self, result, show):
+		# calls show(value) every PRINTINTERVAL until result is ready, and once more at the end.
+		while not result.wait(PRINTINTERVAL):
+			show(self.value)
+		show(self.value)
+
+	def close(self):
+		with self.workerPool.slotLock:
+			self.workerPool.freeSlots.append(self.slot)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, excType, excValue, traceback):
+		self.close()
+
+
+class Stage:
+	# limits the amount of tasks one step runs on the shared pool at the same time.
+
+	def __init__(self, workerPool, threads, key=None):
+		self.workerPool = workerPool
+		self.threads = max(1, min(threads or workerPool.processes, workerPool.processes))
+		self.semaphore = threading.BoundedSemaphore(self.threads)
+		# (step, snapshot, surface, daytime) the tasks are measured under
+		self.metrics = workerPool.metrics if key is not None else None
+		self.key = key
+		self.inFlight = 0
+		self.activeSince = None
+		self.lock = threading.Lock()
+
+	def taskStarted(self):
+		with self.lock:
+			if self.inFlight == 0:
+				self.activeSince = time.perf_counter()
+			self.inFlight += 1
+
+	def taskEnded(self):
+		# the wall time of a step only counts while it has tasks on the pool, so waiting on factorio is not idle workers.
+		with self.lock:
+			self.inFlight -= 1
+			if self.inFlight == 0:
+				self.metrics.addWall(self.key, time.perf_counter() - self.activeSince, self.threads)
+
+	def apply_async(self, func, args=(), callback=None, error_callback=None):
+		self.semaphore.acquire()
+		measured = self.metrics is not None
+		traced = tracing.enabled
+		if traced:
+			name = taskName(func, args)
+		if measured:
+			func, args = metrics.runMeasured, (func, args, func is not runChunk)
+			self.taskStarted()
+		if traced:
+			func, args = tracing.runTraced, (func, args, name, self.key[0] if self.key else "pool")
+
+		def done(result):
+			self.semaphore.release()
+			if traced:
+				result, events = result
+				tracing.events.extend(events)
+			if measured:
+				result, sample = result
+				self.metrics.merge(self.key, sample)
+				self.taskEnded()
+			if callback:
+				callback(result)
+
+		def failed(exception):
+			self.semaphore.release()
+			if measured:
+				self.taskEnded()
+			if error_callback:
+				error_callback(exception)
+
+		return self.workerPool.pool.apply_async(func, args, callback=done, error_callback=failed)
+
+	def map_async(self, func, iterable, chunksize=1):
+		items = list(iterable)
+		chunks = [items[i:i+chunksize] for i in range(0, len(items), chunksize)]
+		result = StageMapResult(len(chunks))
+
+		def feed():
+			for index, chunk in enumerate(chunks):
+				if result.exception is not None:
+					break
+				self.apply_async(runChunk, (func, chunk), callback=lambda r, index=index: result.set(index, r), error_callback=result.fail)
+
+		threading.Thread(target=feed, daemon=True).start()
+		return result
+
+	def map(self, func, iterable, chunksize=1):
+		return self.map_async(func, iterable, chunksize).get()
+
+
+class StageMapResult:
+
+	def __init__(self, chunkCount):
+		self.chunks = [None] * chunkCount
+		self.remaining = chunkCount
+		self.exception = None
+		self.lock = threading.Lock()
+		self.event = threading.Event()
+		if chunkCount == 0:
+			self.event.set()
+
+	def set(self, index, result):
+		with self.lock:
+			self.chunks[index] = result
+			self.remaining -= 1
+			if self.remaining == 0:
+				self.event.set()
+
+	def fail(self, exception):
+		self.exception = exception
+		self.event.set()
+
+	def wait(self, timeout=None):
+		return self.event.wait(timeout)
+
+	def get(self, timeout=None):
+		self.wait(timeout)
+		if self.exception is not None:
+			raise self.exception
+		return [item for chunk in self.chunks for item in chunk]
@@ -1,9 +1,11 @@
+import io
 import json
 import math
-import multiprocessing as mp
 from argparse import Namespace
+from functools import lru_cache, partial
 import os
 from pathlib import Path
+import queue
 import subprocess
 import sys
 import time
@@ -13,20 +15,31 @@ from sys import platform as _platform
 import numpy
 import psutil
 from PIL import Image, ImageChops
-from turbojpeg import TurboJPEG
+import encoders
+import tilestore
+import tracing
+from catalog import TileCatalog
+import metrics
+from metrics import measure
+from rawimage import JPEGEXT, decodeJpeg, screenshotExt, screenshotSignature, unfinishedExt
+from checkpoint import SAVEINTERVAL, openCheckpoint, unitKey
+from signature import appendSignatures, signature
+from workerpool import PRINTINTERVAL, WorkerPool
 
 maxQuality = False  		# Set this to true if you want to compress/postprocess the images yourself later
 useBetterEncoder = True 	# Slower encoder that generates smaller images.
 
 quality = 80
 
-EXT = ".png"
-OUTEXT = ".jpg"     		# format='JPEG' is hardcoded in places, meed to modify those, too. Most parameters are not supported outside jpeg.
+EXT = ".png"				# unfinished tiles, .bmp with --screenshotformat=bmp (see rawimage.py). the finished ones use the formats of --tileformat, see encoders.py.
 THUMBNAILEXT = ".png"
 
 BACKGROUNDCOLOR = (27, 45, 51)
 THUMBNAILSCALE = 2
 
+DOWNSAMPLER = "antialias"	# of the task that runs in this process, see --downsampler. "antialias" resizes every tile separately with PIL, "box" averages 2x2 pixel blocks of all 4 children in one numpy pass.
+							# Any other PIL filter name ("bilinear", "bicubic", "lanczos", ...) stacks the 4 children and resizes them with a single PIL call.
+
 MINRENDERBOXSIZE = 8
 
 
@@ -39,42 +52,167 @@ def printErase(arg):
 		pass
 
 
-# note that these are all 64 bit libraries since factorio doesnt support 32 bit.
-if os.name == "nt":
-	jpeg = TurboJPEG(Path(__file__, "..", "mozjpeg/turbojpeg.dll").resolve().as_posix())
-# elif _platform == "darwin":						# I'm not actually sure if mac can run linux libraries or not.
-# 	jpeg = TurboJPEG("mozjpeg/libturbojpeg.dylib")	# If anyone on mac has problems with the line below please make an issue :)
-else:
-	jpeg = TurboJPEG(Path(__file__, "..", "mozjpeg/libturbojpeg.so").resolve().as_posix())
+def uniformColor(img):
+	# the colour of a tile that has only one, None for every other tile.
+	if img.mode != "RGB":
+		return None
+	array = numpy.asarray(img)
+	if (array[0, 0] != array[-1, -1]).any():
+		return None
+	low = array.min(axis=(0, 1))
+	if (array.max(axis=(0, 1)) != low).any():
+		return None
+	return tuple(int(c) for c in low)
 
 
 def saveCompress(img, path: Path):
-	if maxQuality:  # do not waste any time compressing the image
-		return img.save(path, subsampling=0, quality=100)
+	# writes a finished tile in the format of its zoom level, to the tile store instead when the task packs them.
+	# packed tiles of a single colour are only recorded in the store, the viewer paints them.
+	path = encoders.finalPath(path)
+	if tilestore.packing() and tilestore.tileKey(path) is not None:
+		color = uniformColor(img)
+		if color is not None:
+			tilestore.writeUniform(path, color, img.size[0])
+			metrics.add("tilesUniform", 1)
+			return
+	with measure("encode"):
+		if maxQuality and encoders.tileFormat(path)[0] == "jpg":  # do not waste any time compressing the image
+			buffer = io.BytesIO()
+			img.save(buffer, format="JPEG", subsampling=0, quality=100)
+			data = buffer.getvalue()
+		else:
+			data = encoders.encode(img, path)
+		tilestore.write(path, data)
+	metrics.add("bytesWritten", len(data))
+
+
+def saveTile(img, path: Path):
+	# intermediate EXT tiles
+	with measure("encode", path):
+		img.save(path)
+
+
+def openTile(path: Path):
+	with measure("decode", path):
+		return tilestore.openImage(path).convert("RGB")
+
+
+def keepsScreenshot(path: Path):
+	# a jpeg screenshot already is the finished tile when the max zoom level is jpg, crop saved it in the same quality.
+	return path.suffix == JPEGEXT and DOWNSAMPLER == "antialias" and not maxQuality and encoders.tileFormat(path)[0] == "jpg"
+
+
+def openOriginal(path: Path):
+	# an unfinished tile or screenshot that is finished with saveOriginal once its parent is made. screenshots that are
+	# kept are only decoded at the half size their parent needs.
+	if keepsScreenshot(path):
+		with measure("decode", path):
+			return decodeJpeg(path, 2)[0]
+	return openTile(path)
+
+
+def saveOriginal(img, path: Path):
+	if not keepsScreenshot(path):
+		return saveCompress(img, path)
+	finished = encoders.finalPath(path)
+	data = path.read_bytes()
+	color = uniformColor(img)
+	if color is not None and tilestore.packing() and tilestore.tileKey(finished) is not None:
+		tilestore.writeUniform(finished, color, encoders.jpeg.decode_header(data)[0])
+		metrics.add("tilesUniform", 1)
+		return
+	tilestore.write(finished, data)
+	metrics.add("bytesWritten", len(data))
+
+
+def originalSignature(img, path: Path):
+	return screenshotSignature(path) if path.suffix == JPEGEXT else signature(img)
+
+
+def boxReduce(array):
+	# average every 2x2 pixel block of an uint8 (h, w, 3) array, odd trailing rows and columns are dropped.
+	h, w = array.shape[0] // 2, array.shape[1] // 2
+	rows = array[:h * 2, :w * 2].reshape(h, 2, w * 2 * array.shape[2])
+	result = numpy.add(rows[:, 0], rows[:, 1], dtype=numpy.uint16).reshape(h, w, 2, array.shape[2])
+	result = numpy.add(result[:, :, 0], result[:, :, 1])
+	result += 2
+	result >>= 2
+	return result.astype(numpy.uint8)
+
+
+@lru_cache(maxsize=4)
+def backgroundCanvas(size):
+	canvas = numpy.empty((2 * size, 2 * size, 3), dtype=numpy.uint8)
+	canvas[:, :] = BACKGROUNDCOLOR
+	return canvas
+
 
-	outFile = path.open("wb")
-	outFile.write(jpeg.encode(numpy.array(img)[:, :, ::-1].copy()))
-	outFile.close()
+def halve(img):
+	if DOWNSAMPLER == "antialias":
+		return img.resize((img.size[0] // 2, img.size[1] // 2), Image.ANTIALIAS)
+	if DOWNSAMPLER == "box":
+		return Image.fromarray(boxReduce(numpy.asarray(img)))
+	return img.resize((img.size[0] // 2, img.size[1] // 2), getattr(Image, DOWNSAMPLER.upper()))
 
 
-def simpleZoom(workQueue):
-	for (folder, start, stop, filename) in workQueue:
+def parentCanvas(size):
+	if DOWNSAMPLER == "antialias":
+		return Image.new("RGB", (size, size), BACKGROUNDCOLOR)
+	return backgroundCanvas(size).copy()
+
+
+def pasteChild(canvas, coord, img, size):
+	if DOWNSAMPLER == "antialias":
+		canvas.paste(box=(coord[0] * size // 2, coord[1] * size // 2), im=img.resize((size // 2, size // 2), Image.ANTIALIAS))
+	else:
+		if img.size != (size, size):
+			img = img.resize((size, size), Image.ANTIALIAS)
+		canvas[coord[1] * size:(coord[1] + 1) * size, coord[0] * size:(coord[0] + 1) * size] = numpy.asarray(img)
+
+
+def finishParent(canvas, size):
+	if DOWNSAMPLER == "antialias":
+		return canvas
+	if DOWNSAMPLER == "box":
+		return Image.fromarray(boxReduce(canvas))
+	return Image.fromarray(canvas).resize((size, size), getattr(Image, DOWNSAMPLER.upper()))
+
+
+def convertedTile(path):
+	# a tile an interrupted zoom already finished and deleted the EXT original of.
+	path = encoders.finalPath(path)
+	return path if tilestore.exists(path) else None
+
+
+def simpleZoom(workQueue, downsampler="antialias"):
+	global DOWNSAMPLER
+	DOWNSAMPLER = downsampler
+	signatures = []
+	for (folder, start, stop, filename, ext) in workQueue:
 		path = Path(folder, str(start), filename)
-		img = Image.open(path.with_suffix(EXT), mode="r").convert("RGB")
-		if OUTEXT != EXT:
-			saveCompress(img, path.with_suffix(OUTEXT))
-			path.with_suffix(EXT).unlink()
+		converted = not path.with_suffix(ext).is_file() and convertedTile(path)
+		img = openTile(converted or path.with_suffix(ext))
+		signatures.append((folder, f"{folder.name}/{start}/{filename}", originalSignature(img, converted or path.with_suffix(ext))))
+		if not converted:
+			saveCompress(img, path)
+			path.with_suffix(ext).unlink()
 
 		for z in range(start - 1, stop - 1, -1):
 			if img.size[0] >= MINRENDERBOXSIZE * 2 and img.size[1] >= MINRENDERBOXSIZE * 2:
-				img = img.resize((img.size[0] // 2, img.size[1] // 2), Image.ANTIALIAS)
+				img = halve(img)
 			zFolder = Path(folder, str(z))
 			if not zFolder.exists():
 				zFolder.mkdir(parents=True)
-			saveCompress(img, Path(zFolder, filename).with_suffix(OUTEXT))
+			saveCompress(img, Path(zFolder, filename))
+	return signatures
+
 
+def zoomRenderboxes(daytimeSurfaces, toppath, timestamp, subpath, args, pool: WorkerPool = None):
+	maxthreads = args.zoomthreads if args.zoomthreads else args.maxthreads
+	if pool is None:
+		with WorkerPool(maxthreads) as pool:
+			return zoomRenderboxes(daytimeSurfaces, toppath, timestamp, subpath, args, pool)
 
-def zoomRenderboxes(daytimeSurfaces, toppath, timestamp, subpath, args):
 	with Path(toppath, "mapInfo.json").open("r+", encoding="utf-8") as mapInfoFile:
 		mapInfo = json.load(mapInfoFile)
 
@@ -148,6 +286,7 @@ def zoomRenderboxes(daytimeSurfaces, toppath, timestamp, subpath, args):
 										link["zoom"]["max"],
 										link["zoom"]["min"],
 										link["filename"],
+										screenshotExt(args),
 									)
 								)
 
@@ -155,19 +294,35 @@ def zoomRenderboxes(daytimeSurfaces, toppath, timestamp, subpath, args):
 			json.dump(outInfo, mapInfoOutFile)
 			mapInfoOutFile.truncate()
 
-	maxthreads = args.zoomthreads if args.zoomthreads else args.maxthreads
-	processes = []
-	zoomWork = list(zoomWork)
-	for i in range(0, min(maxthreads, len(zoomWork))):
-		p = mp.Process(target=simpleZoom, args=(zoomWork[i::maxthreads],))
-		p.start()
-		processes.append(p)
-	for p in processes:
-		p.join()
-
-
-def work(basepath, pathList, surfaceName, daytime, size, start, stop, last, chunk, keepLast=False):
+	signatures = {}
+	for results in pool.stage(maxthreads, ("renderboxes", timestamp)).map(partial(simpleZoom, downsampler=args.downsampler), [[work] for work in zoomWork], 8):
+		for folder, key, array in results:
+			signatures.setdefault(folder.parent, []).append((key, array))
+	for folder, folderSignatures in signatures.items():
+		appendSignatures(folder, folderSignatures)
+
+
+def olderTile(basepath, pathList, surfaceName, daytime, z, x, y, catalog=None):
+	if catalog is not None:
+		snapshot = catalog.newest(surfaceName, daytime, z, x, y, len(pathList) - 1)
+		if snapshot is False:
+			return None
+		if snapshot is not None:
+			path = encoders.finalPath(Path(basepath, snapshot, surfaceName, daytime, str(z), str(x), str(y)))
+			if tilestore.exists(path):
+				return path
+	for n in range(1, len(pathList)):
+		path = encoders.finalPath(Path(basepath, pathList[n], surfaceName, daytime, str(z), str(x), str(y)))
+		if tilestore.exists(path):
+			return path
+	return None
+
+
+def work(basepath, pathList, surfaceName, daytime, size, start, stop, last, chunk, keepLast=False, catalog=None, signed=False, ext=EXT, startExt=None):
+	# startExt is the extension of the tiles on level start, the screenshots when that is the max zoom level.
+	startExt = startExt or ext
 	chunksize = 2 ** (start - stop)
+	signatures = []
 	if start > stop:
 		for k in range(start, stop, -1):
 			x = chunksize * chunk[0]
@@ -185,11 +340,11 @@ def work(basepath, pathList, surfaceName, daytime, size, start, stop, last, chun
 							str(k),
 							str(i + coord[0]),
 							str(j + coord[1]),
-						).with_suffix(EXT)
+						).with_suffix(startExt if k == start else ext)
 						for coord in coords
 					]
 
-					if any(path.exists() for path in paths):
+					if any(path.exists() or k == start and convertedTile(path) for path in paths):
 
 						if not Path(basepath, pathList[0], surfaceName, daytime, str(k - 1), str(i // 2)).exists():
 							try:
@@ -201,59 +356,179 @@ def work(basepath, pathList, surfaceName, daytime, size, start, stop, last, chun
 						for m in range(len(coords)):
 							isOriginal.append(paths[m].is_file())
 							if not isOriginal[m]:
-								for n in range(1, len(pathList)):
-									paths[m] = Path(basepath, pathList[n], surfaceName, daytime, str(k), str(i + coords[m][0]), str(j + coords[m][1])).with_suffix(OUTEXT)
-									if paths[m].is_file():
-										break
+								paths[m] = (k == start and convertedTile(paths[m])) or olderTile(basepath, pathList, surfaceName, daytime, k, i + coords[m][0], j + coords[m][1], catalog) or paths[m]
 
-						result = Image.new("RGB", (size, size), BACKGROUNDCOLOR)
+						canvas = parentCanvas(size)
 
 						images = []
 						for m in range(len(coords)):
-							if paths[m].is_file():
-								img = Image.open(paths[m], mode="r").convert("RGB")
-								result.paste(
-									box=(
-										coords[m][0] * size // 2,
-										coords[m][1] * size // 2,
-									),
-									im=img.resize(
-										(size // 2, size // 2), Image.ANTIALIAS
-									),
-								)
+							if isOriginal[m] or tilestore.exists(paths[m]):
+								img = openOriginal(paths[m]) if isOriginal[m] else openTile(paths[m])
+								pasteChild(canvas, coords[m], img, size)
 
 								if isOriginal[m]:
 									images.append((img, paths[m]))
 
+						result = finishParent(canvas, size)
+
 						if k == last + 1:
-							saveCompress(result, Path(basepath, pathList[0], surfaceName, daytime, str(k - 1), str(i // 2), str(j // 2)).with_suffix(OUTEXT))
-						if OUTEXT != EXT and (k != last + 1 or keepLast):
-							result.save(Path(basepath, pathList[0], surfaceName, daytime, str(k - 1), str(i // 2), str(j // 2), ).with_suffix(EXT))
+							saveCompress(result, Path(basepath, pathList[0], surfaceName, daytime, str(k - 1), str(i // 2), str(j // 2)))
+						if k != last + 1 or keepLast:
+							saveTile(result, Path(basepath, pathList[0], surfaceName, daytime, str(k - 1), str(i // 2), str(j // 2), ).with_suffix(ext))
 
-						if OUTEXT != EXT:
+						if signed and k == start:
 							for img, path in images:
-								saveCompress(img, path.with_suffix(OUTEXT))
-								path.unlink()
+								signatures.append((f"{k}/{path.parent.name}/{path.stem}", originalSignature(img, path)))
+
+						for img, path in images:
+							saveOriginal(img, path)
+							path.unlink()
 
 			chunksize = chunksize // 2
 	elif stop == last:
 		path = Path(basepath, pathList[0], surfaceName, daytime, str(start), str(chunk[0]), str(chunk[1]))
-		img = Image.open(path.with_suffix(EXT), mode="r").convert("RGB")
-		saveCompress(img, path.with_suffix(OUTEXT))
-		path.with_suffix(EXT).unlink()
-
-
-def thread(basepath, pathList, surfaceName, daytime, size, start, stop, last, allChunks, counter, resultQueue, keepLast=False):
-	#print(start, stop, chunks)
-	while True:
-		with counter.get_lock():
-			i = counter.value - 1
-			if i < 0:
-				return
-			counter.value = i
-		chunk = allChunks[i]
-		work(basepath, pathList, surfaceName, daytime, size, start, stop, last, chunk, keepLast)
-		resultQueue.put(True)
+		original = path.with_suffix(startExt)
+		if not original.is_file() and convertedTile(path):
+			return signatures
+		img = openOriginal(original)
+		if signed:
+			signatures.append((f"{start}/{chunk[0]}/{chunk[1]}", originalSignature(img, original)))
+		saveOriginal(img, original)
+		original.unlink()
+	return signatures
+
+
+def subtreeMaxDepth(memory, size, downsampler="antialias"):
+	# while descending, every level holds one parent canvas and one decoded child in memory.
+	if not memory:
+		return 0
+	tilesPerLevel = 2 if downsampler == "antialias" else 5
+	return max(1, memory * 2**20 // (tilesPerLevel * size * size * 3))
+
+
+def subtreeWork(basepath, pathList, surfaceName, daytime, size, start, stop, last, chunk, keepLast=False, maxDepth=0, catalog=None, signed=False, ext=EXT, startExt=None):
+	# same result as work(), but every subtree of at most maxDepth levels is built recursively in memory.
+	# only the top of each subtree is written as an intermediate EXT image, every other level is finished right away.
+	coords = [(0, 0), (1, 0), (0, 1), (1, 1)]
+	signatures = []
+	startExt = startExt or ext
+
+	def tilePath(snapshot, z, x, y, ext):
+		return Path(basepath, snapshot, surfaceName, daytime, str(z), str(x), str(y)).with_suffix(ext)
+
+	def save(img, z, x, y, top):
+		folder = Path(basepath, pathList[0], surfaceName, daytime, str(z), str(x))
+		if not folder.exists():
+			try:
+				folder.mkdir(parents=True)
+			except OSError:
+				pass
+		if z == top and z == last:
+			saveCompress(img, tilePath(pathList[0], z, x, y, ext))
+			if keepLast:
+				saveTile(img, tilePath(pathList[0], z, x, y, ext))
+		elif z == top:
+			saveTile(img, tilePath(pathList[0], z, x, y, ext))
+		else:
+			saveCompress(img, tilePath(pathList[0], z, x, y, ext))
+
+	def build(z, x, y, base, top):
+		if z == base:
+			path = tilePath(pathList[0], z, x, y, startExt if z == start else ext)
+			if not path.is_file():
+				converted = z == start and convertedTile(path)
+				return openTile(converted) if converted else None
+			img = openOriginal(path)
+			if signed and z == start:
+				signatures.append((f"{z}/{x}/{y}", originalSignature(img, path)))
+			saveOriginal(img, path)
+			path.unlink()
+			return img
+
+		canvas = None
+		missing = []
+		for coord in coords:
+			img = build(z + 1, 2 * x + coord[0], 2 * y + coord[1], base, top)
+			if img is None:
+				missing.append(coord)
+				continue
+			if canvas is None:
+				canvas = parentCanvas(size)
+			pasteChild(canvas, coord, img, size)
+
+		if canvas is None:
+			return None
+
+		for coord in missing:
+			path = olderTile(basepath, pathList, surfaceName, daytime, z + 1, 2 * x + coord[0], 2 * y + coord[1], catalog)
+			if path is not None:
+				pasteChild(canvas, coord, openTile(path), size)
+
+		result = finishParent(canvas, size)
+		save(result, z, x, y, top)
+		return result
+
+	if start == stop:
+		return work(basepath, pathList, surfaceName, daytime, size, start, stop, last, chunk, keepLast, catalog, signed, ext, startExt)
+
+	base = start
+	while base > stop:
+		top = max(stop, base - maxDepth) if maxDepth else stop
+		span = 2 ** (top - stop)
+		for x in range(chunk[0] * span, (chunk[0] + 1) * span):
+			for y in range(chunk[1] * span, (chunk[1] + 1) * span):
+				build(top, x, y, base, top)
+		base = top
+	return signatures
+
+
+def removeEmptyFolders(folder):
+	# the zoom level folders of a packed snapshot are empty once all its tiles are in the store.
+	for zFolder in folder.iterdir():
+		if zFolder.is_dir() and zFolder.name.isdigit():
+			for root, folders, files in os.walk(zFolder, topdown=False):
+				if not files:
+					try:
+						os.rmdir(root)
+					except OSError:
+						pass
+
+
+def pyramidNodes(maxTiles, maxzoom, minzoom, maxthreads, splitLevel=None):
+	# every node from splitLevel up to minzoom is a task. leaves on splitLevel zoom their whole subtree from maxzoom,
+	# every other node only combines its 4 children. returns the number of unfinished children per node.
+	def nodesOn(z):
+		return {(z, x >> maxzoom - z, y >> maxzoom - z) for x, y in maxTiles}
+
+	if splitLevel is None:
+		splitLevel = minzoom
+		while splitLevel < maxzoom - 3 and len(nodesOn(splitLevel)) < 16 * maxthreads:
+			splitLevel += 1
+
+	pending = {node: 0 for node in nodesOn(splitLevel)}
+	for z in range(splitLevel - 1, minzoom - 1, -1):
+		for node in nodesOn(z):
+			pending[node] = 0
+		for (_, x, y) in [node for node in pending if node[0] == z + 1]:
+			pending[(z, x >> 1, y >> 1)] += 1
+	return splitLevel, pending
+
+
+def mortonKey(node, minzoom):
+	z, x, y = node
+	return [(x >> shift, y >> shift) for shift in range(z - minzoom, -1, -1)]
+
+
+def zoomNode(basepath, pathList, surfaceName, daytime, size, start, stop, last, chunk, keepLast=False, maxDepth=0, catalog=None, signed=False, packed=False, dedup=False, ext=EXT, startExt=None, downsampler="antialias"):
+	# signed nodes return the signatures of the max zoom tiles they converted, main writes them to the sidecar.
+	global DOWNSAMPLER
+	DOWNSAMPLER = downsampler
+	with tilestore.writing(packed, dedup):
+		if maxDepth:
+			signatures = subtreeWork(basepath, pathList, surfaceName, daytime, size, start, stop, last, chunk, keepLast, maxDepth, catalog, signed, ext, startExt)
+		else:
+			signatures = work(basepath, pathList, surfaceName, daytime, size, start, stop, last, chunk, keepLast, catalog, signed, ext, startExt)
+	return (stop, chunk[0], chunk[1], signatures)
 
 
 
@@ -266,6 +541,7 @@ def zoom(
 	basepath: Path = None,
 	needsThumbnail: bool = True,
 	args: Namespace = Namespace(),
+	pool: WorkerPool = None,
 ):
 
 	psutil.Process(os.getpid()).nice(psutil.BELOW_NORMAL_PRIORITY_CLASS if os.name == "nt" else 10)
@@ -277,8 +553,18 @@ def zoom(
 	imagePath = Path(topPath, "Images")
 	maxthreads = args.zoomthreads if args.zoomthreads else args.maxthreads
 
+	if pool is None:
+		with WorkerPool(maxthreads) as pool:
+			return zoom(outFolder, timestamp, surfaceReference, daytimeReference, basepath, needsThumbnail, args, pool)
+	stage = pool.stage(maxthreads, ("zoom", timestamp, surfaceReference, daytimeReference))
+	profile = encoders.parseProfile(args.tileformat)
+	ext = screenshotExt(args)
+	unfinished = unfinishedExt(args)
+
 	with dataPath.open("r", encoding="utf-8") as f:
 		data = json.load(f)
+	catalog = TileCatalog(topPath)
+	checkpoint = openCheckpoint(topPath)
 	for mapIndex, map in enumerate(data["maps"]):
 		if timestamp is None or map["path"] == timestamp:
 			for surfaceName, surface in map["surfaces"].items():
@@ -293,10 +579,18 @@ def zoom(
 						daytimes.append("night")
 					for daytime in daytimes:
 						if daytimeReference is None or daytime == daytimeReference:
-							if not Path(topPath, "Images", str(map["path"]), surfaceName, daytime, str(maxzoom - 1)).is_dir():
+							unit = unitKey(map["path"], surfaceName, daytime)
+							savedSplitLevel, finishedNodes = checkpoint.zoomNodes(unit)
+							# folders zoomed before there was a checkpoint only have their maxzoom - 1 folder or their tile store to go by.
+							folder = Path(topPath, "Images", str(map["path"]), surfaceName, daytime)
+							if not checkpoint.isDone(unit, "zoom") and (savedSplitLevel is not None or not (Path(folder, str(maxzoom - 1)).is_dir() or Path(folder, tilestore.STOREFILE).is_file())):
 
 								print(f"zoom {0:5.1f}% [{' ' * (tsize()[0]-15)}]", end="")
 
+								# a resumed zoom keeps the formats it started with.
+								if savedSplitLevel is None:
+									encoders.writeFormats(folder, profile, minzoom, maxzoom)
+
 								generateThumbnail = (
 									needsThumbnail
 									and mapIndex == len(data["maps"]) - 1
@@ -315,158 +609,170 @@ def zoom(
 								minY = float("inf")
 								maxY = float("-inf")
 								imageSize: int = None
-								for xStr in Path(imagePath, str(map["path"]), surfaceName, daytime, str(maxzoom)).iterdir():
-									x = int(xStr.name)
+
+								catalog.index(topPath, data["maps"], mapIndex, surfaceName, daytime)
+								if catalog.hasSnapshot(mapIndex, surfaceName, daytime):
+									# ref already recorded which max zoom tiles it kept
+									maxTiles = catalog.snapshotTiles(mapIndex, surfaceName, daytime, maxzoom)
+									imageSize = catalog.size(mapIndex, surfaceName, daytime)
+								else:
+									maxTiles = []
+									for xStr in Path(imagePath, str(map["path"]), surfaceName, daytime, str(maxzoom)).iterdir():
+										for yStr in Path(imagePath, str(map["path"]), surfaceName, daytime, str(maxzoom), xStr).iterdir():
+											maxTiles.append((int(xStr.name), int(yStr.stem)))
+									catalog.markSnapshot(mapIndex, str(map["path"]), surfaceName, daytime)
+									catalog.addTiles(mapIndex, str(map["path"]), surfaceName, daytime, maxzoom, maxTiles)
+
+								for x, y in maxTiles:
+									if imageSize is None:
+										path = Path(imagePath, str(map["path"]), surfaceName, daytime, str(maxzoom), str(x), str(y)).with_suffix(ext)
+										imageSize = tilestore.openImage(path if path.is_file() else convertedTile(path) or path).size[0]
 									minX = min(minX, x)
 									maxX = max(maxX, x)
-									for yStr in Path(imagePath, str(map["path"]), surfaceName, daytime, str(maxzoom), xStr).iterdir():
-										if imageSize is None:
-											imageSize = Image.open(Path(imagePath, str(map["path"]), surfaceName, daytime, str(maxzoom), xStr, yStr), mode="r").size[0]
-										y = int(yStr.stem)
-										minY = min(minY, y)
-										maxY = max(maxY, y)
-										allBigChunks[
-											(
-												x >> maxzoom-minzoom,
-												y >> maxzoom-minzoom,
-											)
-										] = True
+									minY = min(minY, y)
+									maxY = max(maxY, y)
+									allBigChunks[
+										(
+											x >> maxzoom-minzoom,
+											y >> maxzoom-minzoom,
+										)
+									] = True
 
 								if len(allBigChunks) <= 0:
+									checkpoint.markDone(unit, "zoom")
 									continue
 
 								pathList = []
 								for otherMapIndex in range(mapIndex, -1, -1):
 									pathList.append(str(data["maps"][otherMapIndex]["path"]))
 
-								threadsplit = 0
-								while 4**threadsplit * len(allBigChunks) < maxthreads:
-									threadsplit = threadsplit + 1
-								threadsplit = min(max(maxzoom - minzoom - 3, 0), threadsplit + 3)
-								allChunks = []
-								for pos in list(allBigChunks):
-									for i in range(2**threadsplit):
-										for j in range(2**threadsplit):
-											allChunks.append(
-												(
-													pos[0] * (2**threadsplit) + i,
-													pos[1] * (2**threadsplit) + j,
-												)
-											)
+								maxDepth = subtreeMaxDepth(args.zoommemory, imageSize, args.downsampler)
 
-								threads = min(len(allChunks), maxthreads)
-								processes = []
-								originalSize = len(allChunks)
-
-								# print(("%s %s %s %s" % (pathList[0], str(surfaceName), daytime, pathList)))
-								# print(("%s-%s (total: %s):" % (start, stop + threadsplit, len(allChunks))))
-								counter = mp.Value("i", originalSize)
-								resultQueue = mp.Queue()
-								for _ in range(0, threads):
-									p = mp.Process(
-										target=thread,
-										args=(
-											imagePath,
-											pathList,
-											surfaceName,
-											daytime,
-											imageSize,
-											maxzoom,
-											minzoom + threadsplit,
-											minzoom,
-											allChunks,
-											counter,
-											resultQueue,
-											generateThumbnail,
-										),
-									)
-									p.start()
-									processes.append(p)
+								splitLevel, pending = pyramidNodes(maxTiles, maxzoom, minzoom, maxthreads, savedSplitLevel)
+								ready = sorted((node for node, childCount in pending.items() if node[0] == splitLevel and node not in finishedNodes), key=lambda node: mortonKey(node, minzoom), reverse=True)
+								originalSize = len(pending)
 
+								resultQueue = queue.Queue()
+								signatures = []
+								inFlight = 0
 								doneSize = 0
-								for _ in range(originalSize):
-									resultQueue.get(True)
+
+								# nodes an interrupted run already finished count as done right away.
+								checkpoint.addZoomNodes(unit, splitLevel, [])
+								for node in sorted(finishedNodes & pending.keys(), reverse=True):
+									doneSize += 1
+									z, x, y = node
+									if z > minzoom:
+										parent = (z - 1, x >> 1, y >> 1)
+										pending[parent] -= 1
+										if pending[parent] == 0 and parent not in finishedNodes:
+											ready.append(parent)
+								newNodes = []
+								lastSave = time.monotonic()
+								lastPrint = 0
+
+								while doneSize < originalSize:
+									# parents are pushed onto the end of ready, so they go before the remaining leaves.
+									while ready and inFlight < stage.threads:
+										z, x, y = ready.pop()
+										stage.apply_async(
+											zoomNode,
+											(imagePath, pathList, surfaceName, daytime, imageSize, maxzoom if z == splitLevel else z + 1, z, minzoom, (x, y), generateThumbnail, maxDepth, catalog, z == splitLevel, args.tilestore == "sqlite", args.dedup, unfinished, ext if z == splitLevel else unfinished, args.downsampler),
+											callback=resultQueue.put,
+											error_callback=resultQueue.put,
+										)
+										inFlight += 1
+
+									result = resultQueue.get(True)
+									if isinstance(result, BaseException):
+										raise result
+									inFlight -= 1
 									doneSize += 1
-									progress = float(doneSize) / originalSize
-									tsiz = tsize()[0] - 15
-									print(
-										"\rzoom {:5.1f}% [{}{}]".format(
-											round(progress * 98, 1),
-											"=" * int(progress * tsiz),
-											" " * (tsiz - int(progress * tsiz)),
-										),
-										end="",
-									)
 
-								for p in processes:
-									p.join()
-
-								if threadsplit > 0:
-									# print(("finishing up: %s-%s (total: %s)" % (stop + threadsplit, stop, len(allBigChunks))))
-									processes = []
-									i = len(allBigChunks) - 1
-									for chunk in list(allBigChunks):
-										p = mp.Process(
-											target=work,
-											args=(
-												imagePath,
-												pathList,
-												surfaceName,
-												daytime,
-												imageSize,
-												minzoom + threadsplit,
-												minzoom,
-												minzoom,
-												chunk,
-												generateThumbnail,
+									z, x, y, nodeSignatures = result
+									signatures += nodeSignatures
+									newNodes.append((z, x, y))
+									if time.monotonic() - lastSave > SAVEINTERVAL:
+										# signatures first, a node is only skipped next time if its signatures made it to disk.
+										appendSignatures(Path(imagePath, str(map["path"]), surfaceName, daytime), signatures)
+										checkpoint.addZoomNodes(unit, splitLevel, newNodes)
+										signatures = []
+										newNodes = []
+										lastSave = time.monotonic()
+									if z > minzoom:
+										parent = (z - 1, x >> 1, y >> 1)
+										pending[parent] -= 1
+										if pending[parent] == 0:
+											ready.append(parent)
+
+									if time.monotonic() - lastPrint > PRINTINTERVAL:
+										lastPrint = time.monotonic()
+										progress = float(doneSize) / originalSize
+										tsiz = tsize()[0] - 15
+										print(
+											"\rzoom {:5.1f}% [{}{}]".format(
+												round(progress * 98, 1),
+												"=" * int(progress * tsiz),
+												" " * (tsiz - int(progress * tsiz)),
 											),
+											end="",
 										)
-										i = i - 1
-										p.start()
-										processes.append(p)
-									for p in processes:
-										p.join()
+
+								appendSignatures(Path(imagePath, str(map["path"]), surfaceName, daytime), signatures)
+								for z in range(maxzoom - 1, minzoom - 1, -1):
+									catalog.addTiles(mapIndex, str(map["path"]), surfaceName, daytime, z, {(x >> maxzoom - z, y >> maxzoom - z) for x, y in maxTiles})
+								catalog.markSnapshot(mapIndex, str(map["path"]), surfaceName, daytime, True, imageSize)
 
 								if generateThumbnail:
-									printErase("generating thumbnail")
-									minzoompath = Path(
-										imagePath,
-										str(map["path"]),
-										surfaceName,
-										daytime,
-										str(minzoom),
-									)
+									with tracing.span("thumbnail", "zoom"):
+										printErase("generating thumbnail")
+										minzoompath = Path(
+											imagePath,
+											str(map["path"]),
+											surfaceName,
+											daytime,
+											str(minzoom),
+										)
 
-									if imageSize is None:
-										raise Exception("Missing imageSize for thumbnail generation")
+										if imageSize is None:
+											raise Exception("Missing imageSize for thumbnail generation")
 
-									thumbnail = Image.new(
-										"RGB",
-										(
-											(maxX - minX + 1) * imageSize >> maxzoom-minzoom,
-											(maxY - minY + 1) * imageSize >> maxzoom-minzoom,
-										),
-										BACKGROUNDCOLOR,
-									)
-									bigMinX = minX >> maxzoom-minzoom
-									bigMinY = minY >> maxzoom-minzoom
-									xOffset = ((bigMinX * imageSize << maxzoom-minzoom) - minX * imageSize) >> maxzoom-minzoom
-									yOffset = ((bigMinY * imageSize << maxzoom-minzoom) - minY * imageSize) >> maxzoom-minzoom
-									for chunk in list(allBigChunks):
-										path = Path(minzoompath, str(chunk[0]), str(chunk[1])).with_suffix(EXT)
-										thumbnail.paste(
-											box=(
-												xOffset + (chunk[0] - bigMinX) * imageSize,
-												yOffset + (chunk[1] - bigMinY) * imageSize,
+										thumbnail = Image.new(
+											"RGB",
+											(
+												(maxX - minX + 1) * imageSize >> maxzoom-minzoom,
+												(maxY - minY + 1) * imageSize >> maxzoom-minzoom,
 											),
-											im=Image.open(path, mode="r")
-											.convert("RGB")
-											.resize((imageSize, imageSize), Image.ANTIALIAS),
+											BACKGROUNDCOLOR,
 										)
+										bigMinX = minX >> maxzoom-minzoom
+										bigMinY = minY >> maxzoom-minzoom
+										xOffset = ((bigMinX * imageSize << maxzoom-minzoom) - minX * imageSize) >> maxzoom-minzoom
+										yOffset = ((bigMinY * imageSize << maxzoom-minzoom) - minY * imageSize) >> maxzoom-minzoom
+										for chunk in list(allBigChunks):
+											path = Path(minzoompath, str(chunk[0]), str(chunk[1])).with_suffix(unfinished)
+											if not path.is_file():
+												path = convertedTile(path) or path
+											thumbnail.paste(
+												box=(
+													xOffset + (chunk[0] - bigMinX) * imageSize,
+													yOffset + (chunk[1] - bigMinY) * imageSize,
+												),
+												im=tilestore.openImage(path)
+												.convert("RGB")
+												.resize((imageSize, imageSize), Image.ANTIALIAS),
+											)
+
+											if path.suffix == unfinished:
+												path.unlink()
 
-										if OUTEXT != EXT:
-											path.unlink()
+										thumbnail.save(Path(imagePath, "thumbnail" + THUMBNAILEXT))
 
-									thumbnail.save(Path(imagePath, "thumbnail" + THUMBNAILEXT))
+								if args.tilestore == "sqlite":
+									removeEmptyFolders(folder)
+
+								checkpoint.update("units", unit, zoom=True, zoomNodes=[])
 
 								print("\rzoom {:5.1f}% [{}]".format(100, "=" * (tsize()[0] - 15)))
+
+	catalog.close()